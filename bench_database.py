@@ -0,0 +1,272 @@
+"""Microbenchmarks for database.py at realistic table sizes.
+
+Each size gets a fresh temporary SQLite database (or --database-url, which
+must point to an empty database) filled with synthetic users, payments,
+promo codes and usages, then every benchmarked function is timed on it.
+
+    python bench_database.py --sizes 10000,100000,1000000 --save
+    python bench_database.py --sizes 100000 --compare
+
+--save writes the results to the baseline file, --compare prints the change
+against it, so schema or index changes can be checked run to run.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import database
+from promocodes import random_code
+
+BASELINE_FILE = "bench_baseline.json"
+BATCH = 10000
+# Promo codes are far fewer than users in practice
+PROMO_RATIO = 10
+BENCH_CODE = "BENCH"
+# Run once per database or never touch it
+NOT_BENCHMARKED = {"init_db", "close_db", "subscription_cache_stats"}
+
+
+def _batches(rows):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, BATCH)):
+        yield batch
+
+
+async def populate(size: int, seed: int = 0):
+    """Fill the tables: `size` users, payments and usages, size/10 promo codes"""
+    rng = random.Random(seed)
+    now = datetime.now()
+    promos = max(size // PROMO_RATIO, 1)
+
+    def users():
+        for n in range(1, size + 1):
+            # Half active, a quarter expired, a quarter never subscribed
+            r = rng.random()
+            expiry = now + timedelta(days=rng.randint(1, 365)) if r < 0.5 else (
+                now - timedelta(days=rng.randint(1, 365)) if r < 0.75 else None
+            )
+            yield n, n, f"user{n}", f"User {n}", expiry, True
+
+    def payments():
+        for n in range(1, size + 1):
+            yield rng.randint(1, size), rng.choice((100, 300, 500)), "RUB", 30, "bench", f"bench-{n}"
+
+    def promo_codes():
+        for n in range(1, promos + 1):
+            yield n, f"CODE{n:07d}", 7, 100, 0, now + timedelta(days=30)
+
+    def usages():
+        # Distinct (user, promo) pairs
+        for n in range(1, size + 1):
+            yield n % promos + 1, n
+
+    async with database._db().transaction() as conn:
+        for sql, rows in (
+            ("INSERT INTO users (id, telegram_id, username, full_name, subscription_expiry, is_active) "
+             "VALUES (?, ?, ?, ?, ?, ?)", users()),
+            ("INSERT INTO payments (user_id, amount, currency, days, invoice_payload, telegram_payment_charge_id) "
+             "VALUES (?, ?, ?, ?, ?, ?)", payments()),
+            ("INSERT INTO promo_codes (id, code, days, max_uses, used_count, expires_at) "
+             "VALUES (?, ?, ?, ?, ?, ?)", promo_codes()),
+            ("INSERT INTO promo_code_usages (promo_code_id, user_id) VALUES (?, ?)", usages()),
+        ):
+            for batch in _batches(rows):
+                await conn.executemany(sql, batch)
+        if database._db().dialect == "postgresql":
+            # Explicit ids don't advance the BIGSERIAL sequences
+            for table in ("users", "promo_codes"):
+                await conn.fetchval(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))"
+                )
+
+    await database.create_promo_code(BENCH_CODE, 7, max_uses=10 ** 9)
+    await database.create_promo_code(BENCH_CODE + "2", 7, max_uses=10 ** 9)
+
+
+async def _first_chunk(chunks):
+    async for rows in chunks:
+        return rows
+
+
+def benchmarks(size: int, rng: random.Random) -> dict:
+    """name -> zero-argument coroutine factory, one call per operation"""
+    fresh_ids = itertools.count(size + 1)
+    charges = itertools.count(1)
+    redeemers = itertools.count(1)
+    promo_redeemers = itertools.count(1)
+    new_codes = itertools.count(1)
+    media = itertools.count(1)
+    deleted_media = itertools.count(1)
+    # create_broadcast runs first, so these ids exist; broadcast 1 stays running
+    finished = itertools.count(2)
+    promos = max(size // PROMO_RATIO, 1)
+    now = datetime.now()
+
+    def existing():
+        return rng.randint(1, size)
+
+    def promo():
+        return f"CODE{rng.randint(1, promos):07d}"
+
+    return {
+        "get_user": lambda: database.get_user(existing()),
+        "get_subscription_expiry": lambda: database.get_subscription_expiry(existing()),
+        "get_subscription_info": lambda: database.get_subscription_info(existing()),
+        "has_active_subscription": lambda: database.has_active_subscription(existing()),
+        "get_users_count": database.get_users_count,
+        "get_active_subs_count": database.get_active_subs_count,
+        "get_stats_summary": database.get_stats_summary,
+        "stats_backfilled": database.stats_backfilled,
+        "validate_promo_code": lambda: database.validate_promo_code(promo()),
+        "has_used_promo_code": lambda: database.has_used_promo_code(existing(), promo()),
+        "list_all_promo_codes": database.list_all_promo_codes,
+        "list_promo_codes_page": lambda: database.list_promo_codes_page(after_id=rng.randint(1, promos)),
+        "create_user": lambda: database.create_user(next(fresh_ids), "bench", "Bench"),
+        "upsert_users": lambda: database.upsert_users(
+            [(existing(), "bench", "Bench") for _ in range(50)]
+            + [(next(fresh_ids), "bench", "Bench") for _ in range(50)]
+        ),
+        "add_subscription": lambda: database.add_subscription(existing(), 30),
+        "record_payment": lambda: database.record_payment(
+            existing(), 300, "RUB", 30, "bench", f"bench-run-{next(charges)}"
+        ),
+        "create_promo_code": lambda: database.create_promo_code(f"NEW{next(new_codes)}", 7),
+        "create_promo_codes": lambda: database.create_promo_codes(lambda: random_code("BATCH"), 100, 7),
+        # Each call redeems a BENCH code for a user who has not used it yet
+        "use_promo_code": lambda: database.use_promo_code(BENCH_CODE, next(redeemers)),
+        "redeem_promo_code": lambda: database.redeem_promo_code(BENCH_CODE + "2", next(promo_redeemers)),
+        "save_media_file_id": lambda: database.save_media_file_id(f"hash{next(media)}", "file-id"),
+        "get_media_file_id": lambda: database.get_media_file_id(f"hash{rng.randint(1, 3)}"),
+        "delete_media_file_id": lambda: database.delete_media_file_id(f"hash{next(deleted_media)}"),
+        "create_broadcast": lambda: database.create_broadcast(0, "bench"),
+        "get_broadcast": lambda: database.get_broadcast(1),
+        "get_running_broadcasts": database.get_running_broadcasts,
+        "save_broadcast_progress": lambda: database.save_broadcast_progress(1, existing(), 500, 0, []),
+        "finish_broadcast": lambda: database.finish_broadcast(next(finished)),
+        "iter_active_users": lambda: _first_chunk(database.iter_active_users(existing())),
+        "iter_table_rows": lambda: _first_chunk(database.iter_table_rows("payments", now.date())),
+        "claim_expiry_reminders": lambda: database.claim_expiry_reminders(
+            3, now, now + timedelta(days=365)
+        ),
+        "mark_reminders_sent": lambda: database.mark_reminders_sent(
+            3, [existing() for _ in range(100)]
+        ),
+        "set_fsm_state": lambda: database.set_fsm_state(
+            f"bench:{existing()}", "State:bench", now + timedelta(hours=1)
+        ),
+        "set_fsm_data": lambda: database.set_fsm_data(
+            f"bench:{existing()}", "{}", now + timedelta(hours=1)
+        ),
+        "get_fsm_record": lambda: database.get_fsm_record(f"bench:{existing()}"),
+        "delete_fsm_record": lambda: database.delete_fsm_record(f"bench:{existing()}"),
+        "delete_expired_fsm_records": database.delete_expired_fsm_records,
+        "refresh_active_subscriptions": database.refresh_active_subscriptions,
+        # Rewrites the rollups from the whole history: the slowest on purpose
+        "rebuild_stats": database.rebuild_stats,
+    }
+
+
+async def measure(op, min_time: float, max_iterations: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_iterations and (len(latencies) < 3 or time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        await op()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "ops_per_sec": round(len(latencies) / total, 1),
+        "mean_ms": round(total / len(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+        "iterations": len(latencies),
+    }
+
+
+async def run_size(size: int, database_url: str = None, min_time: float = 1.0,
+                   max_iterations: int = 10000, only=None) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        await database.init_db(database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        # Entries from the previous size would turn lookups into cache hits
+        database._expiry_cache.clear()
+        try:
+            started = time.perf_counter()
+            await populate(size)
+            results = {"_populate_sec": round(time.perf_counter() - started, 2)}
+
+            rng = random.Random(1)
+            for name, op in benchmarks(size, rng).items():
+                if only and name not in only:
+                    continue
+                results[name] = await measure(op, min_time, max_iterations)
+        finally:
+            await database.close_db()
+    return results
+
+
+def format_results(size: int, results: dict, baseline: dict = None) -> str:
+    lines = [f"== {size} rows (populated in {results['_populate_sec']} s)"]
+    lines.append(f"{'function':<30}{'ops/s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, r in results.items():
+        if name.startswith("_"):
+            continue
+        line = f"{name:<30}{r['ops_per_sec']:>10}{r['mean_ms']:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}"
+        old = (baseline or {}).get(name)
+        if old:
+            line += f"   {(r['ops_per_sec'] / old['ops_per_sec'] - 1) * 100:+.0f}% ops/s vs baseline"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, all_results: dict):
+    baseline = load_baseline(path)
+    baseline.update(all_results)
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated row counts")
+    parser.add_argument("--only", default="", help="comma-separated function names")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds per function")
+    parser.add_argument("--max-iterations", type=int, default=10000)
+    parser.add_argument("--database-url", default=None, help="default: temporary SQLite file")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="store results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="show change against the baseline")
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    baseline = load_baseline(args.baseline) if args.compare else {}
+    only = {name for name in args.only.split(",") if name}
+    all_results = {}
+    for size in (int(x) for x in args.sizes.split(",") if x):
+        results = await run_size(size, args.database_url, args.min_time, args.max_iterations, only)
+        all_results[str(size)] = results
+        print(format_results(size, results, baseline.get(str(size))))
+        print()
+
+    if args.save:
+        save_baseline(args.baseline, all_results)
+        print(f"Baseline saved to {args.baseline}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramAPIError
+
+from config import BROADCAST_RATE, BROADCAST_CHUNK
+from database import (
+    create_broadcast, get_broadcast, get_running_broadcasts, iter_active_users,
+    save_broadcast_progress, finish_broadcast
+)
+from outbound import BULK, request_priority
+from ratelimit import TokenBucket
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+MAX_RETRIES = 3
+
+
+class Broadcaster:
+    """Sends admin broadcasts to every active user.
+
+    Recipients are read chunk by chunk in users.id order; after each chunk
+    the position is checkpointed in `broadcasts.last_user_id`, so a restart
+    resumes from there (at most one chunk is re-sent).
+    """
+
+    def __init__(self, bot: Bot, rate: float = BROADCAST_RATE, chunk_size: int = BROADCAST_CHUNK):
+        self.bot = bot
+        self.chunk_size = chunk_size
+        self.bucket = TokenBucket(rate)
+        self._tasks = {}  # broadcast id -> Task
+
+    async def start(self, admin_chat_id: int, text: str = None,
+                    from_chat_id: int = None, message_id: int = None) -> int:
+        broadcast_id = await create_broadcast(admin_chat_id, text, from_chat_id, message_id)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self):
+        """Restart broadcasts that were running when the bot stopped"""
+        for row in await get_running_broadcasts():
+            logging.info(f"Resuming broadcast #{row['id']} after user {row['last_user_id']}")
+            self._spawn(row["id"])
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+        # A broadcast run by another worker stops at its next checkpoint
+        return await finish_broadcast(broadcast_id, "cancelled")
+
+    def is_running(self, broadcast_id: int) -> bool:
+        return broadcast_id in self._tasks
+
+    def _spawn(self, broadcast_id: int):
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _send_one(self, row, telegram_id: int) -> str:
+        for _ in range(MAX_RETRIES):
+            await self.bucket.acquire()
+            try:
+                if row["message_id"]:
+                    await self.bot.copy_message(
+                        chat_id=telegram_id,
+                        from_chat_id=row["from_chat_id"],
+                        message_id=row["message_id"],
+                    )
+                else:
+                    await self.bot.send_message(chat_id=telegram_id, text=row["text"])
+                return SENT
+            except TelegramRetryAfter as e:
+                # Flood control applies to the whole bot: stop every sender
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except TelegramAPIError as e:
+                logging.warning(f"Broadcast to {telegram_id} failed: {e}")
+                return FAILED
+        return FAILED
+
+    async def _run(self, broadcast_id: int):
+        # Runs in its own task, so this only affects the broadcast's requests
+        request_priority.set(BULK)
+        row = await get_broadcast(broadcast_id)
+        try:
+            async for users in iter_active_users(row["last_user_id"], self.chunk_size):
+                results = await asyncio.gather(
+                    *(self._send_one(row, u["telegram_id"]) for u in users)
+                )
+                blocked = [u["telegram_id"] for u, r in zip(users, results) if r == BLOCKED]
+                running = await save_broadcast_progress(
+                    broadcast_id,
+                    last_user_id=users[-1]["id"],
+                    sent=results.count(SENT),
+                    failed=results.count(FAILED),
+                    blocked_telegram_ids=blocked,
+                )
+                if not running:
+                    return
+            if not await finish_broadcast(broadcast_id):
+                return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception(f"Broadcast #{broadcast_id} stopped")
+            return
+
+        row = await get_broadcast(broadcast_id)
+        try:
+            await self.bot.send_message(
+                chat_id=row["admin_chat_id"],
+                text=f"📣 Рассылка #{broadcast_id} завершена.\n\n"
+                     f"✅ Доставлено: {row['sent']}\n"
+                     f"🚫 Заблокировали бота: {row['blocked']}\n"
+                     f"❌ Ошибок: {row['failed']}",
+            )
+        except TelegramAPIError:
+            pass
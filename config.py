@@ -6,13 +6,77 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# Групповая запись пользователей при /start: период сброса (с), размер пачки, максимум ожидающих
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "0.005"))
+USER_FLUSH_BATCH = int(os.getenv("USER_FLUSH_BATCH", "500"))
+USER_QUEUE_SIZE = int(os.getenv("USER_QUEUE_SIZE", "10000"))
+# Профилирование запросов (/dbprofile) и порог журнала медленных запросов, мс
+DB_PROFILE = os.getenv("DB_PROFILE", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "100"))
+# Кэш статуса подписки (записей, секунд)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "60"))
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")
 
+# Приём обновлений: polling или webhook
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес за reverse proxy, напр. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+# Свой Bot API сервер (или локальный фейк для тестов), пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
+# Исходящие запросы к Bot API: сообщений в секунду всего и на чат (с запасом на всплеск), повторы после RetryAfter
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Антифлуд: очков в секунду и запас на пользователя (кнопка = 1, сообщение и «Назад» = 2,
+# /start, счета и записи в базу = 5); предупреждать ли один раз о превышении
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "2"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "20"))
+THROTTLE_NOTICE = os.getenv("THROTTLE_NOTICE", "1") == "1"
+
+# Многопроцессный режим (python supervisor.py): число воркеров, обновлений в работе на воркер, неподтверждённых обновлений на воркер
+WORKERS = int(os.getenv("WORKERS", "2"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "100"))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+
+# Prometheus /metrics на отдельном порту (не на публичном webhook-сервере), 0 = не запускать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
 # Цены подписки
 SUBSCRIPTION_PRICES = [int(x) for x in os.getenv("SUBSCRIPTION_PRICES", "100,300,500").split(",")]
 SUBSCRIPTION_STARS = [int(x) for x in os.getenv("SUBSCRIPTION_STARS", "50,150,250").split(",")]
 SUBSCRIPTION_DAYS = [int(x) for x in os.getenv("SUBSCRIPTION_DAYS", "30,90,365").split(",")]
 
+# Рассылки: сообщений в секунду (лимит Telegram ~30), пользователей на чекпоинт
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "100"))
+
+# Напоминания об окончании подписки: за сколько дней, как часто проверять (сек)
+REMINDER_WINDOWS = sorted(
+    (int(x) for x in os.getenv("REMINDER_WINDOWS", "3,1").split(",") if x), reverse=True
+)
+REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", "3600"))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "10"))
+
+# Состояния FSM (ввод промокода, отзыв): время жизни брошенного диалога и период очистки, с
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))
+FSM_REAP_INTERVAL = int(os.getenv("FSM_REAP_INTERVAL", "600"))
+
+# Как часто обновлять снимок числа активных подписок для /stats, с
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", "600"))
+
+# Выгрузка /export: строк на один запрос к базе
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+
 APP_URL = os.getenv("APP_URL", "https://your-app.com")
 FEEDBACK_URL = os.getenv("FEEDBACK_URL", APP_URL)  # URL формы обратной связи
 
@@ -33,6 +97,11 @@ MESSAGES = {
 🕐 Осталось дней: {days_left}
 
 Вы можете получить доступ к приложению.
+""",
+    "expiry_reminder": """
+⏳ Ваша подписка заканчивается {expiry_date}.
+
+Продлите её, чтобы не потерять доступ к приложению.
 """,
     "choose_plan": """
 💎 Выберите тариф подписки:
@@ -0,0 +1,95 @@
+import asyncio
+import inspect
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import database
+from database import init_db, close_db
+
+
+@pytest.fixture
+def run_db(tmp_path):
+    """run_db(scenario, **init_db kwargs): run an async scenario against a
+    fresh SQLite database in tmp_path, return its result"""
+    def run(scenario, **kwargs):
+        async def wrapper():
+            await init_db(f"sqlite:///{tmp_path / 'bot.db'}", **kwargs)
+            # Entries left by an earlier test describe another database
+            database._expiry_cache.clear()
+            try:
+                return await scenario()
+            finally:
+                await close_db()
+
+        return asyncio.run(wrapper())
+
+    return run
+
+
+class FakeBotAPI:
+    """Bot API stand-in on a local port that records every call.
+
+    Replies with a message in the requested chat to send*/edit* calls and
+    True to everything else; `respond(method, data)` (plain or async) may
+    return a web.Response to answer differently.
+    """
+
+    def __init__(self, respond=None):
+        self.respond = respond
+        self.calls = []  # (method, form data)
+        self.server = None
+
+    @property
+    def methods(self) -> list:
+        return [method for method, _ in self.calls]
+
+    @staticmethod
+    def error(code: int, description: str) -> web.Response:
+        return web.json_response({"ok": False, "error_code": code, "description": description},
+                                 status=code)
+
+    async def start(self) -> "FakeBotAPI":
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return self
+
+    def bot(self, token: str = "123:TEST") -> Bot:
+        base = str(self.server.make_url(""))
+        return Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+
+    async def close(self):
+        await self.server.close()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls.append((method, data))
+        if self.respond is not None:
+            response = self.respond(method, data)
+            if inspect.isawaitable(response):
+                response = await response
+            if response is not None:
+                return response
+
+        result = True
+        if method.startswith(("send", "edit")):
+            result = {
+                "message_id": int(data.get("message_id") or 1),
+                "date": 0,
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+
+@pytest.fixture
+def fake_bot_api():
+    """FakeBotAPI class; start it inside the test's event loop"""
+    return FakeBotAPI
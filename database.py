@@ -1,301 +1,865 @@
-import sqlite3
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import Optional
+import logging
 import os
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "bot.db")
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            full_name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            subscription_expiry TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            amount INTEGER NOT NULL,
-            days INTEGER NOT NULL,
-            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            invoice_payload TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id)
+from cache import MISSING, TTLCache
+from config import (
+    DATABASE_URL, DB_POOL_SIZE, DB_PROFILE, SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL
+)
+from dbprofile import ProfiledPool, profiler
+from migrations import migrate
+from storage import IntegrityError, create_pool
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_pool = None
+
+# telegram_id -> subscription expiry (None = no subscription / no user)
+_expiry_cache = TTLCache(maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+
+
+def _db():
+    if _pool is None:
+        raise RuntimeError("Database is not initialized, call init_db() first")
+    return _pool
+
+
+def _as_datetime(value) -> Optional[datetime]:
+    # SQLite hands timestamps back as ISO strings, PostgreSQL as datetime
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+async def init_db(url: str = DATABASE_URL, pool_size: int = DB_POOL_SIZE, profile: bool = DB_PROFILE):
+    """Open the pool and bring the schema up to date"""
+    global _pool
+    if _pool is None:
+        pool = create_pool(url, size=pool_size, base_dir=BASE_DIR)
+        await pool.open()
+        _pool = ProfiledPool(pool, profiler) if profile else pool
+
+    await migrate(_pool)
+
+
+async def close_db():
+    """Close pooled connections (on shutdown)"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def _get_user(conn, telegram_id: int):
+    return await conn.fetchone("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+
+
+async def get_user(telegram_id: int):
+    async with _db().acquire() as conn:
+        return await _get_user(conn, telegram_id)
+
+async def get_users_count() -> int:
+    async with _db().acquire() as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM users")
+
+async def get_active_subs_count() -> int:
+    async with _db().acquire() as conn:
+        # Check for users where subscription_expiry date is > current timestamp
+        return await conn.fetchval(
+            "SELECT COUNT(*) FROM users WHERE subscription_expiry > ?",
+            (datetime.now(),)
         )
-    """)
-    
-    conn.commit()
-    conn.close()
-
-def get_user(telegram_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
-
-def get_users_count() -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM users")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
 
-def get_active_subs_count() -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Check for users where subscription_expiry date is > current timestamp
-    cursor.execute("SELECT COUNT(*) FROM users WHERE subscription_expiry > datetime('now')")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+async def create_user(telegram_id: int, username: str, full_name: str):
+    await upsert_users([(telegram_id, username, full_name)])
 
-def create_user(telegram_id: int, username: str, full_name: str):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR IGNORE INTO users (telegram_id, username, full_name) VALUES (?, ?, ?)",
-        (telegram_id, username, full_name)
-    )
-    conn.commit()
-    conn.close()
+# Rows per multi-row INSERT; 3 parameters each, PostgreSQL takes at most 32767
+UPSERT_CHUNK = 500
+MAX_UPSERT_CHUNK = 10000
 
-def has_active_subscription(telegram_id: int) -> bool:
-    user = get_user(telegram_id)
-    if not user:
-        return False
-    
-    expiry = user[5]
-    if expiry is None:
+
+def _padded_chunks(rows: list, size: int):
+    """Chunks of `size` rows. The last one is padded to a power of two by
+    repeating its final row, so a handful of statement shapes cover any
+    batch: asyncpg's statement cache and the profiler stats stay small."""
+    for start in range(0, len(rows), size):
+        chunk = rows[start:start + size]
+        padded = min(size, 1 << (len(chunk) - 1).bit_length())
+        yield chunk + chunk[-1:] * (padded - len(chunk))
+
+
+async def upsert_users(users: list, chunk_size: int = UPSERT_CHUNK):
+    """Create or refresh (telegram_id, username, full_name) rows in one transaction.
+
+    Existing rows are only rewritten when something changed, and a user
+    who had blocked the bot becomes active again. New users are counted
+    in the stats rollups in the same transaction. The INSERT goes out in
+    chunks of `chunk_size` rows.
+    """
+    # Last occurrence wins, as it would with one upsert per user
+    users = list({telegram_id: (telegram_id, username, full_name)
+                  for telegram_id, username, full_name in users}.values())
+    if not users:
+        return
+    chunk_size = min(chunk_size, MAX_UPSERT_CHUNK)
+    async with _db().transaction() as conn:
+        new_ids = set()
+        for chunk in _padded_chunks(users, chunk_size):
+            # Multi-row INSERT so RETURNING tells which users are new;
+            # a padding row conflicts with its original and is skipped
+            inserted = await conn.fetchall(
+                f"""INSERT INTO users (telegram_id, username, full_name)
+                    VALUES {', '.join(['(?, ?, ?)'] * len(chunk))}
+                    ON CONFLICT (telegram_id) DO NOTHING RETURNING telegram_id""",
+                [value for user in chunk for value in user]
+            )
+            new_ids.update(row[0] for row in inserted)
+        existing = [user for user in users if user[0] not in new_ids]
+        if existing:
+            await conn.executemany(
+                """UPDATE users SET username = ?, full_name = ?, is_active = ?
+                   WHERE telegram_id = ?
+                     AND (NOT is_active
+                          OR COALESCE(username, '') <> ?
+                          OR COALESCE(full_name, '') <> ?)""",
+                [(username, full_name, True, telegram_id, username, full_name)
+                 for telegram_id, username, full_name in existing]
+            )
+        if new_ids:
+            await _add_stat(conn, STAT_NEW_USERS, len(new_ids))
+
+async def get_subscription_expiry(telegram_id: int) -> Optional[datetime]:
+    """Subscription expiry, served from the in-process cache when possible"""
+    expiry = _expiry_cache.get(telegram_id)
+    if expiry is MISSING:
+        async with _db().acquire() as conn:
+            expiry = _as_datetime(await conn.fetchval(
+                "SELECT subscription_expiry FROM users WHERE telegram_id = ?", (telegram_id,)
+            ))
+        _expiry_cache.add(telegram_id, expiry)
+    return expiry
+
+def subscription_cache_stats() -> dict:
+    """Hit/miss counters of the subscription cache"""
+    return _expiry_cache.stats()
+
+async def has_active_subscription(telegram_id: int) -> bool:
+    expiry_date = await get_subscription_expiry(telegram_id)
+    if expiry_date is None:
         return False
-    
-    expiry_date = datetime.fromisoformat(expiry)
+
     return datetime.now() < expiry_date
 
-def get_subscription_info(telegram_id: int) -> Optional[dict]:
-    user = get_user(telegram_id)
-    if not user or not user[5]:
+async def get_subscription_info(telegram_id: int) -> Optional[dict]:
+    expiry_date = await get_subscription_expiry(telegram_id)
+    if not expiry_date:
         return None
-    
-    expiry_date = datetime.fromisoformat(user[5])
+
     days_left = (expiry_date - datetime.now()).days
-    
+
     return {
         "expiry_date": expiry_date.strftime("%d.%m.%Y"),
         "days_left": max(0, days_left)
     }
 
-def add_subscription(telegram_id: int, days: int):
-    user = get_user(telegram_id)
+
+def _extended_expiry(current_expiry, days: int) -> datetime:
+    current_expiry = _as_datetime(current_expiry)
+    if current_expiry and current_expiry > datetime.now():
+        return current_expiry + timedelta(days=days)
+    return datetime.now() + timedelta(days=days)
+
+
+async def _add_subscription(conn, telegram_id: int, days: int):
+    user = await conn.fetchone(
+        "SELECT subscription_expiry FROM users WHERE telegram_id = ?" + _db().row_lock,
+        (telegram_id,)
+    )
     if not user:
         return
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    current_expiry = user[5]
-    if current_expiry and datetime.fromisoformat(current_expiry) > datetime.now():
-        new_expiry = datetime.fromisoformat(current_expiry) + timedelta(days=days)
-    else:
-        new_expiry = datetime.now() + timedelta(days=days)
-    
-    cursor.execute(
+
+    new_expiry = _extended_expiry(user["subscription_expiry"], days)
+    await conn.execute(
         "UPDATE users SET subscription_expiry = ? WHERE telegram_id = ?",
-        (new_expiry.isoformat(), telegram_id)
+        (new_expiry, telegram_id)
     )
-    conn.commit()
-    conn.close()
-    
     return new_expiry
 
-def add_payment(user_id: int, amount: int, days: int, invoice_payload: str):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO payments (user_id, amount, days, invoice_payload) VALUES (?, ?, ?, ?)",
-        (user_id, amount, days, invoice_payload)
-    )
-    conn.commit()
-    conn.close()
-
-def get_user_id_by_telegram_id(telegram_id: int) -> Optional[int]:
-    user = get_user(telegram_id)
-    return user[0] if user else None
-
-
-def init_promo_codes_table():
-    """Create promo codes table"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS promo_codes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE NOT NULL,
-            days INTEGER NOT NULL,
-            max_uses INTEGER DEFAULT 1,
-            used_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expires_at TIMESTAMP,
-            is_active BOOLEAN DEFAULT 1
+
+async def add_subscription(telegram_id: int, days: int):
+    try:
+        async with _db().transaction() as conn:
+            new_expiry = await _add_subscription(conn, telegram_id, days)
+    except BaseException:
+        _expiry_cache.invalidate(telegram_id)
+        raise
+
+    # Write-through once the new expiry is committed
+    _expiry_cache.set(telegram_id, new_expiry)
+    return new_expiry
+
+# record_payment() statuses
+PAYMENT_OK = "ok"
+PAYMENT_DUPLICATE = "duplicate"
+PAYMENT_NO_USER = "no_user"
+
+
+async def record_payment(telegram_id: int, amount: int, currency: str, days: int,
+                         invoice_payload: str, telegram_payment_charge_id: str,
+                         provider_payment_charge_id: str = None) -> dict:
+    """Credit a successful payment exactly once.
+
+    The ledger row and the subscription extension commit in one
+    transaction. A redelivered update with the same Telegram charge id hits
+    the unique index and changes nothing. With days=0 the charge is only
+    recorded, the subscription stays as it is.
+    Returns {"status", "expiry"} (expiry only for PAYMENT_OK).
+    """
+    async with _db().transaction() as conn:
+        user = await conn.fetchone(
+            "SELECT id, subscription_expiry FROM users WHERE telegram_id = ?" + _db().row_lock,
+            (telegram_id,)
+        )
+        if not user:
+            return {"status": PAYMENT_NO_USER}
+
+        inserted = await conn.execute(
+            """INSERT INTO payments (user_id, amount, days, invoice_payload, currency,
+                                     telegram_payment_charge_id, provider_payment_charge_id)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (telegram_payment_charge_id) DO NOTHING""",
+            (user["id"], amount, days, invoice_payload, currency,
+             telegram_payment_charge_id, provider_payment_charge_id)
         )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS promo_code_usages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            promo_code_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (promo_code_id) REFERENCES promo_codes (id),
-            FOREIGN KEY (user_id) REFERENCES users (id)
+        if not inserted:
+            return {"status": PAYMENT_DUPLICATE}
+        await _add_stat(conn, STAT_PAYMENTS, 1, currency or "")
+        await _add_stat(conn, STAT_REVENUE, amount, currency or "")
+        if not days:
+            # Unmatched charge: kept in the ledger to be credited by hand
+            return {"status": PAYMENT_OK, "expiry": _as_datetime(user["subscription_expiry"])}
+
+        new_expiry = _extended_expiry(user["subscription_expiry"], days)
+        await conn.execute(
+            "UPDATE users SET subscription_expiry = ? WHERE id = ?",
+            (new_expiry, user["id"])
         )
-    """)
-    
-    conn.commit()
-    conn.close()
+
+    _expiry_cache.set(telegram_id, new_expiry)
+    return {"status": PAYMENT_OK, "expiry": new_expiry}
 
 
-def create_promo_code(code: str, days: int, max_uses: int = 1, expires_at: datetime = None):
+async def create_promo_code(code: str, days: int, max_uses: int = 1, expires_at: datetime = None):
     """Create new promo code"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute(
-            """INSERT INTO promo_codes (code, days, max_uses, expires_at) 
-               VALUES (?, ?, ?, ?)""",
-            (code.upper(), days, max_uses, expires_at.isoformat() if expires_at else None)
-        )
-        conn.commit()
-        conn.close()
+        async with _db().transaction() as conn:
+            await conn.execute(
+                """INSERT INTO promo_codes (code, days, max_uses, expires_at)
+                   VALUES (?, ?, ?, ?)""",
+                (code.upper(), days, max_uses, expires_at)
+            )
         return True
-    except sqlite3.IntegrityError:
-        conn.close()
+    except IntegrityError:
         return False
 
 
-def validate_promo_code(code: str) -> Optional[dict]:
-    """Validate promo code and return info if valid"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT * FROM promo_codes WHERE code = ? AND is_active = 1",
+PROMO_BATCH_ATTEMPTS = 3
+
+
+async def create_promo_codes(generate, count: int, days: int, max_uses: int = 1,
+                             expires_at: datetime = None, chunk_size: int = 500) -> list:
+    """Insert `count` new codes made by generate() in one transaction, return them.
+
+    Candidates that repeat within the batch or already exist are replaced
+    with fresh ones before the executemany INSERT. Should another process
+    insert one of them meanwhile, the whole batch is retried.
+    """
+    for attempt in range(PROMO_BATCH_ATTEMPTS):
+        try:
+            async with _db().transaction() as conn:
+                codes = set()
+                while len(codes) < count:
+                    candidates = {generate().upper() for _ in range(count - len(codes))} - codes
+                    pending = sorted(candidates)
+                    for i in range(0, len(pending), chunk_size):
+                        chunk = pending[i:i + chunk_size]
+                        taken = await conn.fetchall(
+                            f"SELECT code FROM promo_codes WHERE code IN ({', '.join('?' * len(chunk))})",
+                            chunk
+                        )
+                        candidates.difference_update(row[0] for row in taken)
+                    if not candidates:
+                        raise ValueError("generate() keeps returning codes that are taken")
+                    codes |= candidates
+
+                codes = sorted(codes)
+                await conn.executemany(
+                    """INSERT INTO promo_codes (code, days, max_uses, expires_at)
+                       VALUES (?, ?, ?, ?)""",
+                    [(code, days, max_uses, expires_at) for code in codes]
+                )
+            return codes
+        except IntegrityError:
+            if attempt == PROMO_BATCH_ATTEMPTS - 1:
+                raise
+
+
+async def _validate_promo_code(conn, code: str) -> Optional[dict]:
+    promo = await conn.fetchone(
+        "SELECT * FROM promo_codes WHERE code = ? AND is_active",
         (code.upper(),)
     )
-    promo = cursor.fetchone()
-    conn.close()
-    
+
     if not promo:
         return None
-    
+
     # Check if expired
-    if promo[6]:  # expires_at
-        expiry = datetime.fromisoformat(promo[6])
+    if promo["expires_at"]:
+        expiry = _as_datetime(promo["expires_at"])
         if datetime.now() > expiry:
             return None
-    
+
     # Check if max uses reached
-    if promo[4] >= promo[3]:  # used_count >= max_uses
+    if promo["used_count"] >= promo["max_uses"]:
         return None
-    
+
     return {
-        "id": promo[0],
-        "code": promo[1],
-        "days": promo[2],
-        "max_uses": promo[3],
-        "used_count": promo[4]
+        "id": promo["id"],
+        "code": promo["code"],
+        "days": promo["days"],
+        "max_uses": promo["max_uses"],
+        "used_count": promo["used_count"]
     }
 
 
-def use_promo_code(code: str, telegram_id: int) -> bool:
-    """Apply promo code to user"""
-    promo = validate_promo_code(code)
-    if not promo:
-        return False
-    
-    # Check if user already used it
-    if has_used_promo_code(telegram_id, code):
-        return False
+async def validate_promo_code(code: str) -> Optional[dict]:
+    """Validate promo code and return info if valid"""
+    async with _db().acquire() as conn:
+        return await _validate_promo_code(conn, code)
 
-    user = get_user(telegram_id)
-    if not user:
-        return False
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+
+# redeem_promo_code() statuses
+PROMO_OK = "ok"
+PROMO_INVALID = "invalid"            # unknown, inactive, expired or out of uses
+PROMO_ALREADY_USED = "already_used"
+PROMO_NO_USER = "no_user"
+
+
+class _Rollback(Exception):
+    def __init__(self, status: str):
+        self.status = status
+
+
+async def redeem_promo_code(code: str, telegram_id: int) -> dict:
+    """Apply promo code to user in a single transaction.
+
+    A use is claimed with a conditional UPDATE (used_count < max_uses), so
+    concurrent redemptions can never exceed the limit; the usage row and the
+    subscription extension commit together with it or not at all.
+    Returns {"status", "code", "days", "expiry"} (only status unless PROMO_OK).
+    """
+    code = code.upper()
     try:
-        # Increment used count
-        cursor.execute(
-            "UPDATE promo_codes SET used_count = used_count + 1 WHERE id = ?",
-            (promo["id"],)
-        )
-        
-        # Record usage
-        cursor.execute(
-            "INSERT INTO promo_code_usages (promo_code_id, user_id) VALUES (?, ?)",
-            (promo["id"], user[0])
-        )
-        
-        conn.commit()
-        conn.close()
-        
-        # Add subscription days
-        add_subscription(telegram_id, promo["days"])
-        
-        return True
-    except Exception as e:
-        print(f"Error in use_promo_code: {e}")
-        conn.close()
-        return False
+        async with _db().transaction() as conn:
+            user = await conn.fetchone(
+                "SELECT id, subscription_expiry FROM users WHERE telegram_id = ?" + _db().row_lock,
+                (telegram_id,)
+            )
+            if not user:
+                return {"status": PROMO_NO_USER}
+            # Before the limit check, so a used code that has since run out
+            # is reported as used rather than invalid
+            if await _has_used_promo_code(conn, telegram_id, code):
+                return {"status": PROMO_ALREADY_USED}
 
+            promo = await conn.fetchone("""
+                UPDATE promo_codes SET used_count = used_count + 1
+                WHERE code = ? AND is_active AND used_count < max_uses
+                  AND (expires_at IS NULL OR expires_at > ?)
+                RETURNING id, days
+            """, (code, datetime.now()))
+            if not promo:
+                return {"status": PROMO_INVALID}
 
-def has_used_promo_code(telegram_id: int, code: str) -> bool:
-    """Check if user already used this promo code"""
-    user = get_user(telegram_id)
-    if not user:
+            # Unique (user_id, promo_code_id): a repeat use inserts nothing
+            inserted = await conn.execute(
+                """INSERT INTO promo_code_usages (promo_code_id, user_id) VALUES (?, ?)
+                   ON CONFLICT DO NOTHING""",
+                (promo["id"], user["id"])
+            )
+            if not inserted:
+                raise _Rollback(PROMO_ALREADY_USED)
+            await _add_stat(conn, STAT_PROMO_REDEMPTIONS, 1)
+
+            new_expiry = _extended_expiry(user["subscription_expiry"], promo["days"])
+            await conn.execute(
+                "UPDATE users SET subscription_expiry = ? WHERE id = ?",
+                (new_expiry, user["id"])
+            )
+    except _Rollback as e:
+        return {"status": e.status}
+    except BaseException:
+        _expiry_cache.invalidate(telegram_id)
+        raise
+
+    _expiry_cache.set(telegram_id, new_expiry)
+    return {"status": PROMO_OK, "code": code, "days": promo["days"], "expiry": new_expiry}
+
+
+async def use_promo_code(code: str, telegram_id: int) -> bool:
+    """Apply promo code to user"""
+    try:
+        return (await redeem_promo_code(code, telegram_id))["status"] == PROMO_OK
+    except Exception:
+        logging.exception(f"use_promo_code failed for {code!r}, user {telegram_id}")
         return False
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT 1 FROM promo_code_usages 
-        WHERE user_id = ? AND promo_code_id = (
+
+
+async def _has_used_promo_code(conn, telegram_id: int, code: str) -> bool:
+    result = await conn.fetchone("""
+        SELECT 1 FROM promo_code_usages
+        WHERE user_id = (SELECT id FROM users WHERE telegram_id = ?) AND promo_code_id = (
             SELECT id FROM promo_codes WHERE code = ?
         )
-    """, (user[0], code.upper()))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
+    """, (telegram_id, code.upper()))
+
     return result is not None
 
 
-def list_all_promo_codes():
+async def has_used_promo_code(telegram_id: int, code: str) -> bool:
+    """Check if user already used this promo code"""
+    async with _db().acquire() as conn:
+        return await _has_used_promo_code(conn, telegram_id, code)
+
+
+async def list_all_promo_codes():
     """List all promo codes (for admin)"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT code, days, max_uses, used_count, is_active, expires_at 
-        FROM promo_codes ORDER BY created_at DESC
-    """)
-    
-    promos = cursor.fetchall()
-    conn.close()
-    
-    return promos
+    async with _db().acquire() as conn:
+        return await conn.fetchall("""
+            SELECT code, days, max_uses, used_count, is_active, expires_at
+            FROM promo_codes ORDER BY created_at DESC
+        """)
+
+
+# list_promo_codes_page() filters
+PROMO_FILTERS = {
+    "all": "",
+    "active": " AND is_active AND used_count < max_uses AND (expires_at IS NULL OR expires_at > ?)",
+    "expired": " AND expires_at <= ?",
+    "exhausted": " AND used_count >= max_uses",
+}
+
+
+def _prefix_range(prefix: str) -> tuple:
+    # code >= prefix AND code < upper is an index range, unlike LIKE
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+async def list_promo_codes_page(status: str = "all", prefix: str = "", after_id: int = None,
+                                before_id: int = None, limit: int = 20) -> tuple:
+    """One page of promo codes, newest first, keyset-paginated on (created_at, id).
+
+    `after_id` continues past that code (next page), `before_id` goes back
+    (previous page). Each page is a single range query on the
+    (created_at, id) index, no matter how deep it is.
+    Returns (rows, has_more) where has_more says the listing continues in
+    the requested direction.
+    """
+    where, args = "1 = 1", []
+    if prefix:
+        where += " AND code >= ? AND code < ?"
+        args += _prefix_range(prefix.upper())
+    where += PROMO_FILTERS[status]
+    if status in ("active", "expired"):
+        args.append(datetime.now())
+
+    order = "DESC"
+    cursor = after_id or before_id
+    if cursor:
+        sign = "<" if after_id else ">"
+        where += f" AND (created_at, id) {sign} ((SELECT created_at FROM promo_codes WHERE id = ?), ?)"
+        args += (cursor, cursor)
+        if before_id:
+            order = "ASC"
+
+    async with _db().acquire() as conn:
+        rows = await conn.fetchall(
+            f"""SELECT id, code, days, max_uses, used_count, is_active, expires_at
+                FROM promo_codes WHERE {where}
+                ORDER BY created_at {order}, id {order} LIMIT ?""",
+            (*args, limit + 1)
+        )
+    has_more = len(rows) > limit
+    rows = [{**dict(r), "expires_at": _as_datetime(r["expires_at"])} for r in rows[:limit]]
+    if order == "ASC":
+        rows.reverse()
+    return rows, has_more
+
+
+async def get_media_file_id(content_hash: str) -> Optional[str]:
+    """Telegram file_id of an already uploaded file"""
+    async with _db().acquire() as conn:
+        return await conn.fetchval(
+            "SELECT file_id FROM media_files WHERE content_hash = ?", (content_hash,)
+        )
+
+
+async def save_media_file_id(content_hash: str, file_id: str):
+    async with _db().transaction() as conn:
+        await conn.execute(
+            """INSERT INTO media_files (content_hash, file_id, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT (content_hash) DO UPDATE
+               SET file_id = excluded.file_id, updated_at = excluded.updated_at""",
+            (content_hash, file_id, datetime.now())
+        )
+
+
+async def delete_media_file_id(content_hash: str):
+    async with _db().transaction() as conn:
+        await conn.execute("DELETE FROM media_files WHERE content_hash = ?", (content_hash,))
+
+
+async def create_broadcast(admin_chat_id: int, text: str = None,
+                           from_chat_id: int = None, message_id: int = None) -> int:
+    """Register a broadcast, either plain text or a message to copy"""
+    async with _db().transaction() as conn:
+        return await conn.fetchval(
+            """INSERT INTO broadcasts (admin_chat_id, text, from_chat_id, message_id)
+               VALUES (?, ?, ?, ?) RETURNING id""",
+            (admin_chat_id, text, from_chat_id, message_id)
+        )
+
+
+async def get_broadcast(broadcast_id: int):
+    async with _db().acquire() as conn:
+        return await conn.fetchone("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+
+async def get_running_broadcasts() -> list:
+    """Broadcasts interrupted by a restart"""
+    async with _db().acquire() as conn:
+        return await conn.fetchall(
+            "SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id"
+        )
+
+
+async def iter_active_users(after_user_id: int = 0, chunk_size: int = 500):
+    """Yield chunks of (id, telegram_id) of active users in id order.
+
+    Each chunk is one primary-key range query, so memory stays bounded and
+    no connection or read snapshot is held between chunks.
+    """
+    while True:
+        async with _db().acquire() as conn:
+            rows = await conn.fetchall(
+                """SELECT id, telegram_id FROM users
+                   WHERE id > ? AND is_active ORDER BY id LIMIT ?""",
+                (after_user_id, chunk_size)
+            )
+        if not rows:
+            return
+        yield rows
+        after_user_id = rows[-1]["id"]
+
+
+# table -> (columns, day column for `since`) readable by /export
+EXPORT_TABLES = {
+    "users": (
+        ("id", "telegram_id", "username", "full_name", "created_at", "subscription_expiry", "is_active"),
+        "created_at",
+    ),
+    "payments": (
+        ("id", "user_id", "amount", "currency", "days", "payment_date", "invoice_payload",
+         "telegram_payment_charge_id", "provider_payment_charge_id"),
+        "payment_date",
+    ),
+    "promo_code_usages": (("id", "promo_code_id", "user_id", "used_at"), "used_at"),
+}
+
+
+async def iter_table_rows(table: str, since: date = None, chunk_size: int = 1000):
+    """Yield chunks of an EXPORT_TABLES table in id order, optionally only
+    rows from the day `since` on.
+
+    Like iter_active_users, every chunk is its own primary-key range query.
+    """
+    columns, day_column = EXPORT_TABLES[table]
+    where, args = "id > ?", ()
+    if since is not None:
+        where += f" AND {_DAY_OF[_db().dialect].format(day_column)} >= ?"
+        args = (since.isoformat(),)
+    after_id = 0
+    while True:
+        async with _db().acquire() as conn:
+            rows = await conn.fetchall(
+                f"SELECT {', '.join(columns)} FROM {table} WHERE {where} ORDER BY id LIMIT ?",
+                (after_id, *args, chunk_size)
+            )
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1]["id"]
+
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int,
+                                  failed: int, blocked_telegram_ids: list) -> bool:
+    """Checkpoint a broadcast and deactivate users who blocked the bot.
+
+    Returns False if the broadcast is no longer running (cancelled,
+    possibly from another bot process).
+    """
+    async with _db().transaction() as conn:
+        if blocked_telegram_ids:
+            await conn.executemany(
+                "UPDATE users SET is_active = ? WHERE telegram_id = ?",
+                [(False, tid) for tid in blocked_telegram_ids]
+            )
+        updated = await conn.execute(
+            """UPDATE broadcasts
+               SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+               WHERE id = ? AND status = 'running'""",
+            (last_user_id, sent, failed, len(blocked_telegram_ids), broadcast_id)
+        )
+        return updated > 0
+
+
+async def finish_broadcast(broadcast_id: int, status: str = "done") -> bool:
+    """Move a running broadcast to `status`, False if it wasn't running"""
+    async with _db().transaction() as conn:
+        updated = await conn.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+            (status, datetime.now(), broadcast_id)
+        )
+        return updated > 0
+
+
+async def claim_expiry_reminders(window_days: int, start: datetime, end: datetime,
+                                 limit: int = 100,
+                                 claim_timeout: timedelta = timedelta(minutes=15)) -> list:
+    """Pick users whose subscription expires in (start, end] and who haven't
+    had the `window_days` reminder for that expiry yet, and claim them.
+    Returns (user_id, telegram_id, expiry datetime) tuples.
+
+    A claim that isn't confirmed with mark_reminders_sent within
+    `claim_timeout` (failed send, crash) is picked up again.
+    """
+    now = datetime.now()
+    async with _db().transaction() as conn:
+        rows = await conn.fetchall("""
+            SELECT u.id, u.telegram_id, u.subscription_expiry FROM users u
+            WHERE u.subscription_expiry > ? AND u.subscription_expiry <= ? AND u.is_active
+              AND NOT EXISTS (
+                  SELECT 1 FROM subscription_reminders r
+                  WHERE r.user_id = u.id AND r.expiry = u.subscription_expiry
+                    AND r.window_days = ?
+                    AND (r.sent_at IS NOT NULL OR r.claimed_at > ?)
+              )
+            ORDER BY u.subscription_expiry LIMIT ?
+        """, (start, end, window_days, now - claim_timeout, limit))
+
+        if rows:
+            await conn.executemany(
+                """INSERT INTO subscription_reminders (user_id, expiry, window_days, sent_at, claimed_at)
+                   VALUES (?, ?, ?, NULL, ?)
+                   ON CONFLICT (user_id, expiry, window_days) DO UPDATE
+                   SET claimed_at = excluded.claimed_at
+                   WHERE subscription_reminders.sent_at IS NULL""",
+                [(r["id"], r["subscription_expiry"], window_days, now) for r in rows]
+            )
+        return [(r["id"], r["telegram_id"], _as_datetime(r["subscription_expiry"])) for r in rows]
+
+
+async def mark_reminders_sent(window_days: int, user_ids: list):
+    """Confirm claimed `window_days` reminders so they aren't sent again"""
+    if not user_ids:
+        return
+    async with _db().transaction() as conn:
+        await conn.executemany(
+            """UPDATE subscription_reminders SET sent_at = ?
+               WHERE user_id = ? AND window_days = ? AND sent_at IS NULL""",
+            [(datetime.now(), user_id, window_days) for user_id in user_ids]
+        )
+
+
+# --- FSM storage ---
+
+async def get_fsm_record(key: str):
+    """(state, data) row for an FSM key, None if missing or expired"""
+    async with _db().acquire() as conn:
+        return await conn.fetchone(
+            "SELECT state, data FROM fsm_states WHERE key = ? AND expires_at > ?",
+            (key, datetime.now())
+        )
+
+
+async def _save_fsm_field(key: str, column: str, value, expires_at: datetime):
+    now = datetime.now()
+    other = "data" if column == "state" else "state"
+    async with _db().transaction() as conn:
+        if value is not None:
+            # The untouched column survives only if the row hasn't expired yet
+            await conn.execute(
+                f"""INSERT INTO fsm_states (key, {column}, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE
+                    SET {column} = excluded.{column}, expires_at = excluded.expires_at,
+                        {other} = CASE WHEN fsm_states.expires_at > ? THEN fsm_states.{other} END""",
+                (key, value, expires_at, now)
+            )
+        # Clearing a field never creates a row; a missing key costs one UPDATE
+        elif await conn.execute(
+            f"""UPDATE fsm_states SET {column} = NULL, expires_at = ?,
+                    {other} = CASE WHEN expires_at > ? THEN {other} END
+                WHERE key = ?""",
+            (expires_at, now, key)
+        ):
+            await conn.execute(
+                "DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL", (key,)
+            )
+
+
+async def set_fsm_state(key: str, state: Optional[str], expires_at: datetime):
+    await _save_fsm_field(key, "state", state, expires_at)
+
+
+async def set_fsm_data(key: str, data: Optional[str], expires_at: datetime):
+    await _save_fsm_field(key, "data", data, expires_at)
+
+
+async def delete_fsm_record(key: str):
+    async with _db().transaction() as conn:
+        await conn.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+
+
+async def delete_expired_fsm_records(limit: int = 1000) -> int:
+    """Drop up to `limit` expired FSM rows, return how many were removed"""
+    async with _db().transaction() as conn:
+        return await conn.execute(
+            """DELETE FROM fsm_states WHERE key IN (
+                   SELECT key FROM fsm_states WHERE expires_at <= ? LIMIT ?
+               )""",
+            (datetime.now(), limit)
+        )
+
+
+# --- Stats rollups ---
+
+STAT_NEW_USERS = "new_users"
+STAT_PAYMENTS = "payments"
+STAT_REVENUE = "revenue"                      # per currency, in rubles / stars
+STAT_PROMO_REDEMPTIONS = "promo_redemptions"
+STAT_ACTIVE_SUBS = "active_subscriptions"     # snapshot, not a sum
+STAT_BACKFILLED = "backfilled"                # marker row in stats_totals
+
+# Calendar day (local time) of a column filled by DEFAULT CURRENT_TIMESTAMP
+_DAY_OF = {
+    "sqlite": "date({}, 'localtime')",       # SQLite's CURRENT_TIMESTAMP is UTC
+    "postgresql": "to_char({}, 'YYYY-MM-DD')",
+}
+
+
+async def _add_stat(conn, metric: str, value: int, currency: str = "", day: str = None,
+                    replace: bool = False):
+    day = day or datetime.now().date().isoformat()
+    new_value = "excluded.value" if replace else "{table}.value + excluded.value"
+    for table, key, args in (
+        ("daily_stats", "day, metric, currency", (day, metric, currency, value)),
+        ("stats_totals", "metric, currency", (metric, currency, value)),
+    ):
+        await conn.execute(
+            f"""INSERT INTO {table} ({key}, value) VALUES ({', '.join('?' * len(args))})
+                ON CONFLICT ({key}) DO UPDATE SET value = {new_value.format(table=table)}""",
+            args
+        )
+
+
+async def rebuild_stats():
+    """Recompute rollups and totals from users, payments and promo usages.
+
+    Live writes keep them current, this is for the first run on an existing
+    database or after the history was edited by hand. Snapshots of active
+    subscriptions can't be rebuilt and are kept.
+    """
+    day = _DAY_OF[_db().dialect].format
+    async with _db().transaction() as conn:
+        await conn.execute("DELETE FROM daily_stats WHERE metric <> ?", (STAT_ACTIVE_SUBS,))
+        await conn.execute("DELETE FROM stats_totals WHERE metric <> ?", (STAT_ACTIVE_SUBS,))
+        for sql in (
+            f"""SELECT {day('created_at')}, '{STAT_NEW_USERS}', '', COUNT(*)
+                FROM users WHERE created_at IS NOT NULL GROUP BY 1""",
+            f"""SELECT {day('payment_date')}, '{STAT_PAYMENTS}', COALESCE(currency, ''), COUNT(*)
+                FROM payments WHERE payment_date IS NOT NULL GROUP BY 1, 3""",
+            f"""SELECT {day('payment_date')}, '{STAT_REVENUE}', COALESCE(currency, ''), SUM(amount)
+                FROM payments WHERE payment_date IS NOT NULL GROUP BY 1, 3""",
+            f"""SELECT {day('used_at')}, '{STAT_PROMO_REDEMPTIONS}', '', COUNT(*)
+                FROM promo_code_usages WHERE used_at IS NOT NULL GROUP BY 1""",
+        ):
+            await conn.execute(f"INSERT INTO daily_stats (day, metric, currency, value) {sql}")
+        await conn.execute(
+            """INSERT INTO stats_totals (metric, currency, value)
+               SELECT metric, currency, SUM(value) FROM daily_stats
+               WHERE metric <> ? GROUP BY metric, currency""",
+            (STAT_ACTIVE_SUBS,)
+        )
+        await conn.execute(
+            "INSERT INTO stats_totals (metric, currency, value) VALUES (?, '', 1)", (STAT_BACKFILLED,)
+        )
+
+
+async def stats_backfilled() -> bool:
+    async with _db().acquire() as conn:
+        return bool(await conn.fetchval(
+            "SELECT 1 FROM stats_totals WHERE metric = ?", (STAT_BACKFILLED,)
+        ))
+
+
+async def refresh_active_subscriptions() -> int:
+    """Store today's count of active subscriptions, return it.
+
+    Subscriptions lapse without any write to hook into, so this one is a
+    periodic snapshot instead of a running counter.
+    """
+    async with _db().transaction() as conn:
+        count = await conn.fetchval(
+            "SELECT COUNT(*) FROM users WHERE subscription_expiry > ?", (datetime.now(),)
+        )
+        await _add_stat(conn, STAT_ACTIVE_SUBS, count, replace=True)
+    return count
+
+
+async def get_stats_summary(periods=(7, 30)) -> dict:
+    """Totals plus, per period, sums over the last N days and the N days before.
+
+    Reads the totals and at most 2 * max(periods) days of rollups, however
+    many users and payments there are.
+    Returns {"totals": {(metric, currency): value},
+             "periods": {days: ({(metric, currency): value} now, ... before)},
+             "active": {days ago: active subscriptions snapshot}}
+    """
+    today = datetime.now().date()
+    since = today - timedelta(days=2 * max(periods) - 1)
+    async with _db().acquire() as conn:
+        totals = await conn.fetchall("SELECT metric, currency, value FROM stats_totals")
+        rows = await conn.fetchall(
+            "SELECT day, metric, currency, value FROM daily_stats WHERE day >= ?",
+            (since.isoformat(),)
+        )
+
+    result = {
+        "totals": {(r["metric"], r["currency"]): r["value"] for r in totals},
+        "periods": {},
+        "active": {},
+    }
+    aged = [((today - datetime.strptime(r["day"], "%Y-%m-%d").date()).days, r) for r in rows]
+    for age, r in aged:
+        if r["metric"] == STAT_ACTIVE_SUBS:
+            result["active"][age] = r["value"]
+    for days in periods:
+        current, previous = {}, {}
+        for age, r in aged:
+            if r["metric"] != STAT_ACTIVE_SUBS and age < 2 * days:
+                bucket = current if age < days else previous
+                key = (r["metric"], r["currency"])
+                bucket[key] = bucket.get(key, 0) + r["value"]
+        result["periods"][days] = (current, previous)
+    return result
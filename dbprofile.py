@@ -0,0 +1,197 @@
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from config import DB_SLOW_QUERY_MS
+
+# Durations kept per statement for the p99 estimate
+SAMPLE_SIZE = 1024
+
+
+@lru_cache(maxsize=512)
+def _normalize(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+class QueryStats:
+    __slots__ = ("calls", "total", "max", "rows", "samples")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    @property
+    def p99(self) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+class UpdateTally:
+    """Queries issued while handling one Telegram update"""
+
+    __slots__ = ("update_id", "update_type", "queries", "seconds", "open")
+
+    def __init__(self, update_id: int, update_type: str):
+        self.update_id = update_id
+        self.update_type = update_type
+        self.queries = 0
+        self.seconds = 0.0
+        self.open = True
+
+
+class UpdateStats:
+    __slots__ = ("updates", "queries", "seconds", "max_queries")
+
+    def __init__(self):
+        self.updates = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries = 0
+
+
+current_update: ContextVar[Optional[UpdateTally]] = ContextVar("current_update", default=None)
+
+
+class QueryProfiler:
+    """Per-statement timings plus per-update query counts"""
+
+    def __init__(self, slow_ms: float = DB_SLOW_QUERY_MS):
+        self.slow = slow_ms / 1000
+        self.queries = {}
+        self.updates = {}
+
+    def record(self, sql: str, elapsed: float, rows: int):
+        key = _normalize(sql)
+        stats = self.queries.get(key)
+        if stats is None:
+            stats = self.queries[key] = QueryStats()
+        stats.calls += 1
+        stats.total += elapsed
+        stats.rows += rows
+        stats.samples.append(elapsed)
+        if elapsed > stats.max:
+            stats.max = elapsed
+
+        tally = current_update.get()
+        # Tasks spawned by a handler (broadcasts) outlive its update
+        attributed = tally is not None and tally.open
+        if attributed:
+            tally.queries += 1
+            tally.seconds += elapsed
+
+        if elapsed >= self.slow:
+            origin = f"update {tally.update_id} ({tally.update_type})" if attributed else "no update"
+            logging.warning(f"Slow query {elapsed * 1000:.1f} ms, {rows} rows, {origin}: {key}")
+
+    def finish_update(self, tally: UpdateTally):
+        tally.open = False
+        stats = self.updates.get(tally.update_type)
+        if stats is None:
+            stats = self.updates[tally.update_type] = UpdateStats()
+        stats.updates += 1
+        stats.queries += tally.queries
+        stats.seconds += tally.seconds
+        stats.max_queries = max(stats.max_queries, tally.queries)
+
+    def top(self, limit: int = 10, key: str = "total") -> list:
+        """(sql, QueryStats) pairs, worst first by total, p99, calls or rows"""
+        return sorted(self.queries.items(), key=lambda item: getattr(item[1], key), reverse=True)[:limit]
+
+    def reset(self):
+        self.queries.clear()
+        self.updates.clear()
+
+
+class ProfiledConnection:
+    """Times every call on a pooled connection"""
+
+    def __init__(self, conn, profiler: QueryProfiler):
+        self._conn = conn
+        self._profiler = profiler
+
+    async def execute(self, sql: str, args=()) -> int:
+        start = time.perf_counter()
+        rowcount = await self._conn.execute(sql, args)
+        self._profiler.record(sql, time.perf_counter() - start, max(rowcount, 0))
+        return rowcount
+
+    async def fetchone(self, sql: str, args=()):
+        start = time.perf_counter()
+        row = await self._conn.fetchone(sql, args)
+        self._profiler.record(sql, time.perf_counter() - start, row is not None)
+        return row
+
+    async def fetchall(self, sql: str, args=()) -> list:
+        start = time.perf_counter()
+        rows = await self._conn.fetchall(sql, args)
+        self._profiler.record(sql, time.perf_counter() - start, len(rows))
+        return rows
+
+    async def fetchval(self, sql: str, args=()):
+        start = time.perf_counter()
+        value = await self._conn.fetchval(sql, args)
+        self._profiler.record(sql, time.perf_counter() - start, value is not None)
+        return value
+
+    async def executemany(self, sql: str, seq) -> int:
+        start = time.perf_counter()
+        rowcount = await self._conn.executemany(sql, seq)
+        self._profiler.record(sql, time.perf_counter() - start, max(rowcount, 0))
+        return rowcount
+
+
+class ProfiledPool:
+    """Pool wrapper handing out ProfiledConnection; everything else is delegated"""
+
+    def __init__(self, pool, profiler: QueryProfiler):
+        self._pool = pool
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self._pool.acquire() as conn:
+            yield ProfiledConnection(conn, self.profiler)
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._pool.transaction() as conn:
+            yield ProfiledConnection(conn, self.profiler)
+
+
+class UpdateAttributionMiddleware(BaseMiddleware):
+    """Outer middleware on dp.update that tags queries with the current update"""
+
+    def __init__(self, profiler: QueryProfiler):
+        self.profiler = profiler
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        tally = UpdateTally(event.update_id, event.event_type)
+        token = current_update.set(tally)
+        try:
+            return await handler(event, data)
+        finally:
+            current_update.reset(token)
+            self.profiler.finish_update(tally)
+
+
+profiler = QueryProfiler()
@@ -0,0 +1,86 @@
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+from datetime import date
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+
+from config import EXPORT_CHUNK
+from database import EXPORT_TABLES, iter_table_rows
+
+FORMATS = ("csv", "jsonl")
+# Bot API limit for documents sent by a bot
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+def _write_chunk(out, fmt: str, columns, rows):
+    if fmt == "csv":
+        csv.writer(out).writerows(tuple(row) for row in rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n")
+
+
+async def write_export(path: str, table: str, fmt: str = "csv", since: date = None,
+                       chunk_size: int = EXPORT_CHUNK) -> int:
+    """Stream `table` into a gzip-compressed CSV/JSONL file, return the row count.
+
+    Only one chunk of rows is in memory at a time; encoding and compression
+    run on a worker thread so the event loop keeps serving updates.
+    """
+    columns = EXPORT_TABLES[table][0]
+    count = 0
+    out = gzip.open(path, "wt", encoding="utf-8", newline="")
+    try:
+        if fmt == "csv":
+            csv.writer(out).writerow(columns)
+        async for rows in iter_table_rows(table, since, chunk_size):
+            await asyncio.to_thread(_write_chunk, out, fmt, columns, rows)
+            count += len(rows)
+    finally:
+        await asyncio.to_thread(out.close)
+    return count
+
+
+class Exporter:
+    """Runs /export in the background and sends the result as a document"""
+
+    def __init__(self, bot: Bot, chunk_size: int = EXPORT_CHUNK):
+        self.bot = bot
+        self.chunk_size = chunk_size
+        self._tasks = set()
+
+    def start(self, chat_id: int, table: str, fmt: str = "csv", since: date = None):
+        task = asyncio.create_task(self._run(chat_id, table, fmt, since))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, chat_id: int, table: str, fmt: str, since: date):
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+        os.close(fd)
+        try:
+            count = await write_export(path, table, fmt, since, self.chunk_size)
+            size = os.path.getsize(path)
+            if size > MAX_DOCUMENT_SIZE:
+                await self.bot.send_message(
+                    chat_id, f"❌ Выгрузка {table} слишком большая ({size // 1024 // 1024} МБ), "
+                             f"сузьте период параметром since."
+                )
+                return
+            suffix = f"-since-{since.isoformat()}" if since else ""
+            filename = f"{table}{suffix}-{date.today().isoformat()}.{fmt}.gz"
+            await self.bot.send_document(
+                chat_id, FSInputFile(path, filename=filename),
+                caption=f"📦 {table}: {count} строк"
+            )
+        except Exception:
+            logging.exception(f"Export of {table} failed")
+            await self.bot.send_message(chat_id, f"❌ Не удалось выгрузить {table}.")
+        finally:
+            os.remove(path)
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Mapping, Optional
+
+from aiogram import Dispatcher
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.types import TelegramObject
+
+from config import FSM_TTL, FSM_REAP_INTERVAL
+from database import (
+    delete_expired_fsm_records, delete_fsm_record, get_fsm_record, set_fsm_data, set_fsm_state
+)
+
+REAP_BATCH = 1000
+EMPTY = (None, None)
+
+# (state, data) of the keys read while handling the current update
+_records: ContextVar[Optional[dict]] = ContextVar("fsm_records", default=None)
+
+
+@contextmanager
+def record_cache():
+    """Serve repeated reads of a key from memory until the block exits"""
+    token = _records.set({})
+    try:
+        yield
+    finally:
+        _records.reset(token)
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM storage in the bot's own database.
+
+    Every write pushes the key's expiry `ttl` seconds ahead; an expired
+    state reads as empty and is deleted later by `run_reaper`. State and
+    data share one row, data is stored as compact JSON, and a key with no
+    state and no data has no row at all. Workers sharing a PostgreSQL
+    database see the same conversations. Inside `record_cache()` (one per
+    update with DatabaseFSMMiddleware) a key is read from the database
+    once and then kept up to date in memory.
+    """
+
+    def __init__(self, ttl: float = FSM_TTL, reap_interval: float = FSM_REAP_INTERVAL):
+        self.ttl = timedelta(seconds=ttl)
+        self.reap_interval = reap_interval
+        self.key_builder = DefaultKeyBuilder(
+            with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+
+    def _expires_at(self) -> datetime:
+        return datetime.now() + self.ttl
+
+    async def _record(self, key: str) -> tuple:
+        cache = _records.get()
+        if cache is not None and key in cache:
+            return cache[key]
+        row = await get_fsm_record(key)
+        record = (row["state"], row["data"]) if row else EMPTY
+        if cache is not None:
+            cache[key] = record
+        return record
+
+    def _cached(self, key: str) -> Optional[tuple]:
+        cache = _records.get()
+        return cache.get(key) if cache is not None else None
+
+    def _remember(self, key: str, state, data):
+        cache = _records.get()
+        if cache is not None:
+            cache[key] = (state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        key = self.key_builder.build(key)
+        record = self._cached(key)
+        if value is None and record == EMPTY:
+            return
+        await set_fsm_state(key, value, self._expires_at())
+        if record is not None:
+            self._remember(key, value, record[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(self.key_builder.build(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        value = json.dumps(data, separators=(",", ":"), ensure_ascii=False) if data else None
+        key = self.key_builder.build(key)
+        record = self._cached(key)
+        if value is None and record == EMPTY:
+            return
+        await set_fsm_data(key, value, self._expires_at())
+        if record is not None:
+            self._remember(key, record[0], value)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        data = (await self._record(self.key_builder.build(key)))[1]
+        return json.loads(data) if data else {}
+
+    async def clear(self, key: StorageKey) -> None:
+        """Drop state and data in one statement"""
+        key = self.key_builder.build(key)
+        if self._cached(key) == EMPTY:
+            return
+        await delete_fsm_record(key)
+        self._remember(key, None, None)
+
+    async def close(self) -> None:
+        # The pool belongs to database.py and is closed by close_db()
+        pass
+
+    async def reap(self) -> int:
+        """Delete all expired keys, return how many were removed"""
+        removed = 0
+        while True:
+            count = await delete_expired_fsm_records(REAP_BATCH)
+            removed += count
+            if count < REAP_BATCH:
+                return removed
+
+    async def run_reaper(self):
+        while True:
+            try:
+                removed = await self.reap()
+                if removed:
+                    logging.info(f"Removed {removed} abandoned FSM states")
+            except Exception:
+                logging.exception("FSM state cleanup failed")
+            await asyncio.sleep(self.reap_interval)
+
+
+class DatabaseFSMContext(FSMContext):
+    async def clear(self) -> None:
+        await self.storage.clear(self.key)
+
+
+class DatabaseFSMMiddleware(FSMContextMiddleware):
+    """FSMContextMiddleware for DatabaseStorage.
+
+    The state is read once per update (aiogram loads it before the handler
+    runs) and later reads of the same key in that update come from memory;
+    `FSMContext.clear()` is a single DELETE.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        with record_cache():
+            return await super().__call__(handler, event, data)
+
+    def get_context(self, *args, **kwargs) -> FSMContext:
+        context = super().get_context(*args, **kwargs)
+        return DatabaseFSMContext(storage=context.storage, key=context.key)
+
+
+def setup_fsm(dp: Dispatcher) -> DatabaseFSMMiddleware:
+    """Swap the dispatcher's FSM middleware for DatabaseFSMMiddleware; call
+    right after creating `dp`, before other outer update middlewares"""
+    middleware = DatabaseFSMMiddleware(dp.fsm.storage, dp.fsm.events_isolation, dp.fsm.strategy)
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(middleware)
+    dp.fsm = middleware
+    return middleware
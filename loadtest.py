@@ -0,0 +1,321 @@
+"""End-to-end load test against a local fake Bot API.
+
+Starts an aiohttp stand-in for api.telegram.org, points the bot from
+main.py at it and polls it with getUpdates like in production. N virtual
+users then walk through /start, profile, the subscribe flow with a Stars
+payment and promo code entry, each waiting for its previous update to be
+handled (closed loop). Prints throughput and p50/p95/p99 latency per handler.
+
+    python loadtest.py --users 200 --rounds 3
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+from ratelimit import PriorityTokenBucket
+
+BOT_ID = 1
+TOKEN = f"{BOT_ID}:LOADTEST"
+PROMO_CODE = "LOADTEST"
+
+
+class FakeBotAPI:
+    """Answers every Bot API method the bot uses with a plausible result"""
+
+    def __init__(self):
+        self.updates = []
+        self.enqueued_at = {}
+        self.calls = {}
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def wake(self):
+        """Return a pending long poll right away"""
+        self._new_updates.set()
+
+    def push(self, **payload) -> int:
+        update_id = next(self._update_ids)
+        self.updates.append({"update_id": update_id, **payload})
+        self.enqueued_at[update_id] = time.perf_counter()
+        self._new_updates.set()
+        return update_id
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot"},
+            **fields,
+        }
+
+    async def _get_updates(self, data) -> list:
+        offset = int(data.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(data.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(data.get("chat_id") or 0)
+
+        if method == "getUpdates":
+            result = await self._get_updates(data)
+        elif method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bot", "username": "loadtest_bot"}
+        elif method == "sendPhoto":
+            file_id = f"photo-{self.calls[method]}" if not isinstance(data.get("photo"), str) else data["photo"]
+            result = self._message(chat_id, caption=data.get("caption", ""), photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600},
+            ])
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=data.get("text", ""))
+        elif method in ("editMessageCaption", "editMessageMedia"):
+            result = self._message(chat_id, caption=data.get("caption", ""), photo=[
+                {"file_id": "photo-edited", "file_unique_id": "photo-edited", "width": 800, "height": 600},
+            ])
+        elif method == "sendInvoice":
+            result = self._message(chat_id, invoice={
+                "title": data.get("title", ""),
+                "description": data.get("description", ""),
+                "start_parameter": data.get("start_parameter", ""),
+                "currency": data.get("currency", ""),
+                "total_amount": 0,
+            })
+        else:
+            # deleteMessage, answerCallbackQuery, answerPreCheckoutQuery, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class LatencyRecorder(BaseMiddleware):
+    """Resolves each update's waiter and records its end-to-end latency per handler"""
+
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+        self.handlers = {}
+        self.latencies = {}
+        self.errors = 0
+        self.waiters = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: dict[str, Any],
+    ) -> Any:
+        if "handler" in data:
+            # Inner middleware: remember which handler took the update
+            self.handlers[data["event_update"].update_id] = data["handler"].callback.__name__
+            return await handler(event, data)
+
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - self.api.enqueued_at.pop(event.update_id)
+            name = self.handlers.pop(event.update_id, "unhandled")
+            self.latencies.setdefault(name, []).append(elapsed)
+            waiter = self.waiters.pop(event.update_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+
+class VirtualUser:
+    def __init__(self, user_id: int, api: FakeBotAPI, recorder: LatencyRecorder, catalog, think: float):
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.api = api
+        self.recorder = recorder
+        self.catalog = catalog
+        self.think = think
+        self._ids = itertools.count(1)
+
+    async def _send(self, **payload):
+        update_id = self.api.push(**payload)
+        waiter = asyncio.get_running_loop().create_future()
+        self.recorder.waiters[update_id] = waiter
+        await waiter
+        if self.think:
+            await asyncio.sleep(self.think)
+
+    def _message(self, **fields) -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": self.chat,
+            "from": self.user,
+            **fields,
+        }
+
+    async def text(self, text: str, **fields):
+        await self._send(message=self._message(text=text, **fields))
+
+    async def press(self, data: str):
+        await self._send(callback_query={
+            "id": f"{self.user['id']}-{next(self._ids)}",
+            "from": self.user,
+            "chat_instance": str(self.user["id"]),
+            "message": self._message(text="menu"),
+            "data": data,
+        })
+
+    async def pay(self, days: int):
+        # Not at the top: plans reads BOT_TOKEN, which run() may still have to set
+        from plans import XTR
+
+        plan = self.catalog.get(days)
+        payload = self.catalog.invoice_payload(plan, XTR, self.user["id"])
+        await self._send(pre_checkout_query={
+            "id": f"{self.user['id']}-{next(self._ids)}",
+            "from": self.user,
+            "currency": XTR,
+            "total_amount": plan.stars,
+            "invoice_payload": payload,
+        })
+        await self._send(message=self._message(successful_payment={
+            "currency": XTR,
+            "total_amount": plan.stars,
+            "invoice_payload": payload,
+            "telegram_payment_charge_id": f"charge-{self.user['id']}-{next(self._ids)}",
+            "provider_payment_charge_id": "",
+        }))
+
+    async def session(self, days: int):
+        await self.text("/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        await self.press("profile")
+        await self.press("subscribe")
+        await self.press(f"select_plan_{days}")
+        await self.press(f"buy_star_{days}")
+        await self.pay(days)
+        await self.press("enter_promo")
+        await self.text(PROMO_CODE)
+        await self.press("back_main")
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def format_report(recorder: LatencyRecorder, elapsed: float) -> str:
+    total = sum(len(v) for v in recorder.latencies.values())
+    lines = [
+        f"{total} updates in {elapsed:.2f} s: {total / elapsed:.1f} updates/s, {recorder.errors} errors",
+        "",
+        f"{'handler':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}",
+    ]
+    for name, values in sorted(recorder.latencies.items()):
+        lines.append(
+            f"{name:<32}{len(values):>8}"
+            f"{percentile(values, 0.5) * 1000:>10.1f}"
+            f"{percentile(values, 0.95) * 1000:>10.1f}"
+            f"{percentile(values, 0.99) * 1000:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+async def run(users: int, rounds: int, think: float = 0.0, database_url: str = None,
+              throttle: bool = False):
+    """Returns the recorder and the wall time of the run"""
+    api = FakeBotAPI()
+    await api.start()
+
+    os.environ.setdefault("BOT_TOKEN", TOKEN)
+    import main
+    from database import init_db, close_db, create_promo_code
+
+    main.bot.session.api = TelegramAPIServer.from_base(api.url)
+    if not throttle:
+        # Virtual users click far faster than people; measure the bot, not the flood limits
+        scheduler = main.outbound_scheduler
+        scheduler.bucket = PriorityTokenBucket(float("inf"))
+        scheduler.chat_rate = scheduler.chat_burst = float("inf")
+        main.throttling.rate = main.throttling.burst = float("inf")
+    recorder = LatencyRecorder(api)
+    main.dp.update.outer_middleware(recorder)
+    for name in ("message", "callback_query", "pre_checkout_query"):
+        main.dp.observers[name].middleware(recorder)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        await init_db(database_url or f"sqlite:///{os.path.join(tmp, 'loadtest.db')}")
+        await create_promo_code(PROMO_CODE, 7, max_uses=users)
+        polling = asyncio.create_task(
+            main.dp.start_polling(main.bot, handle_signals=False, close_bot_session=False)
+        )
+        days = next(iter(main.catalog.plans))
+        try:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await asyncio.gather(*(
+                    VirtualUser(1000 + n, api, recorder, main.catalog, think).session(days)
+                    for n in range(users)
+                ))
+            elapsed = time.perf_counter() - start
+        finally:
+            await main.dp.stop_polling()
+            api.wake()
+            await polling
+            await main.bot.session.close()
+            await main.user_writer.close()
+            await close_db()
+            await api.stop()
+
+    return recorder, elapsed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50, help="concurrent virtual users")
+    parser.add_argument("--rounds", type=int, default=1, help="sessions per user")
+    parser.add_argument("--think", type=float, default=0.0, help="pause between a user's updates, s")
+    parser.add_argument("--database-url", default=None, help="default: temporary SQLite file")
+    parser.add_argument("--throttle", action="store_true", help="keep outbound and anti-flood rate limits on")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # Per-update INFO lines would dominate the measurement
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    recorder, elapsed = asyncio.run(
+        run(args.users, args.rounds, args.think, args.database_url, args.throttle)
+    )
+    print(format_report(recorder, elapsed))
+    sys.exit(1 if recorder.errors else 0)
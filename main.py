@@ -2,35 +2,76 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
-    LabeledPrice, PreCheckoutQuery, Message,
-    ReplyKeyboardMarkup, KeyboardButton, FSInputFile,
+    PreCheckoutQuery, Message,
+    ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile,
     MenuButtonWebApp, WebAppInfo
 )
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 import asyncio
+import html
 import logging
-from datetime import datetime, timedelta
-import os
+from datetime import datetime
 
 from config import (
-    BOT_TOKEN, MESSAGES, SUBSCRIPTION_PRICES, SUBSCRIPTION_STARS,
-    SUBSCRIPTION_DAYS, APP_URL, FEEDBACK_URL, PAYMENT_PROVIDER_TOKEN, ADMIN_IDS
+    BOT_TOKEN, MESSAGES, APP_URL, FEEDBACK_URL, PAYMENT_PROVIDER_TOKEN, ADMIN_IDS,
+    RUN_MODE, TELEGRAM_API_URL, METRICS_PORT, DB_PROFILE
 )
 from database import (
-    init_db, create_user, get_user, has_active_subscription,
-    get_subscription_info, add_subscription, add_payment,
-    get_user_id_by_telegram_id,
-    create_promo_code, validate_promo_code, use_promo_code,
-    has_used_promo_code, list_all_promo_codes, init_promo_codes_table,
-    get_users_count, get_active_subs_count
+    init_db, has_active_subscription,
+    create_user, get_subscription_info, record_payment, PAYMENT_OK, PAYMENT_DUPLICATE, PAYMENT_NO_USER,
+    create_promo_code, create_promo_codes, redeem_promo_code, PROMO_OK, PROMO_ALREADY_USED,
+    list_promo_codes_page, PROMO_FILTERS, close_db,
+    subscription_cache_stats, get_broadcast, get_stats_summary, rebuild_stats,
+    EXPORT_TABLES
 )
+from broadcast import Broadcaster
+from reminders import ReminderScheduler
+from stats import StatsJob, format_stats
+from export import Exporter, FORMATS
+from promocodes import MAX_BATCH, codes_csv, parse_expiry, random_code
+from fsm_storage import DatabaseStorage, setup_fsm
+from media import media
+from navigation import show_screen, edit_screen
+from writebehind import UserWriteBehind
+from metrics import setup_metrics, start_metrics_server
+from outbound import OutboundScheduler
+from throttle import setup_throttling
+from dbprofile import UpdateAttributionMiddleware, profiler
+from plans import PlanCatalog, RUB, XTR
+from storage import IntegrityError
+from webhook import run_webhook
+
+MENU_IMAGE = "menu_image.jpg"
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+def create_session():
+    if TELEGRAM_API_URL:
+        return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    return AiohttpSession()
+
+bot = Bot(token=BOT_TOKEN, session=create_session())
+# Registered first so metrics time the API call itself, not the queueing
+outbound_scheduler = OutboundScheduler()
+bot.session.middleware(outbound_scheduler)
+fsm_storage = DatabaseStorage()
+dp = Dispatcher(storage=fsm_storage)
+setup_fsm(dp)
+catalog = PlanCatalog.from_config()
+broadcaster = Broadcaster(bot)
+reminder_scheduler = ReminderScheduler(bot)
+stats_job = StatsJob()
+exporter = Exporter(bot)
+user_writer = UserWriteBehind()
+# Before setup_metrics, so handler metrics only see updates that got through
+throttling = setup_throttling(dp)
+setup_metrics(dp, bot)
+if DB_PROFILE:
+    dp.update.outer_middleware(UpdateAttributionMiddleware(profiler))
 
 # States
 class PromoState(StatesGroup):
@@ -59,33 +100,6 @@ def get_main_keyboard():
         [InlineKeyboardButton(text="❓ Помощь", url=f"tg://user?id={ADMIN_IDS[0]}" if ADMIN_IDS else "https://t.me/telegram")],
     ])
 
-def get_subscription_plans_keyboard():
-    keyboard = []
-    prices = SUBSCRIPTION_PRICES
-    days = SUBSCRIPTION_DAYS
-    
-    for day in days:
-        label = f"📅 {day} дней"
-        keyboard.append([InlineKeyboardButton(text=label, callback_data=f"select_plan_{day}")])
-    
-    keyboard.append([InlineKeyboardButton(text="« Назад", callback_data="back_main")])
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
-
-def get_currency_keyboard(days):
-    # Find price index
-    try:
-        idx = SUBSCRIPTION_DAYS.index(days)
-        rub_price = SUBSCRIPTION_PRICES[idx]
-        star_price = SUBSCRIPTION_STARS[idx]
-    except ValueError:
-        return None
-
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"🇷🇺 Рубли ({rub_price}₽)", callback_data=f"buy_rub_{days}_{rub_price}")],
-        [InlineKeyboardButton(text=f"⭐️ Telegram Stars ({star_price} XTR)", callback_data=f"buy_star_{days}_{star_price}")],
-        [InlineKeyboardButton(text="« Назад", callback_data="subscribe")]
-    ])
-
 def get_back_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="« Назад", callback_data="back_main")]
@@ -97,156 +111,118 @@ def get_app_keyboard():
         [InlineKeyboardButton(text="« Назад", callback_data="back_main")]
     ])
 
-@dp.message(Command("start"))
+@dp.message(Command("start"), flags={"throttle": "heavy"})
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
     user = message.from_user
-    create_user(user.id, user.username or "", user.full_name or "")
-
-    # Send photo with main menu
-    # Using FSInputFile to read from local disk
-    photo = FSInputFile("menu_image.jpg")
-    await message.answer_photo(
-        photo=photo,
-        caption=MESSAGES["welcome"],
-        reply_markup=get_main_keyboard(),
-        parse_mode=ParseMode.HTML
+
+    # The user row is committed with other /starts in one batch, while the
+    # menu photo (uploaded once, then re-sent by cached file_id) goes out
+    await asyncio.gather(
+        user_writer.upsert(user.id, user.username or "", user.full_name or ""),
+        media.answer_photo(
+            message,
+            MENU_IMAGE,
+            caption=MESSAGES["welcome"],
+            reply_markup=get_main_keyboard(),
+            parse_mode=ParseMode.HTML
+        ),
     )
 
-@dp.callback_query(F.data == "back_main")
+@dp.callback_query(F.data == "back_main", flags={"throttle": "normal"})
 async def back_main(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    
-    # Text messages can't be converted to photos easily via edit
-    # So we delete and resend
-    try:
-        await callback.message.delete()
-    except:
-        pass
 
-    photo = FSInputFile("menu_image.jpg")
-    await callback.message.answer_photo(
-        photo=photo,
-        caption=MESSAGES["welcome"],
+    # Edits the photo in place; only a text screen has to be replaced
+    await show_screen(
+        callback.message,
+        MESSAGES["welcome"],
         reply_markup=get_main_keyboard(),
+        photo=MENU_IMAGE,
         parse_mode=ParseMode.HTML
     )
     await callback.answer()
 
 @dp.callback_query(F.data == "profile")
 async def show_profile(callback: types.CallbackQuery):
-    info = get_subscription_info(callback.from_user.id)
+    info = await get_subscription_info(callback.from_user.id)
     
     if info:
         text = MESSAGES["subscription_active"].format(**info)
     else:
         text = MESSAGES["no_subscription"]
     
-    # We can edit the caption of the photo if we are coming from main menu
-    # Or send a new text message if we want to "hide" the photo.
-    # User wanted "old message disappears".
-    # Best practice: Delete photo message, send new text message.
-    await callback.message.delete()
-    await callback.message.answer(text, reply_markup=get_back_keyboard())
+    await show_screen(callback.message, text, reply_markup=get_back_keyboard())
     await callback.answer()
 
 @dp.callback_query(F.data == "subscribe")
 async def show_subscription_plans(callback: types.CallbackQuery):
-    plans_text = "💎 <b>Выберите длительность подписки:</b>\n\n"
-    
-    for rub, stars, day in zip(SUBSCRIPTION_PRICES, SUBSCRIPTION_STARS, SUBSCRIPTION_DAYS):
-        if day == 7:
-            label = f"🧪 <b>7 дней</b>"
-        elif day == 30:
-            label = f"📅 <b>1 месяц</b>"
-        elif day == 90:
-            label = f"⭐ <b>3 месяца</b> (Выгодно)"
-        elif day == 180:
-            label = f"💎 <b>6 месяцев</b> (Super)"
-        else:
-            label = f"• {day} дней"
-            
-        plans_text += f"{label}\n💳 <b>{rub} ₽</b>   <i>(⭐️ {stars} Stars)</i>\n\n"
-    
-    try:
-        await callback.message.delete()
-    except:
-        pass
-        
-    await callback.message.answer(plans_text, reply_markup=get_subscription_plans_keyboard(), parse_mode=ParseMode.HTML)
+    await show_screen(callback.message, catalog.plans_text, reply_markup=catalog.plans_keyboard, parse_mode=ParseMode.HTML)
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("select_plan_"))
 async def select_plan(callback: types.CallbackQuery):
-    days = int(callback.data.split("_")[2])
-    
-    text = f"💳 <b>Выберите способ оплаты для {days} дней:</b>"
-    
-    kb = get_currency_keyboard(days)
-    if not kb:
+    plan = catalog.get(int(callback.data.split("_")[2]))
+    if not plan:
         await callback.answer("Ошибка тарифа", show_alert=True)
         return
 
-    await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    await show_screen(callback.message, plan.currency_text, reply_markup=plan.currency_keyboard, parse_mode=ParseMode.HTML)
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("buy_rub_"))
-async def process_buy_rub(callback: types.CallbackQuery):
-    _, _, days, price = callback.data.split("_")
-    days = int(days)
-    price = int(price)
-    
-    prices = [LabeledPrice(label=f"Подписка {days} дней", amount=price * 100)]
-    
+async def send_plan_invoice(callback: types.CallbackQuery, currency: str, provider_token: str):
+    # Price always comes from the catalog, never from callback data
+    plan = catalog.get(int(callback.data.split("_")[2]))
+    if not plan:
+        await callback.answer("Ошибка тарифа", show_alert=True)
+        return
+
     await callback.message.delete()
     
     await bot.send_invoice(
         chat_id=callback.from_user.id,
-        title=f"Подписка на {days} дней",
-        description=f"Доступ к приложению на {days} дней",
-        payload=f"sub_{days}_{callback.from_user.id}_{int(asyncio.get_event_loop().time())}_rub",
-        provider_token=PAYMENT_PROVIDER_TOKEN,
-        currency="RUB",
-        prices=prices,
+        title=f"Подписка на {plan.days} дней",
+        description=f"Доступ к приложению на {plan.days} дней",
+        payload=catalog.invoice_payload(plan, currency, callback.from_user.id),
+        provider_token=provider_token,
+        currency=currency,
+        prices=plan.prices(currency),
         start_parameter="subscription"
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("buy_star_"))
+@dp.callback_query(F.data.startswith("buy_rub_"), flags={"throttle": "heavy"})
+async def process_buy_rub(callback: types.CallbackQuery):
+    await send_plan_invoice(callback, RUB, PAYMENT_PROVIDER_TOKEN)
+
+@dp.callback_query(F.data.startswith("buy_star_"), flags={"throttle": "heavy"})
 async def process_buy_star(callback: types.CallbackQuery):
-    _, _, days, price = callback.data.split("_")
-    days = int(days)
-    price = int(price)
-    
-    # For Stars: amount is in XTR (integer), currency is XTR
-    prices = [LabeledPrice(label=f"Подписка {days} дней", amount=price)]
-    
-    await callback.message.delete()
-    
-    await bot.send_invoice(
-        chat_id=callback.from_user.id,
-        title=f"Подписка на {days} дней",
-        description=f"Доступ к приложению на {days} дней",
-        payload=f"sub_{days}_{callback.from_user.id}_{int(asyncio.get_event_loop().time())}_star",
-        provider_token="", # Stars don't use provider token
-        currency="XTR",
-        prices=prices,
-        start_parameter="subscription"
-    )
-    await callback.answer()
+    # Stars don't use provider token
+    await send_plan_invoice(callback, XTR, "")
 
 @dp.pre_checkout_query()
 async def process_pre_checkout(query: PreCheckoutQuery):
-    await bot.answer_pre_checkout_query(query.id, ok=True)
+    invoice = catalog.verify(query.invoice_payload, query.currency, query.total_amount, query.from_user.id)
+    if invoice:
+        await bot.answer_pre_checkout_query(query.id, ok=True)
+    else:
+        await bot.answer_pre_checkout_query(
+            query.id,
+            ok=False,
+            error_message="Тариф изменился или счёт устарел. Пожалуйста, оформите подписку заново."
+        )
 
-@dp.message(F.successful_payment)
+@dp.message(F.successful_payment, flags={"throttle": "free"})
 async def process_successful_payment(message: Message):
     payment = message.successful_payment
     payload = payment.invoice_payload
     
-    parts = payload.split("_")
-    days = int(parts[1])
+    # Days come from the payload, so a plan removed since the invoice still pays out
+    days = catalog.paid_days(payload) or 0
+    if not days:
+        logging.error(f"Payment {payment.telegram_payment_charge_id} has unknown payload {payload!r}, "
+                      f"recorded unmatched")
     
     # Calculate amount based on currency
     if payment.currency == "XTR":
@@ -256,11 +232,33 @@ async def process_successful_payment(message: Message):
         amount = payment.total_amount // 100
         currency_label = "₽"
     
-    user_db_id = get_user_id_by_telegram_id(message.from_user.id)
-    if user_db_id:
-        add_payment(user_db_id, amount, days, payload)
-        new_expiry = add_subscription(message.from_user.id, days)
-        
+    user = message.from_user
+    result = await record_payment(
+        user.id, amount, payment.currency, days, payload,
+        payment.telegram_payment_charge_id, payment.provider_payment_charge_id
+    )
+    if result["status"] == PAYMENT_NO_USER:
+        # The /start upsert failed or the row is gone; the money came in, so create it and credit
+        logging.warning(f"Payment {payment.telegram_payment_charge_id} from unknown user {user.id}, creating it")
+        await create_user(user.id, user.username or "", user.full_name or "")
+        result = await record_payment(
+            user.id, amount, payment.currency, days, payload,
+            payment.telegram_payment_charge_id, payment.provider_payment_charge_id
+        )
+    if result["status"] == PAYMENT_DUPLICATE:
+        # Redelivered update, the payment has already been credited
+        logging.info(f"Duplicate payment {payment.telegram_payment_charge_id} ignored")
+        return
+
+    if result["status"] == PAYMENT_OK and not days:
+        await message.answer(
+            f"⚠️ Оплата получена ({amount} {currency_label}), но тариф по ней не найден.\n\n"
+            f"Подписка будет начислена вручную. Если этого не произошло, напишите администратору "
+            f"и укажите номер платежа:\n<code>{payment.telegram_payment_charge_id}</code>",
+            parse_mode=ParseMode.HTML
+        )
+    elif result["status"] == PAYMENT_OK:
+        new_expiry = result["expiry"]
         await message.answer(
             f"✅ Оплата успешна ({amount} {currency_label})!\n\n"
             f"📅 Подписка активирована до: {new_expiry.strftime('%d.%m.%Y')}\n\n"
@@ -271,8 +269,9 @@ async def process_successful_payment(message: Message):
 @dp.callback_query(F.data == "access_app")
 async def access_app(callback: types.CallbackQuery):
     # Разрешаем доступ если есть подписка ИЛИ если это админ
-    if has_active_subscription(callback.from_user.id) or callback.from_user.id in ADMIN_IDS:
-        await callback.message.edit_text(
+    if await has_active_subscription(callback.from_user.id) or callback.from_user.id in ADMIN_IDS:
+        await show_screen(
+            callback.message,
             "✅ Доступ разрешен!\n\n"
             "Нажмите кнопку ниже, чтобы открыть приложение:",
             reply_markup=get_app_keyboard()
@@ -289,7 +288,8 @@ async def access_app(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "feedback")
 async def enter_feedback_callback(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
+    screen = await show_screen(
+        callback.message,
         "💡 <b>Предложение по доработке</b>\n\n"
         "Напишите вашу идею, пожелание или опишите проблему. "
         "Я передам ваше соообщение разработчику.\n\n"
@@ -298,11 +298,11 @@ async def enter_feedback_callback(callback: types.CallbackQuery, state: FSMConte
         parse_mode=ParseMode.HTML
     )
     # Save the id of the message to edit it later
-    await state.update_data(menu_message_id=callback.message.message_id)
+    await state.update_data(menu_message_id=screen.message_id, menu_has_photo=bool(screen.photo))
     await state.set_state(FeedbackState.waiting_for_feedback)
     await callback.answer()
 
-@dp.message(FeedbackState.waiting_for_feedback)
+@dp.message(FeedbackState.waiting_for_feedback, flags={"throttle": "heavy"})
 async def process_feedback_input(message: Message, state: FSMContext):
     feedback_text = message.text
     user = message.from_user
@@ -326,11 +326,13 @@ async def process_feedback_input(message: Message, state: FSMContext):
         f"📝 <b>Текст:</b>\n{feedback_text}"
     )
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(chat_id=admin_id, text=admin_notification, parse_mode=ParseMode.HTML)
-        except Exception as e:
-            logging.error(f"Failed to send feedback to admin {admin_id}: {e}")
+    results = await asyncio.gather(*(
+        bot.send_message(chat_id=admin_id, text=admin_notification, parse_mode=ParseMode.HTML)
+        for admin_id in ADMIN_IDS
+    ), return_exceptions=True)
+    for admin_id, result in zip(ADMIN_IDS, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed to send feedback to admin {admin_id}: {result}")
 
     # Confirmation to user
     response_text = (
@@ -340,11 +342,13 @@ async def process_feedback_input(message: Message, state: FSMContext):
 
     try:
         reply_markup = get_main_keyboard()
-        await bot.edit_message_text(
+        await edit_screen(
+            bot,
             chat_id=message.chat.id,
             message_id=menu_message_id,
             text=response_text,
             reply_markup=reply_markup,
+            has_photo=data.get("menu_has_photo", False),
             parse_mode=ParseMode.HTML
         )
     except Exception:
@@ -394,12 +398,12 @@ async def show_help(callback: types.CallbackQuery):
 """
         keyboard = get_back_keyboard()
     
-    await callback.message.edit_text(help_text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    await show_screen(callback.message, help_text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
     await callback.answer()
 
 @dp.message(Command("profile"))
 async def cmd_profile(message: Message):
-    info = get_subscription_info(message.from_user.id)
+    info = await get_subscription_info(message.from_user.id)
     
     if info:
         text = MESSAGES["subscription_active"].format(**info)
@@ -412,18 +416,19 @@ async def cmd_profile(message: Message):
 
 @dp.callback_query(F.data == "enter_promo")
 async def enter_promo_callback(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
+    screen = await show_screen(
+        callback.message,
         "🎟 <b>Активация промокода</b>\n\n"
         "Пожалуйста, отправьте код в чат:",
         reply_markup=get_back_keyboard(),
         parse_mode=ParseMode.HTML
     )
     # Save the id of the message to edit it later
-    await state.update_data(menu_message_id=callback.message.message_id)
+    await state.update_data(menu_message_id=screen.message_id, menu_has_photo=bool(screen.photo))
     await state.set_state(PromoState.waiting_for_code)
     await callback.answer()
 
-@dp.message(PromoState.waiting_for_code)
+@dp.message(PromoState.waiting_for_code, flags={"throttle": "heavy"})
 async def process_promo_code_input(message: Message, state: FSMContext):
     code = message.text.strip().upper()
     data = await state.get_data()
@@ -435,31 +440,29 @@ async def process_promo_code_input(message: Message, state: FSMContext):
     except:
         pass
         
-    response_text = ""
-    success = False
-
-    # Check and apply
-    if has_used_promo_code(message.from_user.id, code):
-        response_text = "❌ Вы уже использовали этот промокод!"
-    elif use_promo_code(code, message.from_user.id):
-        promo_info = validate_promo_code(code)
+    # Check and apply in one transaction
+    result = await redeem_promo_code(code, message.from_user.id)
+    if result["status"] == PROMO_OK:
         response_text = (
             f"✅ Промокод <b>{code}</b> активирован!\n\n"
-            f"🎁 Вам начислено: <b>{promo_info['days']} дней</b> подписки\n\n"
+            f"🎁 Вам начислено: <b>{result['days']} дней</b> подписки\n\n"
             f"Проверьте профиль."
         )
-        success = True
+    elif result["status"] == PROMO_ALREADY_USED:
+        response_text = "❌ Вы уже использовали этот промокод!"
     else:
         response_text = "❌ Промокод не найден, истек или уже использован."
 
     # Edit the prompt message to show result
     try:
         reply_markup = get_main_keyboard()
-        await bot.edit_message_text(
+        await edit_screen(
+            bot,
             chat_id=message.chat.id,
             message_id=menu_message_id,
             text=response_text,
             reply_markup=reply_markup,
+            has_photo=data.get("menu_has_photo", False),
             parse_mode=ParseMode.HTML
         )
     except Exception as e:
@@ -469,7 +472,7 @@ async def process_promo_code_input(message: Message, state: FSMContext):
     await state.clear()
 
 
-@dp.message(Command("promo"))
+@dp.message(Command("promo"), flags={"throttle": "heavy"})
 async def cmd_promo(message: Message):
     # Keep legacy command support
     args = message.text.split(maxsplit=1)
@@ -482,15 +485,15 @@ async def cmd_promo(message: Message):
         return
     
     code = args[1].strip().upper()
-    if has_used_promo_code(message.from_user.id, code):
+    result = await redeem_promo_code(code, message.from_user.id)
+    if result["status"] == PROMO_ALREADY_USED:
         await message.answer("❌ Вы уже использовали этот промокод!", reply_markup=get_main_keyboard())
         return
     
-    if use_promo_code(code, message.from_user.id):
-        promo_info = validate_promo_code(code)
+    if result["status"] == PROMO_OK:
         await message.answer(
             f"✅ Промокод <b>{code}</b> активирован!\n\n"
-            f"🎁 Вам начислено: <b>{promo_info['days']} дней</b> подписки",
+            f"🎁 Вам начислено: <b>{result['days']} дней</b> подписки",
             parse_mode=ParseMode.HTML,
             reply_markup=get_main_keyboard()
         )
@@ -511,10 +514,12 @@ async def cmd_create_promo(message: Message):
     if len(args) < 3:
         await message.answer(
             "⚙️ <b>Создание промокода</b>\n\n"
-            "Формат: <code>/create_promo КОД ДНЕЙ [КОЛ_ИСПОЛЬЗОВАНИЙ]</code>\n\n"
+            "Формат: <code>/create_promo КОД ДНЕЙ [КОЛ_ИСПОЛЬЗОВАНИЙ] [ГГГГ-ММ-ДД]</code>\n\n"
             "Примеры:\n"
             "• <code>/create_promo BONUS7 7 50</code> — 50 промокодов на 7 дней\n"
-            "• <code>/create_promo TEST30 30 1</code> — 1 промокод на 30 дней",
+            "• <code>/create_promo TEST30 30 1</code> — 1 промокод на 30 дней\n"
+            "• <code>/create_promo NY 14 100 2027-01-10</code> — действует по 10.01.2027\n\n"
+            "Много случайных кодов сразу: <code>/create_promo_batch</code>",
             parse_mode=ParseMode.HTML
         )
         return
@@ -523,19 +528,115 @@ async def cmd_create_promo(message: Message):
         code = args[1].upper()
         days = int(args[2])
         max_uses = int(args[3]) if len(args) > 3 else 1
+        expires_at = parse_expiry(args[4]) if len(args) > 4 else None
         
-        if create_promo_code(code, days, max_uses):
+        if await create_promo_code(code, days, max_uses, expires_at):
             await message.answer(
                 f"✅ Промокод создан!\n\n"
                 f"🎫 Код: <code>{code}</code>\n"
                 f"📅 Дней: {days}\n"
-                f"👥 Макс. использований: {max_uses}",
+                f"👥 Макс. использований: {max_uses}" +
+                (f"\n⏳ Действует по: {args[4]}" if expires_at else ""),
                 parse_mode=ParseMode.HTML
             )
         else:
             await message.answer("❌ Промокод с таким кодом уже существует!")
     except ValueError:
-        await message.answer("❌ Неверный формат! Проверьте числа.")
+        await message.answer("❌ Неверный формат! Проверьте числа и дату.")
+
+@dp.message(Command("create_promo_batch"))
+async def cmd_create_promo_batch(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    args = message.text.split()
+    if len(args) < 3:
+        await message.answer(
+            "⚙️ <b>Пакетное создание промокодов</b>\n\n"
+            "Формат: <code>/create_promo_batch КОЛИЧЕСТВО ДНЕЙ [КОЛ_ИСПОЛЬЗОВАНИЙ] [ПРЕФИКС] [ГГГГ-ММ-ДД]</code>\n\n"
+            "Пример:\n"
+            "• <code>/create_promo_batch 10000 30 1 PARTNER 2027-03-31</code> — 10 000 одноразовых "
+            "кодов вида PARTNERXXXXXXXX на 30 дней, действуют по 31.03.2027\n"
+            "• <code>/create_promo_batch 500 7 1 - 2027-01-10</code> — без префикса\n\n"
+            f"Коды придут CSV-файлом. Не больше {MAX_BATCH} за раз.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    try:
+        count, days = int(args[1]), int(args[2])
+        max_uses = int(args[3]) if len(args) > 3 else 1
+        # "-" keeps the codes unprefixed when only a date is wanted
+        prefix = args[4].upper() if len(args) > 4 and args[4] != "-" else ""
+        expires_at = parse_expiry(args[5]) if len(args) > 5 else None
+    except ValueError:
+        await message.answer("❌ Неверный формат! Проверьте числа и дату.")
+        return
+    if not 0 < count <= MAX_BATCH or days <= 0 or max_uses <= 0:
+        await message.answer(f"❌ Количество должно быть от 1 до {MAX_BATCH}, дни и использования — больше нуля.")
+        return
+
+    try:
+        codes = await create_promo_codes(lambda: random_code(prefix), count, days, max_uses, expires_at)
+    except (ValueError, IntegrityError) as e:
+        logging.warning(f"Promo batch of {count} with prefix {prefix!r} failed: {e}")
+        await message.answer("❌ Не удалось создать промокоды, попробуйте ещё раз или возьмите другой префикс.")
+        return
+    await message.answer_document(
+        BufferedInputFile(
+            codes_csv(codes, days, max_uses, expires_at),
+            filename=f"promo-{prefix or 'batch'}-{datetime.now():%Y%m%d-%H%M%S}.csv"
+        ),
+        caption=f"✅ Создано промокодов: {len(codes)} ({days} дн., {max_uses} исп.)"
+    )
+
+PROMO_PAGE_SIZE = 20
+PROMO_FILTER_TITLES = {
+    "all": "все", "active": "активные", "expired": "истёкшие", "exhausted": "исчерпанные",
+}
+
+async def render_promo_page(status: str, prefix: str, after_id: int = None, before_id: int = None):
+    rows, has_more = await list_promo_codes_page(
+        status, prefix, after_id, before_id, limit=PROMO_PAGE_SIZE
+    )
+    title = f"📋 <b>Промокоды ({PROMO_FILTER_TITLES[status]}"
+    title += f", на {html.escape(prefix.upper())}…)</b>" if prefix else ")</b>"
+    if not rows:
+        return f"{title}\n\n📭 Ничего не найдено.", None
+
+    now = datetime.now()
+    text = title + "\n\n"
+    for row in rows:
+        expires_at = row["expires_at"]
+        if not row["is_active"]:
+            status_icon = "❌"
+        elif expires_at and expires_at <= now:
+            status_icon = "⌛"
+        elif row["used_count"] >= row["max_uses"]:
+            status_icon = "🔒"
+        else:
+            status_icon = "✅"
+        text += f"{status_icon} <code>{row['code']}</code> — {row['days']}д ({row['used_count']}/{row['max_uses']})"
+        if expires_at:
+            text += f" до {expires_at.strftime('%d.%m.%Y')}"
+        text += "\n"
+
+    # Going forward there are older codes if has_more; going back we came from them
+    has_prev = has_more if before_id else after_id is not None
+    has_next = has_more if not before_id else True
+    # callback_data is limited to 64 bytes, so the prefix is cut short
+    prefix = prefix[:16]
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            text="« Назад", callback_data=f"promos:{status}:p:{rows[0]['id']}:{prefix}"
+        ))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            text="Далее »", callback_data=f"promos:{status}:n:{rows[-1]['id']}:{prefix}"
+        ))
+    return text, InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
 
 @dp.message(Command("list_promo"))
 async def cmd_list_promo(message: Message):
@@ -543,17 +644,30 @@ async def cmd_list_promo(message: Message):
         await message.answer("❌ У вас нет прав администратора!")
         return
     
-    promos = list_all_promo_codes()
-    if not promos:
-        await message.answer("📭 Промокодов пока нет.")
+    # /list_promo [active|expired|exhausted] [ПРЕФИКС]
+    status, prefix = "all", ""
+    for arg in message.text.split()[1:3]:
+        if arg in PROMO_FILTERS:
+            status = arg
+        else:
+            prefix = arg[:16]
+
+    text, keyboard = await render_promo_page(status, prefix)
+    await message.answer(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+
+@dp.callback_query(F.data.startswith("promos:"))
+async def promo_page(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ У вас нет прав администратора!", show_alert=True)
         return
-    
-    text = "📋 <b>Список промокодов:</b>\n\n"
-    for code, days, max_uses, used_count, is_active, expires_at in promos:
-        status = "✅" if is_active else "❌"
-        text += f"{status} <code>{code}</code> — {days}д ({used_count}/{max_uses})\n"
-    
-    await message.answer(text, parse_mode=ParseMode.HTML)
+
+    _, status, direction, cursor, prefix = callback.data.split(":", 4)
+    if direction == "n":
+        text, keyboard = await render_promo_page(status, prefix, after_id=int(cursor))
+    else:
+        text, keyboard = await render_promo_page(status, prefix, before_id=int(cursor))
+    await show_screen(callback.message, text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    await callback.answer()
 
 @dp.message(Command("stats"))
 async def cmd_stats(message: Message):
@@ -561,16 +675,155 @@ async def cmd_stats(message: Message):
         await message.answer("❌ У вас нет прав администратора!")
         return
     
-    count = get_users_count()
-    active_subs = get_active_subs_count()
+    summary = await get_stats_summary()
+    cache = subscription_cache_stats()
     
     await message.answer(
-        f"📊 <b>Статистика бота:</b>\n\n"
-        f"👤 Всего пользователей: <b>{count}</b>\n"
-        f"💎 Активных подписок: <b>{active_subs}</b>",
+        format_stats(summary) +
+        f"\n🗃 Кэш подписок: {cache['hits']} попаданий / {cache['misses']} промахов "
+        f"({cache['hit_rate']:.0%}), записей: {cache['size']}/{cache['maxsize']}",
         parse_mode=ParseMode.HTML
     )
 
+@dp.message(Command("stats_rebuild"))
+async def cmd_stats_rebuild(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    await rebuild_stats()
+    await stats_job.run_once()
+    await message.answer("✅ Статистика пересчитана по истории.")
+
+@dp.message(Command("dbprofile"))
+async def cmd_dbprofile(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    if not DB_PROFILE:
+        await message.answer("ℹ️ Профилирование БД выключено (DB_PROFILE=1 в .env).")
+        return
+
+    args = message.text.split()
+    if len(args) > 1 and args[1] == "reset":
+        profiler.reset()
+        await message.answer("✅ Статистика запросов сброшена.")
+        return
+
+    # /dbprofile [total|p99|calls|rows]
+    key = args[1] if len(args) > 1 and args[1] in ("total", "p99", "calls", "rows") else "total"
+    text = f"🐢 <b>Топ запросов по {key}:</b>\n\n"
+    for sql, stats in profiler.top(10, key):
+        text += (
+            f"<code>{html.escape(sql[:200])}</code>\n"
+            f"вызовов: {stats.calls}, всего: {stats.total * 1000:.0f} мс, "
+            f"p99: {stats.p99 * 1000:.1f} мс, строк: {stats.rows}\n\n"
+        )
+
+    if profiler.updates:
+        text += "<b>Запросов на обновление:</b>\n"
+        for update_type, stats in sorted(profiler.updates.items()):
+            text += (
+                f"{update_type}: {stats.queries / stats.updates:.1f} в среднем, "
+                f"максимум {stats.max_queries}, {stats.seconds / stats.updates * 1000:.1f} мс в БД\n"
+            )
+
+    await message.answer(text, parse_mode=ParseMode.HTML)
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    args = message.text.split(maxsplit=1)
+    if message.reply_to_message:
+        # Copy the replied message as is (text, photo, formatting)
+        broadcast_id = await broadcaster.start(
+            message.chat.id,
+            from_chat_id=message.chat.id,
+            message_id=message.reply_to_message.message_id,
+        )
+    elif len(args) > 1:
+        broadcast_id = await broadcaster.start(message.chat.id, text=args[1])
+    else:
+        await message.answer(
+            "📣 <b>Рассылка</b>\n\n"
+            "Формат: <code>/broadcast ТЕКСТ</code>\n"
+            "или ответьте командой <code>/broadcast</code> на сообщение, которое нужно разослать.\n\n"
+            "Статус: <code>/broadcast_status ID</code>\n"
+            "Остановить: <code>/broadcast_cancel ID</code>",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    await message.answer(
+        f"📣 Рассылка #{broadcast_id} запущена.\n"
+        f"Статус: /broadcast_status {broadcast_id}"
+    )
+
+@dp.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    args = message.text.split()
+    row = await get_broadcast(int(args[1])) if len(args) > 1 and args[1].isdigit() else None
+    if not row:
+        await message.answer("❌ Рассылка не найдена.")
+        return
+
+    await message.answer(
+        f"📣 Рассылка #{row['id']}: {row['status']}\n\n"
+        f"✅ Доставлено: {row['sent']}\n"
+        f"🚫 Заблокировали бота: {row['blocked']}\n"
+        f"❌ Ошибок: {row['failed']}"
+    )
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    # /export <table> [ГГГГ-ММ-ДД] [csv|jsonl]
+    args = message.text.split()
+    table = args[1] if len(args) > 1 else None
+    fmt, since = "csv", None
+    try:
+        for arg in args[2:]:
+            if arg in FORMATS:
+                fmt = arg
+            else:
+                since = datetime.strptime(arg, "%Y-%m-%d").date()
+    except ValueError:
+        table = None
+    if table not in EXPORT_TABLES:
+        await message.answer(
+            "❌ Использование: <code>/export ТАБЛИЦА [ГГГГ-ММ-ДД] [csv|jsonl]</code>\n"
+            f"Таблицы: {', '.join(EXPORT_TABLES)}",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    # Runs in the background, the file arrives when it's ready
+    exporter.start(message.chat.id, table, fmt, since)
+    await message.answer(f"⏳ Готовлю выгрузку {table} ({fmt}.gz)...")
+
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав администратора!")
+        return
+
+    args = message.text.split()
+    if len(args) > 1 and args[1].isdigit() and await broadcaster.cancel(int(args[1])):
+        await message.answer(f"⏹ Рассылка #{args[1]} остановлена.")
+    else:
+        await message.answer("❌ Активная рассылка не найдена.")
+
 
 from aiogram.types import BotCommand, BotCommandScopeDefault
 
@@ -591,10 +844,29 @@ async def setup_bot_commands(bot: Bot):
     )
 
 async def main():
-    init_db()
-    init_promo_codes_table()
+    await init_db()
+    await broadcaster.resume()
+    reminders_task = asyncio.create_task(reminder_scheduler.run())
+    reaper_task = asyncio.create_task(fsm_storage.run_reaper())
+    stats_task = asyncio.create_task(stats_job.run())
     await setup_bot_commands(bot)
-    await dp.start_polling(bot)
+    # Never on the public webhook server, always its own listener
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    try:
+        if RUN_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # getUpdates is refused while a webhook is set
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        reminders_task.cancel()
+        reaper_task.cancel()
+        stats_task.cancel()
+        await user_writer.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,87 @@
+import hashlib
+import logging
+import os
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaPhoto, Message
+
+from database import get_media_file_id, save_media_file_id, delete_media_file_id
+
+
+class MediaRegistry:
+    """Uploads each local asset once and reuses Telegram's file_id.
+
+    file_ids are keyed by a hash of the file content, so replacing the image
+    on disk triggers exactly one new upload.
+    """
+
+    def __init__(self):
+        self._digests = {}   # path -> (mtime_ns, size, sha256)
+        self._file_ids = {}  # sha256 -> file_id
+        self._unique_ids = {}  # sha256 -> file_unique_id, to recognise the image in a message
+
+    def _digest(self, path: str) -> str:
+        st = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._digests[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    async def _get_file_id(self, digest: str):
+        file_id = self._file_ids.get(digest)
+        if file_id is None:
+            file_id = await get_media_file_id(digest)
+            if file_id:
+                self._file_ids[digest] = file_id
+        return file_id
+
+    async def answer_photo(self, message: Message, path: str, **kwargs) -> Message:
+        """message.answer_photo() that uploads `path` only if Telegram doesn't have it yet"""
+        digest = self._digest(path)
+        file_id = await self._get_file_id(digest)
+        if file_id:
+            try:
+                sent = await message.answer_photo(photo=file_id, **kwargs)
+                self._unique_ids[digest] = sent.photo[-1].file_unique_id
+                return sent
+            except TelegramBadRequest as e:
+                # file_id belongs to another bot token or was purged, upload again
+                logging.warning(f"Cached file_id for {path} rejected: {e}")
+                self._file_ids.pop(digest, None)
+                await delete_media_file_id(digest)
+
+        sent = await message.answer_photo(photo=FSInputFile(path), **kwargs)
+        await self._remember(digest, sent)
+        return sent
+
+    async def _remember(self, digest: str, sent: Message):
+        photo = sent.photo[-1]
+        self._unique_ids[digest] = photo.file_unique_id
+        if self._file_ids.get(digest) != photo.file_id:
+            self._file_ids[digest] = photo.file_id
+            await save_media_file_id(digest, photo.file_id)
+
+    def is_shown(self, message: Message, path: str) -> bool:
+        """True if `message` already carries the image at `path`"""
+        unique_id = self._unique_ids.get(self._digest(path))
+        return unique_id is not None and any(p.file_unique_id == unique_id for p in message.photo or ())
+
+    async def edit_photo(self, message: Message, path: str, caption: str = None,
+                         parse_mode: str = None, reply_markup=None) -> Message:
+        """Swap the image (and caption) of a photo message in one call"""
+        digest = self._digest(path)
+        file_id = await self._get_file_id(digest)
+        edited = await message.edit_media(
+            media=InputMediaPhoto(media=file_id or FSInputFile(path), caption=caption, parse_mode=parse_mode),
+            reply_markup=reply_markup,
+        )
+        if isinstance(edited, Message):
+            await self._remember(digest, edited)
+        return edited
+
+
+media = MediaRegistry()
@@ -0,0 +1,215 @@
+import logging
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+from database import subscription_cache_stats
+
+# Seconds; spans a cached DB read up to a slow photo upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        return self._header() + [
+            f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), function: Callable[[], float] = None):
+        super().__init__(name, help, labels)
+        self._function = function
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def render(self) -> list:
+        if self._function is not None:
+            return self._header() + [f"{self.name} {self._function()}"]
+        return self._header() + [
+            f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            # per-bucket counts (+Inf last), sum
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = self._header()
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+UPDATE_DURATION = Histogram("bot_update_duration_seconds", "Time to process an update", ["update_type"])
+UPDATE_ERRORS = Counter("bot_update_errors_total", "Updates that raised", ["update_type"])
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates being processed", ["update_type"])
+
+HANDLER_DURATION = Histogram("bot_handler_duration_seconds", "Handler run time", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions", ["handler"])
+HANDLERS_IN_FLIGHT = Gauge("bot_handlers_in_flight", "Handlers currently running", ["handler"])
+
+API_DURATION = Histogram("bot_api_request_duration_seconds", "Outbound Bot API call time", ["method"])
+API_ERRORS = Counter("bot_api_errors_total", "Failed Bot API calls", ["method"])
+UPDATES_THROTTLED = Counter("bot_updates_throttled_total", "Updates dropped by anti-flood", ["handler"])
+
+CACHE_HITS = Gauge(
+    "bot_subscription_cache_hits", "Subscription cache hits since start",
+    function=lambda: subscription_cache_stats()["hits"],
+)
+CACHE_MISSES = Gauge(
+    "bot_subscription_cache_misses", "Subscription cache misses since start",
+    function=lambda: subscription_cache_stats()["misses"],
+)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware on dp.update: latency, errors, in-flight per update type"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        update_type = event.event_type
+        UPDATES_IN_FLIGHT.inc(update_type)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.inc(update_type)
+            raise
+        finally:
+            UPDATE_DURATION.observe(time.perf_counter() - start, update_type)
+            UPDATES_IN_FLIGHT.dec(update_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: same measurements per matched handler function"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        HANDLERS_IN_FLIGHT.inc(name)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - start, name)
+            HANDLERS_IN_FLIGHT.dec(name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Session middleware timing every outbound Bot API call"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            API_ERRORS.inc(name)
+            raise
+        finally:
+            API_DURATION.observe(time.perf_counter() - start, name)
+
+
+def setup_metrics(dp: Dispatcher, bot: Bot):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    handler_middleware = HandlerMetricsMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(handler_middleware)
+    bot.session.middleware(ApiMetricsMiddleware())
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Serve GET /metrics on its own port; returns the runner"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
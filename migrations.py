@@ -0,0 +1,203 @@
+import logging
+
+# (version, name, statements). Append new migrations, never edit applied ones.
+# {pk}, {bigint}, {true} are filled with the backend's column types.
+MIGRATIONS = [
+    (1, "baseline", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id {pk},
+            telegram_id {bigint} UNIQUE NOT NULL,
+            username TEXT,
+            full_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            subscription_expiry TIMESTAMP,
+            is_active BOOLEAN DEFAULT {true}
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id {pk},
+            user_id {bigint} NOT NULL,
+            amount INTEGER NOT NULL,
+            days INTEGER NOT NULL,
+            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            invoice_payload TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS promo_codes (
+            id {pk},
+            code TEXT UNIQUE NOT NULL,
+            days INTEGER NOT NULL,
+            max_uses INTEGER DEFAULT 1,
+            used_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP,
+            is_active BOOLEAN DEFAULT {true}
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS promo_code_usages (
+            id {pk},
+            promo_code_id {bigint} NOT NULL,
+            user_id {bigint} NOT NULL,
+            used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (promo_code_id) REFERENCES promo_codes (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+    ]),
+    (2, "media file_id cache", [
+        """
+        CREATE TABLE IF NOT EXISTS media_files (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (3, "broadcasts", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id {pk},
+            admin_chat_id {bigint} NOT NULL,
+            text TEXT,
+            from_chat_id {bigint},
+            message_id {bigint},
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id {bigint} NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """,
+    ]),
+    (4, "expiry reminders", [
+        """
+        CREATE TABLE IF NOT EXISTS subscription_reminders (
+            user_id {bigint} NOT NULL,
+            expiry TIMESTAMP NOT NULL,
+            window_days INTEGER NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, expiry, window_days),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_subscription_expiry ON users (subscription_expiry)",
+    ]),
+    (5, "hot-path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id)",
+        # Older versions could record the same usage twice, keep the first
+        """
+        DELETE FROM promo_code_usages WHERE id NOT IN (
+            SELECT MIN(id) FROM promo_code_usages GROUP BY user_id, promo_code_id
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_code_usages_user_promo
+        ON promo_code_usages (user_id, promo_code_id)
+        """,
+    ]),
+    (6, "payment ledger charge ids", [
+        "ALTER TABLE payments ADD COLUMN currency TEXT",
+        "ALTER TABLE payments ADD COLUMN telegram_payment_charge_id TEXT",
+        "ALTER TABLE payments ADD COLUMN provider_payment_charge_id TEXT",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_telegram_charge_id
+        ON payments (telegram_payment_charge_id)
+        """,
+    ]),
+    (7, "fsm storage", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at TIMESTAMP NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at)",
+    ]),
+    (8, "stats rollups", [
+        # day is 'YYYY-MM-DD'; currency is '' for metrics that have none
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            currency TEXT NOT NULL DEFAULT '',
+            value {bigint} NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, currency)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            metric TEXT NOT NULL,
+            currency TEXT NOT NULL DEFAULT '',
+            value {bigint} NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, currency)
+        )
+        """,
+    ]),
+    (9, "promo code listing index", [
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_created_at_id ON promo_codes (created_at, id)",
+    ]),
+    (10, "reminder claims", [
+        # A claim is logged before sending, sent_at is set once it's delivered
+        "ALTER TABLE subscription_reminders ADD COLUMN claimed_at TIMESTAMP",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+_TABLE_EXISTS = {
+    "sqlite": "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+    "postgresql": "SELECT 1 FROM information_schema.tables WHERE table_name = ?",
+}
+
+
+async def get_schema_version(pool) -> int:
+    async with pool.acquire() as conn:
+        if not await conn.fetchval(_TABLE_EXISTS[pool.dialect], ("schema_migrations",)):
+            return 0
+        return await conn.fetchval("SELECT MAX(version) FROM schema_migrations") or 0
+
+
+async def migrate(pool) -> int:
+    """Apply pending migrations, return the resulting schema version.
+
+    An up-to-date database costs two catalog lookups and no DDL.
+    """
+    version = await get_schema_version(pool)
+    if version >= LATEST_VERSION:
+        return version
+
+    async with pool.transaction() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    for number, name, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        async with pool.transaction() as conn:
+            if pool.dialect == "postgresql":
+                # Serialize bot processes starting at the same time
+                await conn.execute("SELECT pg_advisory_xact_lock(?)", (number,))
+            if await conn.fetchval("SELECT 1 FROM schema_migrations WHERE version = ?", (number,)):
+                continue
+            for sql in statements:
+                await conn.execute(sql.format(**pool.types))
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (number, name)
+            )
+        logging.info(f"Applied schema migration {number}: {name}")
+
+    return LATEST_VERSION
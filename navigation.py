@@ -0,0 +1,61 @@
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+from media import media
+
+CAPTION_LIMIT = 1024
+
+
+async def show_screen(message: Message, text: str, reply_markup=None,
+                      photo: Optional[str] = None, parse_mode: Optional[str] = None) -> Message:
+    """Turn the bot's `message` into another menu screen, in one API call when possible.
+
+    A photo message stays a photo message: a text screen becomes its caption
+    and a screen with another image swaps it via edit_message_media. A text
+    message can't gain a photo, so it is deleted and the photo sent anew;
+    the same happens when Telegram rejects the edit (message too old, gone).
+    """
+    try:
+        if getattr(message, "photo", None):
+            if photo is not None and not media.is_shown(message, photo):
+                return await media.edit_photo(
+                    message, photo, caption=text, parse_mode=parse_mode, reply_markup=reply_markup
+                )
+            if len(text) <= CAPTION_LIMIT:
+                return await message.edit_caption(
+                    caption=text, reply_markup=reply_markup, parse_mode=parse_mode
+                )
+        elif photo is None:
+            return await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return message
+        logging.info(f"Editing message {message.message_id} failed, sending a new one: {e}")
+
+    try:
+        await message.delete()
+    except TelegramBadRequest:
+        pass
+    if photo is not None:
+        return await media.answer_photo(
+            message, photo, caption=text, reply_markup=reply_markup, parse_mode=parse_mode
+        )
+    return await message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+
+async def edit_screen(bot: Bot, chat_id: int, message_id: int, text: str, reply_markup=None,
+                      has_photo: bool = False, parse_mode: Optional[str] = None):
+    """Edit a screen known only by id, e.g. a prompt remembered in FSM data"""
+    if has_photo:
+        return await bot.edit_message_caption(
+            chat_id=chat_id, message_id=message_id, caption=text,
+            reply_markup=reply_markup, parse_mode=parse_mode
+        )
+    return await bot.edit_message_text(
+        chat_id=chat_id, message_id=message_id, text=text,
+        reply_markup=reply_markup, parse_mode=parse_mode
+    )
@@ -0,0 +1,88 @@
+import logging
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES
+from ratelimit import PriorityTokenBucket, TokenBucket
+
+# Priority classes, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+# Set to BULK inside broadcast/reminder tasks; handlers keep the default
+request_priority: ContextVar[int] = ContextVar("request_priority", default=INTERACTIVE)
+
+# Drop idle per-chat buckets once there are this many
+MAX_CHAT_BUCKETS = 10000
+
+# Changing or removing a message doesn't count towards a chat's message limit
+CHAT_EXEMPT_PREFIXES = ("edit", "delete")
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Session middleware every Bot API call goes through.
+
+    Calls addressed to a chat wait for a token from that chat's bucket and
+    then from the global bucket, where interactive replies are served ahead
+    of bulk traffic. A RetryAfter pauses both buckets and the call is
+    retried, up to `max_retries` times. Edits and deletions only take a
+    global token, calls without a chat (answers to callback and
+    pre-checkout queries, getMe, ...) are not limited at all.
+    """
+
+    def __init__(self, rate: float = OUTBOUND_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: float = OUTBOUND_CHAT_BURST, max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.rate = rate
+        self.bucket = PriorityTokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}  # chat_id -> TokenBucket
+
+    def split(self, processes: int):
+        """Keep to a 1/`processes` share of the global rate, for when that
+        many processes send with the same token. Call before any traffic.
+        """
+        self.bucket = PriorityTokenBucket(self.rate / processes)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._evict()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _evict(self):
+        self._chats = {k: b for k, b in self._chats.items() if not b.is_idle()}
+        if len(self._chats) >= MAX_CHAT_BUCKETS:
+            # Everyone is busy: forget the oldest half, their waiters keep their bucket
+            keys = list(self._chats)
+            self._chats = {k: self._chats[k] for k in keys[len(keys) // 2:]}
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        if method.__api_method__.startswith(CHAT_EXEMPT_PREFIXES):
+            chat_bucket = None
+        else:
+            chat_bucket = self._chat_bucket(chat_id)
+        priority = request_priority.get()
+        for attempt in range(self.max_retries + 1):
+            if chat_bucket is not None:
+                await chat_bucket.acquire()
+            await self.bucket.acquire(priority=priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"{method.__api_method__} to {chat_id}: flood control, retry in {e.retry_after} s")
+                self.bucket.pause(e.retry_after)
+                if chat_bucket is not None:
+                    chat_bucket.pause(e.retry_after)
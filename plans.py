@@ -0,0 +1,145 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Optional
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
+
+from config import BOT_TOKEN, SUBSCRIPTION_PRICES, SUBSCRIPTION_STARS, SUBSCRIPTION_DAYS
+
+RUB = "RUB"
+XTR = "XTR"
+_CURRENCY_CODES = {RUB: "r", XTR: "s"}
+_CODE_CURRENCIES = {v: k for k, v in _CURRENCY_CODES.items()}
+
+PLAN_LABELS = {
+    7: "🧪 <b>7 дней</b>",
+    30: "📅 <b>1 месяц</b>",
+    90: "⭐ <b>3 месяца</b> (Выгодно)",
+    180: "💎 <b>6 месяцев</b> (Super)",
+}
+
+
+@dataclass(frozen=True)
+class Plan:
+    days: int
+    rub: int
+    stars: int
+    currency_text: str
+    currency_keyboard: InlineKeyboardMarkup
+
+    def amount(self, currency: str) -> Optional[int]:
+        """Invoice total in the currency's smallest units"""
+        if currency == RUB:
+            return self.rub * 100
+        if currency == XTR:
+            return self.stars
+        return None
+
+    def prices(self, currency: str) -> list:
+        return [LabeledPrice(label=f"Подписка {self.days} дней", amount=self.amount(currency))]
+
+
+@dataclass(frozen=True)
+class Invoice:
+    plan: Plan
+    currency: str
+    user_id: int
+
+
+class PlanCatalog:
+    """Subscription plans, built once at startup.
+
+    Texts and keyboards are rendered up front; invoice payloads are
+    HMAC-signed so pre-checkout can verify plan, currency, amount and buyer
+    without touching the database or trusting callback data.
+    """
+
+    def __init__(self, prices, stars, days, secret: bytes):
+        self._secret = secret
+        plans = {}
+        plans_text = "💎 <b>Выберите длительность подписки:</b>\n\n"
+        plan_buttons = []
+
+        for rub, star, day in zip(prices, stars, days):
+            label = PLAN_LABELS.get(day, f"• {day} дней")
+            plans_text += f"{label}\n💳 <b>{rub} ₽</b>   <i>(⭐️ {star} Stars)</i>\n\n"
+            plan_buttons.append([InlineKeyboardButton(text=f"📅 {day} дней", callback_data=f"select_plan_{day}")])
+            plans[day] = Plan(
+                days=day,
+                rub=rub,
+                stars=star,
+                currency_text=f"💳 <b>Выберите способ оплаты для {day} дней:</b>",
+                currency_keyboard=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text=f"🇷🇺 Рубли ({rub}₽)", callback_data=f"buy_rub_{day}")],
+                    [InlineKeyboardButton(text=f"⭐️ Telegram Stars ({star} XTR)", callback_data=f"buy_star_{day}")],
+                    [InlineKeyboardButton(text="« Назад", callback_data="subscribe")]
+                ]),
+            )
+
+        plan_buttons.append([InlineKeyboardButton(text="« Назад", callback_data="back_main")])
+        self.plans = MappingProxyType(plans)
+        self.plans_text = plans_text
+        self.plans_keyboard = InlineKeyboardMarkup(inline_keyboard=plan_buttons)
+
+    @classmethod
+    def from_config(cls) -> "PlanCatalog":
+        secret = hashlib.sha256(f"invoice-payload:{BOT_TOKEN}".encode()).digest()
+        return cls(SUBSCRIPTION_PRICES, SUBSCRIPTION_STARS, SUBSCRIPTION_DAYS, secret)
+
+    def get(self, days: int) -> Optional[Plan]:
+        return self.plans.get(days)
+
+    def _sign(self, body: str) -> str:
+        mac = hmac.new(self._secret, body.encode(), hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(mac).decode().rstrip("=")
+
+    def invoice_payload(self, plan: Plan, currency: str, user_id: int) -> str:
+        """Compact signed payload: days.currency.user.nonce.signature"""
+        body = f"{plan.days}.{_CURRENCY_CODES[currency]}.{user_id}.{secrets.token_urlsafe(6)}"
+        return f"{body}.{self._sign(body)}"
+
+    def parse_payload(self, payload: str) -> Optional[Invoice]:
+        body, _, signature = payload.rpartition(".")
+        if not body or not hmac.compare_digest(signature, self._sign(body)):
+            return None
+
+        days, code, user_id, _ = body.split(".", 3)
+        plan = self.plans.get(int(days))
+        if plan is None or code not in _CODE_CURRENCIES:
+            return None
+        return Invoice(plan=plan, currency=_CODE_CURRENCIES[code], user_id=int(user_id))
+
+    def paid_days(self, payload: str) -> Optional[int]:
+        """Days a successful payment buys, None if the payload isn't recognised.
+
+        Unlike parse_payload, a valid signature is enough: the plan may have
+        been removed after the invoice was issued. Unsigned
+        sub_<days>_<user>_<time>_<rub|star> payloads of invoices sent before
+        signing are accepted too, as Telegram only reports payments for
+        invoices this bot sent.
+        """
+        body, _, signature = payload.rpartition(".")
+        if body and hmac.compare_digest(signature, self._sign(body)):
+            days = body.split(".", 1)[0]
+        else:
+            parts = payload.split("_")
+            if len(parts) != 5 or parts[0] != "sub" or parts[4] not in ("rub", "star"):
+                return None
+            days = parts[1]
+        return int(days) if days.isdigit() and int(days) > 0 else None
+
+    def verify(self, payload: str, currency: str, total_amount: int, user_id: int) -> Optional[Invoice]:
+        """Invoice if the payment matches what we issued, else None"""
+        invoice = self.parse_payload(payload)
+        if (
+            invoice is None
+            or invoice.currency != currency
+            or invoice.user_id != user_id
+            or invoice.plan.amount(currency) != total_amount
+        ):
+            return None
+        return invoice
@@ -0,0 +1,27 @@
+import csv
+import io
+import secrets
+from datetime import datetime, timedelta
+
+# No 0/O and 1/I, so codes survive being typed from a screenshot
+ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+CODE_LENGTH = 8
+MAX_BATCH = 50000
+
+
+def random_code(prefix: str = "", length: int = CODE_LENGTH) -> str:
+    return prefix.upper() + "".join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+def parse_expiry(value: str) -> datetime:
+    """'YYYY-MM-DD' -> end of that day: a code is valid through the date given"""
+    return datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)
+
+
+def codes_csv(codes, days: int, max_uses: int, expires_at: datetime = None) -> bytes:
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(("code", "days", "max_uses", "expires_at"))
+    expires = expires_at.isoformat(sep=" ") if expires_at else ""
+    writer.writerows((code, days, max_uses, expires) for code in codes)
+    return out.getvalue().encode("utf-8")
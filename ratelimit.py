@@ -0,0 +1,104 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`.
+
+    Waiters are served in FIFO order. pause() stops the whole bucket, e.g.
+    for the duration of a Telegram flood-control RetryAfter.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take tokens without waiting; False if there aren't enough"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        """Full and unpaused, i.e. indistinguishable from a fresh bucket"""
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._paused_until and not self._lock.locked()
+
+
+class PriorityTokenBucket(TokenBucket):
+    """TokenBucket that serves waiters by priority (lower value first),
+    FIFO within the same priority.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        super().__init__(rate, capacity)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump_task = None
+
+    async def acquire(self, tokens: float = 1, priority: int = 0):
+        if not self._waiters and self.try_acquire(tokens):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, waiter))
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+        await waiter
+
+    async def _pump(self):
+        try:
+            while self._waiters:
+                _, _, tokens, waiter = self._waiters[0]
+                if waiter.done():
+                    # Cancelled while waiting
+                    heapq.heappop(self._waiters)
+                    continue
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    heapq.heappop(self._waiters)
+                    waiter.set_result(None)
+                    continue
+                # Re-check the head afterwards: a more urgent waiter may have arrived
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+        finally:
+            self._pump_task = None
+
+    def is_idle(self) -> bool:
+        return not self._waiters and super().is_idle()
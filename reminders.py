@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import MESSAGES, REMINDER_WINDOWS, REMINDER_INTERVAL, REMINDER_RATE
+from database import claim_expiry_reminders, mark_reminders_sent
+from outbound import BULK, request_priority
+from ratelimit import TokenBucket
+
+BATCH_SIZE = 100
+MAX_RETRIES = 3
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+
+def get_renew_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💎 Продлить подписку", callback_data="subscribe")]
+    ])
+
+
+class ReminderScheduler:
+    """Periodically reminds users that their subscription is about to end.
+
+    With windows [3, 1] a user gets one reminder when expiry is 1-3 days
+    away and another when it is under a day away. Each reminder is logged
+    per (user, expiry, window), so it goes out once, and a renewal (new
+    expiry) starts a fresh cycle.
+    """
+
+    def __init__(self, bot: Bot, windows=REMINDER_WINDOWS,
+                 interval: float = REMINDER_INTERVAL, rate: float = REMINDER_RATE):
+        self.bot = bot
+        self.windows = sorted(windows, reverse=True)
+        self.interval = interval
+        self.bucket = TokenBucket(rate)
+
+    async def _send(self, telegram_id: int, expiry: datetime) -> str:
+        text = MESSAGES["expiry_reminder"].format(expiry_date=expiry.strftime("%d.%m.%Y"))
+        for _ in range(MAX_RETRIES):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(telegram_id, text, reply_markup=get_renew_keyboard())
+                return SENT
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except TelegramAPIError as e:
+                logging.info(f"Reminder to {telegram_id} not delivered: {e}")
+                return FAILED
+        return FAILED
+
+    async def run_once(self) -> int:
+        """One scan over all windows, returns number of reminders delivered.
+
+        Reminders that failed stay claimed but unsent and are retried by a
+        later scan; a user who blocked the bot isn't retried.
+        """
+        now = datetime.now()
+        delivered = 0
+        for i, days in enumerate(self.windows):
+            # (next smaller window, this window] so windows don't overlap
+            lower = self.windows[i + 1] if i + 1 < len(self.windows) else 0
+            start, end = now + timedelta(days=lower), now + timedelta(days=days)
+            while True:
+                rows = await claim_expiry_reminders(days, start, end, BATCH_SIZE)
+                if not rows:
+                    break
+                results = await asyncio.gather(
+                    *(self._send(telegram_id, expiry) for _, telegram_id, expiry in rows)
+                )
+                await mark_reminders_sent(
+                    days, [row[0] for row, result in zip(rows, results) if result != FAILED]
+                )
+                delivered += results.count(SENT)
+        return delivered
+
+    async def run(self):
+        request_priority.set(BULK)
+        while True:
+            try:
+                delivered = await self.run_once()
+                if delivered:
+                    logging.info(f"Sent {delivered} subscription expiry reminders")
+            except Exception:
+                logging.exception("Expiry reminder scan failed")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from config import STATS_INTERVAL
+from database import (
+    get_stats_summary, rebuild_stats, refresh_active_subscriptions, stats_backfilled,
+    STAT_NEW_USERS, STAT_PAYMENTS, STAT_REVENUE, STAT_PROMO_REDEMPTIONS, STAT_ACTIVE_SUBS
+)
+
+PERIODS = (7, 30)
+CURRENCIES = (("RUB", "₽"), ("XTR", "⭐️"))
+
+
+class StatsJob:
+    """Background upkeep of the /stats rollups.
+
+    Counters are maintained by the writes themselves; this job backfills
+    them from history on the first start and snapshots the number of
+    active subscriptions every `interval` seconds.
+    """
+
+    def __init__(self, interval: float = STATS_INTERVAL):
+        self.interval = interval
+
+    async def run_once(self) -> int:
+        if not await stats_backfilled():
+            logging.info("Building stats rollups from history")
+            await rebuild_stats()
+        return await refresh_active_subscriptions()
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Stats refresh failed")
+            await asyncio.sleep(self.interval)
+
+
+def _trend(current: int, previous: int) -> str:
+    if not previous:
+        return ""
+    return f" ({(current - previous) / previous:+.0%})"
+
+
+def _revenue(values: dict, previous: dict = None) -> str:
+    parts = []
+    for code, sign in CURRENCIES:
+        amount = values.get((STAT_REVENUE, code), 0)
+        trend = _trend(amount, previous.get((STAT_REVENUE, code), 0)) if previous is not None else ""
+        parts.append(f"{amount} {sign}{trend}")
+    return ", ".join(parts)
+
+
+def format_stats(summary: dict) -> str:
+    """HTML text of /stats from get_stats_summary()"""
+    totals = summary["totals"]
+    active = summary["active"]
+    text = (
+        f"📊 <b>Статистика бота:</b>\n\n"
+        f"👤 Всего пользователей: <b>{totals.get((STAT_NEW_USERS, ''), 0)}</b>\n"
+        f"💎 Активных подписок: <b>{totals.get((STAT_ACTIVE_SUBS, ''), 0)}</b>\n"
+        f"💰 Выручка всего: <b>{_revenue(totals)}</b>\n"
+        f"💳 Оплат всего: <b>{sum(v for (m, _), v in totals.items() if m == STAT_PAYMENTS)}</b>\n"
+    )
+
+    for days in PERIODS:
+        current, previous = summary["periods"][days]
+        new_users = current.get((STAT_NEW_USERS, ""), 0)
+        payments = sum(v for (m, _), v in current.items() if m == STAT_PAYMENTS)
+        promo = current.get((STAT_PROMO_REDEMPTIONS, ""), 0)
+        text += (
+            f"\n<b>За {days} дней</b> (к предыдущим {days}):\n"
+            f"👤 Новых пользователей: {new_users}"
+            f"{_trend(new_users, previous.get((STAT_NEW_USERS, ''), 0))}\n"
+            f"💳 Оплат: {payments}"
+            f"{_trend(payments, sum(v for (m, _), v in previous.items() if m == STAT_PAYMENTS))}\n"
+            f"💰 Выручка: {_revenue(current, previous)}\n"
+            f"🎟 Активаций промокодов: {promo}"
+            f"{_trend(promo, previous.get((STAT_PROMO_REDEMPTIONS, ''), 0))}\n"
+        )
+        if 0 in active and days in active:
+            text += f"💎 Активных подписок: {active[0]}{_trend(active[0], active[days])}\n"
+
+    return text
@@ -0,0 +1,331 @@
+"""Multi-process mode: one intake process, WORKERS handler processes.
+
+    python supervisor.py
+
+The supervisor receives raw updates (long polling or webhook, per RUN_MODE)
+and only looks at them long enough to pick a worker by user id, so all
+updates of one user go to the same worker, in order. Workers run the
+handlers from main.py; shared state lives in the database, so use
+PostgreSQL (or at least one SQLite file on a local disk).
+
+Each worker acknowledges an update once it has been handled. A worker
+that dies is restarted on a fresh pipe and gets every update it had not
+acknowledged, so an update it was in the middle of may run twice
+(payments are credited once per charge id regardless).
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+from collections import OrderedDict
+
+import aiohttp
+from aiohttp import web
+
+from config import (
+    RUN_MODE, WORKERS, WORKER_CONCURRENCY, WORKER_QUEUE_SIZE, METRICS_PORT,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_MAX_CONCURRENCY
+)
+
+POLL_TIMEOUT = 30
+MONITOR_INTERVAL = 1.0
+STOP_TIMEOUT = 30
+
+
+def shard_key(update: dict) -> int:
+    """User the update belongs to (chat for channel posts, update id as last resort)"""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"]
+            chat = value.get("chat")
+            if chat:
+                return chat["id"]
+    return update["update_id"]
+
+
+class ShardWorker:
+    """Feeds raw updates to a dispatcher: one user's updates run one after
+    another, different users concurrently, at most `concurrency` at once.
+    `on_done(update)` is called after each update, handled or failed.
+    """
+
+    def __init__(self, dp, bot, concurrency: int = WORKER_CONCURRENCY, on_done=None):
+        self.dp = dp
+        self.bot = bot
+        self.on_done = on_done
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails = {}  # shard key -> last scheduled Task
+
+    def submit(self, update: dict):
+        key = shard_key(update)
+        task = asyncio.create_task(self._process(self._tails.get(key), update))
+        self._tails[key] = task
+        task.add_done_callback(lambda t: self._tails.pop(key) if self._tails.get(key) is t else None)
+
+    async def _process(self, previous, update: dict):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            # Only updates that can run take a slot, a flooding user's backlog doesn't
+            async with self._slots:
+                await self.dp.feed_raw_update(self.bot, update)
+        except Exception:
+            logging.exception(f"Update {update.get('update_id')} failed")
+        finally:
+            if self.on_done is not None:
+                self.on_done(update)
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.gather(*self._tails.values())
+
+
+async def _run_worker(index: int, conn, workers: int):
+    import main
+    from database import init_db, close_db
+    from metrics import start_metrics_server
+
+    # All workers send with one token, so together they keep to OUTBOUND_RATE
+    main.outbound_scheduler.split(workers)
+    await init_db()
+    background = []
+    if index == 0:
+        # Process-wide jobs run once, not once per worker
+        await main.broadcaster.resume()
+        background.append(asyncio.create_task(main.reminder_scheduler.run()))
+        background.append(asyncio.create_task(main.fsm_storage.run_reaper()))
+        background.append(asyncio.create_task(main.stats_job.run()))
+    metrics_runner = await start_metrics_server(port=METRICS_PORT + index) if METRICS_PORT else None
+
+    worker = ShardWorker(main.dp, main.bot, on_done=lambda update: conn.send(update["update_id"]))
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, conn.recv)
+            if update is None:
+                break
+            worker.submit(update)
+        await worker.drain()
+    finally:
+        for task in background:
+            task.cancel()
+        await main.user_writer.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_db()
+        await main.bot.session.close()
+
+
+def _worker_main(index: int, conn, workers: int):
+    # Ctrl+C reaches the whole process group; shutdown is driven by the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s")
+    asyncio.run(_run_worker(index, conn, workers))
+
+
+class _WorkerLink:
+    """Supervisor side of one worker: its pipe, the updates it has not
+    acknowledged yet, and a sender task that writes them to the pipe.
+
+    A pipe is never reused after its worker dies (the dead process may
+    have been halfway through a read), a restart gets a new link.
+    """
+
+    def __init__(self, process, conn, pending: OrderedDict):
+        self.process = process
+        self.conn = conn
+        self.pending = pending    # update_id -> update, in routing order
+        self.acked = asyncio.Event()
+        self._outbox = asyncio.Queue()
+        for update in pending.values():
+            self._outbox.put_nowait(update)
+        self._sender = asyncio.create_task(self._send_loop())
+        asyncio.get_running_loop().add_reader(conn.fileno(), self._on_readable)
+
+    def send(self, update):
+        if update is not None:
+            self.pending[update["update_id"]] = update
+        self._outbox.put_nowait(update)
+
+    async def _send_loop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                update = await self._outbox.get()
+                # Blocks while the pipe buffer is full, so off the event loop
+                await loop.run_in_executor(None, self.conn.send, update)
+        except (BrokenPipeError, ConnectionResetError, EOFError, OSError):
+            pass  # worker is gone, monitor() restarts it
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                self.pending.pop(self.conn.recv(), None)
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        self.acked.set()
+
+    def close(self):
+        self._sender.cancel()
+        try:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        except (ValueError, OSError):
+            pass
+        self.conn.close()
+
+
+class Supervisor:
+    def __init__(self, workers: int = WORKERS, queue_size: int = WORKER_QUEUE_SIZE,
+                 target=_worker_main):
+        self._context = multiprocessing.get_context("spawn")
+        self.queue_size = queue_size
+        self.target = target
+        self.links = [None] * workers
+        self._stopping = asyncio.Event()
+
+    @property
+    def processes(self) -> list:
+        return [link.process for link in self.links]
+
+    def _start(self, index: int, pending: OrderedDict = None):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=self.target, args=(index, child_conn, len(self.links)), name=f"bot-worker-{index}"
+        )
+        process.start()
+        child_conn.close()
+        self.links[index] = _WorkerLink(process, conn, pending if pending is not None else OrderedDict())
+
+    async def route(self, update: dict):
+        link = self.links[shard_key(update) % len(self.links)]
+        # Worker is behind: hold intake instead of buffering more
+        while len(link.pending) >= self.queue_size:
+            link.acked.clear()
+            await link.acked.wait()
+            link = self.links[shard_key(update) % len(self.links)]
+        link.send(update)
+
+    async def monitor(self):
+        while not self._stopping.is_set():
+            for index, link in enumerate(self.links):
+                if not link.process.is_alive():
+                    logging.warning(
+                        f"Worker {index} exited with code {link.process.exitcode}, restarting "
+                        f"and re-sending {len(link.pending)} unacknowledged updates"
+                    )
+                    link.close()
+                    self._start(index, link.pending)
+                    # Wake route() calls waiting on the old link
+                    link.acked.set()
+            await asyncio.sleep(MONITOR_INTERVAL)
+
+    async def poll(self, bot, allowed_updates: list):
+        """getUpdates loop handing raw JSON to the workers"""
+        await bot.delete_webhook()
+        url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+        offset = 0
+        timeout = aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as http:
+            while True:
+                try:
+                    async with http.post(url, json={
+                        "offset": offset, "timeout": POLL_TIMEOUT, "allowed_updates": allowed_updates,
+                    }) as resp:
+                        payload = await resp.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.warning(f"getUpdates failed: {e!r}")
+                    await asyncio.sleep(1)
+                    continue
+
+                if not payload.get("ok"):
+                    logging.warning(f"getUpdates error: {payload.get('description')}")
+                    await asyncio.sleep(payload.get("parameters", {}).get("retry_after", 1))
+                    continue
+
+                for update in payload["result"]:
+                    await self.route(update)
+                    offset = update["update_id"] + 1
+
+    async def serve_webhook(self, bot, allowed_updates: list):
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL must be set when RUN_MODE=webhook")
+
+        async def handle(request: web.Request) -> web.Response:
+            if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                return web.Response(status=401)
+            # route() holds the response while the worker queue is full
+            await self.route(await request.json())
+            return web.json_response({})
+
+        async def health(request: web.Request) -> web.Response:
+            return web.json_response({
+                "status": "ok",
+                "workers": [p.is_alive() for p in self.processes],
+            })
+
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, handle)
+        app.router.add_get("/healthz", health)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+            allowed_updates=allowed_updates,
+        )
+        logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def stop(self):
+        for link in self.links:
+            link.send(None)
+        loop = asyncio.get_running_loop()
+        for link in self.links:
+            await loop.run_in_executor(None, link.process.join, STOP_TIMEOUT)
+            if link.process.is_alive():
+                logging.warning(f"{link.process.name} did not stop in time, terminating")
+                link.process.terminate()
+            if link.pending:
+                logging.warning(f"{link.process.name} left {len(link.pending)} updates unhandled")
+            link.close()
+
+    async def run(self):
+        # Imported here so spawned workers don't build a second bot on import
+        from main import bot, dp, setup_bot_commands
+
+        for index in range(len(self.links)):
+            self._start(index)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        await setup_bot_commands(bot)
+        allowed_updates = dp.resolve_used_update_types()
+        intake = self.serve_webhook if RUN_MODE == "webhook" else self.poll
+        intake_task = asyncio.create_task(intake(bot, allowed_updates))
+        tasks = [intake_task, asyncio.create_task(self.monitor()), asyncio.create_task(self._stopping.wait())]
+        logging.info(f"Supervisor started {len(self.links)} workers ({RUN_MODE})")
+        try:
+            # Until a signal arrives or the intake fails
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.stop()
+            await bot.session.close()
+        if intake_task.done() and not intake_task.cancelled() and intake_task.exception():
+            raise intake_task.exception()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(Supervisor().run())
@@ -0,0 +1,27 @@
+import asyncio
+import inspect
+import random
+
+import database
+from bench_database import (
+    NOT_BENCHMARKED, benchmarks, format_results, load_baseline, run_size, save_baseline,
+)
+
+
+def test_every_benchmark_runs_on_small_dataset(tmp_path):
+    results = asyncio.run(run_size(200, f"sqlite:///{tmp_path / 'bench.db'}", min_time=0, max_iterations=5))
+
+    assert set(benchmarks(200, random.Random()).keys()) <= set(results)
+    assert all(r["iterations"] == 3 for name, r in results.items() if not name.startswith("_"))
+
+    path = str(tmp_path / "baseline.json")
+    save_baseline(path, {"200": results})
+    assert "vs baseline" in format_results(200, results, load_baseline(path)["200"])
+
+
+def test_every_database_function_is_benchmarked():
+    public = {
+        name for name, obj in vars(database).items()
+        if inspect.isfunction(obj) and obj.__module__ == "database" and not name.startswith("_")
+    }
+    assert public - NOT_BENCHMARKED == set(benchmarks(10, random.Random()))
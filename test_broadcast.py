@@ -0,0 +1,107 @@
+import asyncio
+
+import database
+from broadcast import Broadcaster
+from database import upsert_users, create_broadcast, get_broadcast, save_broadcast_progress
+
+ADMIN = 100
+BLOCKED_CHAT = 3
+BROKEN_CHAT = 5
+
+
+def run(run_db, fake_bot_api, scenario):
+    """scenario(broadcaster, api, hold) with users 1-6; chat 3 has blocked
+    the bot and doesn't answer until `hold` is set, chat 5 always fails"""
+    async def wrapper():
+        hold = asyncio.Event()
+        hold.set()
+
+        async def respond(method, data):
+            chat_id = int(data["chat_id"])
+            if chat_id == BLOCKED_CHAT:
+                await hold.wait()
+                return fake_bot_api.error(403, "Forbidden: bot was blocked by the user")
+            if chat_id == BROKEN_CHAT:
+                return fake_bot_api.error(400, "Bad Request: chat not found")
+
+        await upsert_users([(n, f"user{n}", "User") for n in range(1, 7)])
+        api = await fake_bot_api(respond).start()
+        bot = api.bot()
+        try:
+            return await scenario(Broadcaster(bot, rate=1000, chunk_size=2), api, hold)
+        finally:
+            hold.set()
+            await bot.session.close()
+            await api.close()
+
+    return run_db(wrapper)
+
+
+def delivered(api) -> list:
+    """Chats the broadcast text reached"""
+    return [int(data["chat_id"]) for _, data in api.calls
+            if data.get("text") == "news" and int(data["chat_id"]) not in (BLOCKED_CHAT, BROKEN_CHAT)]
+
+
+async def user_id(telegram_id: int) -> int:
+    async with database._db().acquire() as conn:
+        return await conn.fetchval("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+
+
+def test_counters_and_blocked_users(run_db, fake_bot_api):
+    async def scenario(broadcaster, api, _):
+        broadcast_id = await broadcaster.start(ADMIN, text="news")
+        await broadcaster._tasks[broadcast_id]
+
+        row = await get_broadcast(broadcast_id)
+        assert row["status"] == "done"
+        assert (row["sent"], row["failed"], row["blocked"]) == (4, 1, 1)
+        assert sorted(delivered(api)) == [1, 2, 4, 6]
+        # The admin gets the summary
+        assert int(api.calls[-1][1]["chat_id"]) == ADMIN
+
+        async with database._db().acquire() as conn:
+            inactive = await conn.fetchall("SELECT telegram_id FROM users WHERE NOT is_active")
+        assert [r["telegram_id"] for r in inactive] == [BLOCKED_CHAT]
+
+    run(run_db, fake_bot_api, scenario)
+
+
+def test_resume_continues_after_last_user(run_db, fake_bot_api):
+    async def scenario(broadcaster, api, _):
+        # Checkpointed after the first chunk before a restart
+        broadcast_id = await create_broadcast(ADMIN, text="news")
+        await save_broadcast_progress(broadcast_id, await user_id(2), 2, 0, [])
+
+        await broadcaster.resume()
+        assert broadcaster.is_running(broadcast_id)
+        await broadcaster._tasks[broadcast_id]
+
+        assert delivered(api) == [4, 6]
+        row = await get_broadcast(broadcast_id)
+        assert (row["status"], row["sent"], row["failed"], row["blocked"]) == ("done", 4, 1, 1)
+
+    run(run_db, fake_bot_api, scenario)
+
+
+def test_cancel_stops_the_broadcast(run_db, fake_bot_api):
+    async def scenario(broadcaster, api, hold):
+        hold.clear()
+        broadcast_id = await broadcaster.start(ADMIN, text="news")
+        task = broadcaster._tasks[broadcast_id]
+        # The second chunk (users 3 and 4) is in flight, so the first is checkpointed
+        while BLOCKED_CHAT not in [int(data["chat_id"]) for _, data in api.calls]:
+            await asyncio.sleep(0.01)
+
+        assert await broadcaster.cancel(broadcast_id)
+        await asyncio.wait([task])
+        assert task.cancelled() and not broadcaster.is_running(broadcast_id)
+
+        row = await get_broadcast(broadcast_id)
+        assert row["status"] == "cancelled"
+        assert row["last_user_id"] == await user_id(2)
+        assert set(delivered(api)) <= {1, 2, 4}
+        # Already finished: a second cancel reports nothing to do
+        assert not await broadcaster.cancel(broadcast_id)
+
+    run(run_db, fake_bot_api, scenario)
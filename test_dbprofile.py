@@ -0,0 +1,68 @@
+import asyncio
+
+import database
+from database import init_db, close_db, create_user, get_user
+from dbprofile import UpdateTally, current_update, profiler
+
+
+def test_queries_are_counted_and_attributed_to_update(tmp_path):
+    async def scenario():
+        await init_db(f"sqlite:///{tmp_path / 'bot.db'}", profile=True)
+        profiler.reset()
+        try:
+            tally = UpdateTally(7, "message")
+            token = current_update.set(tally)
+            try:
+                await create_user(1, "", "")
+                for _ in range(3):
+                    await get_user(1)
+            finally:
+                current_update.reset(token)
+                profiler.finish_update(tally)
+        finally:
+            await close_db()
+
+        assert tally.queries == 6
+        [(sql, stats)] = profiler.top(1, "calls")
+        assert sql == "SELECT * FROM users WHERE telegram_id = ?"
+        assert stats.calls == 3 and stats.rows == 3
+        assert stats.p99 <= stats.max <= stats.total
+        assert profiler.updates["message"].max_queries == 6
+
+    asyncio.run(scenario())
+
+
+def test_slow_queries_are_logged(tmp_path, caplog):
+    async def scenario():
+        await init_db(f"sqlite:///{tmp_path / 'bot.db'}", profile=True)
+        slow, profiler.slow = profiler.slow, 0
+        try:
+            await get_user(1)
+        finally:
+            profiler.slow = slow
+            await close_db()
+
+    asyncio.run(scenario())
+    assert any("Slow query" in r.message and "no update" in r.message for r in caplog.records)
+
+
+def test_query_after_the_update_is_not_attributed_to_it(tmp_path, caplog):
+    async def scenario():
+        await init_db(f"sqlite:///{tmp_path / 'bot.db'}", profile=True)
+        slow, profiler.slow = profiler.slow, 0
+        tally = UpdateTally(7, "message")
+        token = current_update.set(tally)
+        try:
+            profiler.finish_update(tally)
+            # A task spawned by the handler still runs in its context
+            await get_user(1)
+        finally:
+            current_update.reset(token)
+            profiler.slow = slow
+            await close_db()
+        return tally
+
+    tally = asyncio.run(scenario())
+    assert tally.queries == 0
+    assert any("Slow query" in r.message and "no update" in r.message for r in caplog.records)
+    assert not any("update 7" in r.message for r in caplog.records)
@@ -0,0 +1,67 @@
+import csv
+import gzip
+import json
+import tempfile
+from datetime import date, timedelta
+
+import database
+from database import upsert_users, record_payment
+from export import Exporter, write_export
+
+
+def test_tables_are_streamed_in_chunks_to_gzip(tmp_path, run_db):
+    async def scenario():
+        await upsert_users([(1000 + i, f"user{i}", f"Имя, \"{i}\"") for i in range(25)])
+        await record_payment(1000, 300, "RUB", 30, "p", "charge-1")
+
+        path = tmp_path / "users.csv.gz"
+        assert await write_export(str(path), "users", chunk_size=4) == 25
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == list(database.EXPORT_TABLES["users"][0])
+        assert [r[1] for r in rows[1:]] == [str(1000 + i) for i in range(25)]
+        assert rows[4][3] == 'Имя, "3"'
+
+        path = tmp_path / "payments.jsonl.gz"
+        assert await write_export(str(path), "payments", "jsonl") == 1
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            [payment] = [json.loads(line) for line in f]
+        assert payment["amount"] == 300 and payment["currency"] == "RUB"
+
+        tomorrow = date.today() + timedelta(days=1)
+        assert await write_export(str(path), "payments", "jsonl", since=tomorrow) == 0
+
+    run_db(scenario)
+
+
+class FakeBot:
+    def __init__(self):
+        self.documents = []
+        self.messages = []
+
+    async def send_document(self, chat_id, document, caption=None):
+        with gzip.open(document.path, "rt", encoding="utf-8") as f:
+            self.documents.append((chat_id, document.filename, caption, f.read()))
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+def test_exporter_sends_document_and_removes_temp_file(tmp_path, run_db, monkeypatch):
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(scratch))
+
+    async def scenario():
+        await upsert_users([(1, "a", "A"), (2, "b", "B")])
+        bot = FakeBot()
+        await Exporter(bot).start(42, "users", "jsonl")
+
+        [(chat_id, filename, caption, body)] = bot.documents
+        assert chat_id == 42
+        assert filename.startswith("users-") and filename.endswith(".jsonl.gz")
+        assert "2 строк" in caption
+        assert len(body.splitlines()) == 2
+        assert list(scratch.iterdir()) == []
+
+    run_db(scenario)
@@ -0,0 +1,102 @@
+from datetime import timedelta
+
+from aiogram.fsm.storage.base import StorageKey
+
+import database
+from dbprofile import UpdateTally, current_update, profiler
+from fsm_storage import DatabaseFSMContext, DatabaseStorage, record_cache
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+
+async def rows() -> int:
+    async with database._db().acquire() as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM fsm_states")
+
+
+def test_state_and_data_round_trip_and_clear(run_db):
+    async def scenario():
+        storage = DatabaseStorage()
+        await storage.set_state(KEY, "PromoState:waiting_for_code")
+        await storage.update_data(KEY, {"menu_message_id": 7})
+
+        assert await storage.get_state(KEY) == "PromoState:waiting_for_code"
+        assert await storage.get_data(KEY) == {"menu_message_id": 7}
+        # Same user in another chat is a separate conversation
+        assert await storage.get_state(StorageKey(bot_id=1, chat_id=43, user_id=42)) is None
+
+        # FSMContext.clear(): no state, no data -> no row
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        assert await rows() == 0
+
+    run_db(scenario)
+
+
+async def statements(action) -> int:
+    """Number of queries `action()` runs"""
+    tally = UpdateTally(1, "message")
+    token = current_update.set(tally)
+    try:
+        await action()
+    finally:
+        current_update.reset(token)
+        profiler.finish_update(tally)
+    return tally.queries
+
+
+def test_clear_is_a_single_statement(run_db):
+    async def scenario():
+        context = DatabaseFSMContext(DatabaseStorage(), KEY)
+        # Absent key: no upsert, just the DELETE
+        assert await statements(context.clear) == 1
+        assert await statements(lambda: context.set_state(None)) == 1
+
+        await context.set_state("PromoState:waiting_for_code")
+        await context.update_data(menu_message_id=7)
+        assert await statements(context.clear) == 1
+        assert await rows() == 0
+
+    run_db(scenario, profile=True)
+
+
+def test_reads_are_cached_for_the_update(run_db):
+    async def scenario():
+        context = DatabaseFSMContext(DatabaseStorage(), KEY)
+        with record_cache():
+            # What FSMContextMiddleware does before the handler
+            assert await statements(context.get_state) == 1
+            # Nothing stored: clearing and reading again are free
+            assert await statements(context.clear) == 0
+            assert await statements(context.get_data) == 0
+
+            await context.set_state("FeedbackState:waiting_for_feedback")
+            assert await statements(lambda: context.update_data(menu_message_id=7)) == 1
+            assert await context.get_state() == "FeedbackState:waiting_for_feedback"
+            await context.clear()
+            assert await statements(context.get_state) == 0
+        assert await rows() == 0
+
+    run_db(scenario, profile=True)
+
+
+def test_abandoned_states_expire_and_are_reaped(run_db):
+    async def scenario():
+        storage = DatabaseStorage(ttl=-1)
+        await storage.set_state(KEY, "FeedbackState:waiting_for_feedback")
+        await storage.set_data(KEY, {"menu_message_id": 7})
+
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+
+        # A write to an expired key must not revive its old state
+        storage.ttl = timedelta(hours=1)
+        await storage.set_data(KEY, {"x": 1})
+        assert await storage.get_state(KEY) is None
+
+        storage.ttl = timedelta(seconds=-1)
+        await storage.set_state(StorageKey(bot_id=1, chat_id=1, user_id=1), "A:b")
+        assert await storage.reap() == 1
+        assert await rows() == 1
+
+    run_db(scenario)
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_loadtest_runs_full_scenario():
+    # Separate process: main.py reads its config and builds the bot at import
+    env = {**os.environ, "BOT_TOKEN": "1:LOADTEST", "METRICS_PORT": "0"}
+    result = subprocess.run(
+        [sys.executable, "loadtest.py", "--users", "5"],
+        cwd=HERE, env=env, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "50 updates" in result.stdout
+    assert "0 errors" in result.stdout
+    for handler in ("cmd_start", "process_successful_payment", "process_promo_code_input"):
+        assert handler in result.stdout
+
+
+def test_loadtest_runs_without_bot_token():
+    # The fake token is filled in by loadtest.py itself
+    env = {name: value for name, value in os.environ.items() if name != "BOT_TOKEN"}
+    result = subprocess.run(
+        [sys.executable, "loadtest.py", "--users", "2", "--rounds", "1"],
+        cwd=HERE, env={**env, "METRICS_PORT": "0"}, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "0 errors" in result.stdout
@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+
+from migrations import LATEST_VERSION, get_schema_version, migrate
+from storage import create_pool
+
+
+def run(db_path, coro_fn):
+    async def scenario():
+        pool = create_pool(f"sqlite:///{db_path}")
+        await pool.open()
+        try:
+            return await coro_fn(pool)
+        finally:
+            await pool.close()
+
+    return asyncio.run(scenario())
+
+
+def test_fresh_database_reaches_latest_version(tmp_path):
+    db = tmp_path / "bot.db"
+    assert run(db, migrate) == LATEST_VERSION
+    assert run(db, get_schema_version) == LATEST_VERSION
+
+    conn = sqlite3.connect(db)
+    indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_payments_user_id", "idx_promo_code_usages_user_promo",
+            "idx_users_subscription_expiry"} <= indexes
+
+
+def test_up_to_date_schema_runs_no_ddl(tmp_path):
+    db = tmp_path / "bot.db"
+    run(db, migrate)
+
+    async def second_start(pool):
+        statements = []
+        for conn in pool._connections:
+            conn._raw.set_trace_callback(statements.append)
+        await migrate(pool)
+        return statements
+
+    statements = run(db, second_start)
+    assert statements
+    assert not any("CREATE" in sql or "DELETE" in sql for sql in statements)
+
+
+def test_legacy_database_is_upgraded_and_deduplicated(tmp_path):
+    db = tmp_path / "bot.db"
+    # Schema as created by the original init_db/init_promo_codes_table
+    conn = sqlite3.connect(db)
+    conn.executescript("""
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT, full_name TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            subscription_expiry TIMESTAMP, is_active BOOLEAN DEFAULT 1);
+        CREATE TABLE promo_codes (id INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT UNIQUE NOT NULL,
+            days INTEGER NOT NULL, max_uses INTEGER DEFAULT 1, used_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, expires_at TIMESTAMP, is_active BOOLEAN DEFAULT 1);
+        CREATE TABLE promo_code_usages (id INTEGER PRIMARY KEY AUTOINCREMENT, promo_code_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL, used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        INSERT INTO users (telegram_id) VALUES (1);
+        INSERT INTO promo_codes (code, days) VALUES ('X', 7);
+        INSERT INTO promo_code_usages (promo_code_id, user_id) VALUES (1, 1), (1, 1);
+    """)
+    conn.close()
+
+    assert run(db, migrate) == LATEST_VERSION
+
+    conn = sqlite3.connect(db)
+    assert conn.execute("SELECT COUNT(*) FROM promo_code_usages").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 1
@@ -0,0 +1,61 @@
+from aiogram.types import Message
+from aiohttp import web
+
+from media import media
+from navigation import show_screen
+
+CHAT = {"id": 42, "type": "private"}
+PHOTO = [{"file_id": "photo-1", "file_unique_id": "unique-1", "width": 10, "height": 10}]
+
+
+def respond(method, data):
+    if method == "editMessageText" and data.get("message_id") == "999":
+        return web.json_response(
+            {"ok": False, "error_code": 400, "description": "Bad Request: message can't be edited"},
+            status=400,
+        )
+    if method in ("sendPhoto", "editMessageCaption", "editMessageMedia"):
+        message = {"message_id": int(data.get("message_id") or 100), "date": 0, "chat": CHAT, "photo": PHOTO}
+        return web.json_response({"ok": True, "result": message})
+
+
+def test_navigation_edits_in_one_call(tmp_path, run_db, fake_bot_api):
+    image = tmp_path / "menu.jpg"
+    image.write_bytes(b"fake image")
+
+    async def scenario():
+        api = await fake_bot_api(respond).start()
+        bot = api.bot()
+        try:
+            start = Message.model_validate({"message_id": 1, "date": 0, "chat": CHAT, "text": "/start"},
+                                           context={"bot": bot})
+            menu = await media.answer_photo(start, str(image), caption="menu")
+            assert api.methods == ["sendPhoto"]
+
+            # Menu -> profile -> menu: caption edits on the same photo
+            profile = await show_screen(menu, "profile")
+            menu = await show_screen(profile, "menu", photo=str(image))
+            assert api.methods[1:] == ["editMessageCaption", "editMessageCaption"]
+
+            text = Message.model_validate({"message_id": 5, "date": 0, "chat": CHAT, "text": "paid"},
+                                          context={"bot": bot})
+            api.calls.clear()
+            await show_screen(text, "plans")
+            assert api.methods == ["editMessageText"]
+
+            # A text message can't become a photo: delete and send by file_id
+            api.calls.clear()
+            await show_screen(text, "menu", photo=str(image))
+            assert api.methods == ["deleteMessage", "sendPhoto"]
+
+            # Rejected edit falls back to a new message
+            old = Message.model_validate({"message_id": 999, "date": 0, "chat": CHAT, "text": "old"},
+                                         context={"bot": bot})
+            api.calls.clear()
+            await show_screen(old, "profile")
+            assert api.methods == ["editMessageText", "deleteMessage", "sendMessage"]
+        finally:
+            await bot.session.close()
+            await api.close()
+
+    run_db(scenario)
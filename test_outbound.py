@@ -0,0 +1,106 @@
+import asyncio
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, DeleteMessage, EditMessageText, SendMessage
+
+import outbound
+from outbound import BULK, INTERACTIVE, OutboundScheduler
+from ratelimit import PriorityTokenBucket
+
+
+def test_interactive_waiters_go_before_bulk():
+    async def scenario():
+        bucket = PriorityTokenBucket(rate=50, capacity=1)
+        await bucket.acquire()  # drain the burst so everyone has to queue
+        order = []
+
+        async def take(name, priority):
+            await bucket.acquire(priority=priority)
+            order.append(name)
+
+        bulk = [asyncio.create_task(take(f"bulk{n}", BULK)) for n in range(3)]
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(take("reply", INTERACTIVE))
+        await asyncio.gather(*bulk, interactive)
+        return order
+
+    assert asyncio.run(scenario()) == ["reply", "bulk0", "bulk1", "bulk2"]
+
+
+def test_retry_after_pauses_and_retries():
+    async def scenario():
+        scheduler = OutboundScheduler(rate=100, chat_rate=100, chat_burst=10, max_retries=2)
+        calls = []
+
+        async def make_request(bot, method):
+            calls.append(method.__api_method__)
+            if len(calls) == 1:
+                raise TelegramRetryAfter(method=method, message="Flood", retry_after=0.05)
+            return "ok"
+
+        method = SendMessage(chat_id=1, text="hi")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await scheduler(make_request, None, method) == "ok"
+        assert loop.time() - started >= 0.05
+        assert calls == ["sendMessage", "sendMessage"]
+
+        # Calls without a chat are passed straight through
+        assert await scheduler(make_request, None, AnswerCallbackQuery(callback_query_id="1")) == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_per_chat_limit_does_not_hold_other_chats():
+    async def scenario():
+        scheduler = OutboundScheduler(rate=1000, chat_rate=10, chat_burst=1)
+        sent = []
+
+        async def make_request(bot, method):
+            sent.append(method.chat_id)
+
+        # Chat 1 gets a second message (waits ~0.1 s), chat 2 must not wait behind it
+        await asyncio.gather(
+            scheduler(make_request, None, SendMessage(chat_id=1, text="a")),
+            scheduler(make_request, None, SendMessage(chat_id=1, text="b")),
+            scheduler(make_request, None, SendMessage(chat_id=2, text="c")),
+        )
+        return sent
+
+    assert asyncio.run(scenario()) == [1, 2, 1]
+
+
+def test_edits_and_deletes_skip_the_chat_limit():
+    async def scenario():
+        scheduler = OutboundScheduler(rate=1000, chat_rate=0.001, chat_burst=1)
+        sent = []
+
+        async def make_request(bot, method):
+            sent.append(method.__api_method__)
+
+        # The chat's only token goes to the message, edits and deletes don't wait for another
+        await scheduler(make_request, None, SendMessage(chat_id=1, text="a"))
+        await asyncio.wait_for(asyncio.gather(
+            scheduler(make_request, None, EditMessageText(chat_id=1, message_id=1, text="b")),
+            scheduler(make_request, None, DeleteMessage(chat_id=1, message_id=1)),
+        ), timeout=1)
+        return sent
+
+    assert asyncio.run(scenario()) == ["sendMessage", "editMessageText", "deleteMessage"]
+
+
+def test_split_shares_the_global_rate():
+    scheduler = OutboundScheduler(rate=30)
+    scheduler.split(4)
+    assert scheduler.bucket.rate == scheduler.bucket.capacity == 7.5
+
+
+def test_chat_buckets_stay_bounded(monkeypatch):
+    monkeypatch.setattr(outbound, "MAX_CHAT_BUCKETS", 4)
+    scheduler = OutboundScheduler(chat_rate=0.001, chat_burst=1)
+    for chat_id in range(4):
+        scheduler._chat_bucket(chat_id).try_acquire()
+
+    # None of them is idle: the oldest half goes
+    scheduler._chat_bucket(10)
+    assert list(scheduler._chats) == [2, 3, 10]
@@ -0,0 +1,53 @@
+import asyncio
+
+import database
+from database import (
+    create_user, record_payment, get_subscription_info,
+    PAYMENT_OK, PAYMENT_DUPLICATE, PAYMENT_NO_USER
+)
+
+
+def test_redelivered_payment_is_credited_once(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+
+        results = await asyncio.gather(*(
+            record_payment(1, 300, "RUB", 30, "sub_30_1_0_rub", "charge-1", "provider-1")
+            for _ in range(10)
+        ))
+
+        statuses = [r["status"] for r in results]
+        assert statuses.count(PAYMENT_OK) == 1
+        assert statuses.count(PAYMENT_DUPLICATE) == 9
+        assert (await get_subscription_info(1))["days_left"] in (29, 30)
+        async with database._db().acquire() as conn:
+            assert await conn.fetchval("SELECT COUNT(*) FROM payments") == 1
+
+    run_db(scenario, pool_size=8)
+
+
+def test_distinct_charges_extend_subscription(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+
+        assert (await record_payment(1, 50, "XTR", 30, "p", "charge-1"))["status"] == PAYMENT_OK
+        assert (await record_payment(1, 50, "XTR", 30, "p", "charge-2"))["status"] == PAYMENT_OK
+        assert (await get_subscription_info(1))["days_left"] in (59, 60)
+        assert (await record_payment(2, 50, "XTR", 30, "p", "charge-3"))["status"] == PAYMENT_NO_USER
+
+    run_db(scenario, pool_size=8)
+
+
+def test_unmatched_charge_is_recorded_without_days(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+
+        result = await record_payment(1, 50, "XTR", 0, "unknown", "charge-1")
+        assert result == {"status": PAYMENT_OK, "expiry": None}
+        assert (await record_payment(1, 50, "XTR", 0, "unknown", "charge-1"))["status"] == PAYMENT_DUPLICATE
+        assert await get_subscription_info(1) is None
+        async with database._db().acquire() as conn:
+            assert await conn.fetchval("SELECT days FROM payments WHERE telegram_payment_charge_id = ?",
+                                       ("charge-1",)) == 0
+
+    run_db(scenario)
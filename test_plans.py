@@ -0,0 +1,48 @@
+from plans import PlanCatalog, RUB, XTR
+
+
+def make_catalog(secret=b"secret"):
+    return PlanCatalog([100, 300], [50, 150], [30, 90], secret)
+
+
+def test_texts_and_keyboards_are_prerendered():
+    catalog = make_catalog()
+    assert "1 месяц" in catalog.plans_text and "3 месяца" in catalog.plans_text
+    assert catalog.get(90).currency_keyboard.inline_keyboard[0][0].callback_data == "buy_rub_90"
+    assert catalog.get(7) is None
+
+
+def test_verify_accepts_issued_invoice():
+    catalog = make_catalog()
+    plan = catalog.get(30)
+    payload = catalog.invoice_payload(plan, RUB, 42)
+
+    assert len(payload) <= 128
+    invoice = catalog.verify(payload, RUB, 10000, 42)
+    assert invoice.plan is plan and invoice.currency == RUB
+    assert catalog.verify(catalog.invoice_payload(plan, XTR, 42), XTR, 50, 42)
+
+
+def test_verify_rejects_tampering():
+    catalog = make_catalog()
+    payload = catalog.invoice_payload(catalog.get(90), XTR, 42)
+
+    assert catalog.verify(payload, XTR, 1, 42) is None          # wrong amount
+    assert catalog.verify(payload, RUB, 30000, 42) is None      # wrong currency
+    assert catalog.verify(payload, XTR, 150, 43) is None        # someone else's invoice
+    assert catalog.verify(payload.replace("90.", "30.", 1), XTR, 50, 42) is None
+    assert make_catalog(b"other").verify(payload, XTR, 150, 42) is None
+    assert catalog.verify("sub_30_42_0_rub", RUB, 10000, 42) is None
+
+
+def test_paid_days_outlive_the_plan():
+    payload = make_catalog().invoice_payload(make_catalog().get(90), XTR, 42)
+    # The 90-day plan is gone by the time the payment arrives
+    catalog = PlanCatalog([100], [50], [30], b"secret")
+    assert catalog.parse_payload(payload) is None
+    assert catalog.paid_days(payload) == 90
+
+    assert catalog.paid_days("sub_7_42_123_star") == 7
+    assert catalog.paid_days("sub_0_42_123_rub") is None
+    assert catalog.paid_days(payload.replace("90.", "30.", 1)) is None
+    assert catalog.paid_days("donation") is None
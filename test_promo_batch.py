@@ -0,0 +1,41 @@
+import csv
+import io
+import itertools
+
+import database
+from database import create_promo_code, create_promo_codes, validate_promo_code
+from promocodes import codes_csv, parse_expiry, random_code
+
+
+def test_batch_inserts_unique_codes_in_one_go(run_db):
+    async def scenario():
+        expires_at = parse_expiry("2099-12-31")
+        codes = await create_promo_codes(lambda: random_code("partner"), 10000, 30, 2, expires_at)
+
+        assert len(codes) == len(set(codes)) == 10000
+        assert all(code.startswith("PARTNER") and len(code) == 15 for code in codes)
+        async with database._db().acquire() as conn:
+            assert await conn.fetchval("SELECT COUNT(*) FROM promo_codes") == 10000
+        promo = await validate_promo_code(codes[0])
+        assert promo["days"] == 30 and promo["max_uses"] == 2
+
+        rows = list(csv.reader(io.StringIO(codes_csv(codes, 30, 2, expires_at).decode())))
+        assert rows[0] == ["code", "days", "max_uses", "expires_at"]
+        assert rows[1] == [codes[0], "30", "2", "2100-01-01 00:00:00"]
+        assert len(rows) == 10001
+
+    run_db(scenario)
+
+
+def test_taken_and_repeated_candidates_are_replaced(run_db):
+    async def scenario():
+        await create_promo_code("A1", 7)
+        # Collides with the existing code and with itself before giving fresh ones
+        candidates = itertools.chain(["A1", "B2", "B2", "A1"], (f"C{n}" for n in itertools.count()))
+        codes = await create_promo_codes(lambda: next(candidates), 4, 7)
+
+        assert codes == ["B2", "C0", "C1", "C2"]
+        async with database._db().acquire() as conn:
+            assert await conn.fetchval("SELECT COUNT(*) FROM promo_codes") == 5
+
+    run_db(scenario)
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+import database
+from database import create_promo_code, list_promo_codes_page
+
+
+def codes(rows):
+    return [r["code"] for r in rows]
+
+
+def test_pages_walk_forward_and_back_without_gaps(run_db):
+    async def scenario():
+        # Mostly the same created_at second: id breaks the ties
+        for n in range(45):
+            await create_promo_code(f"CODE{n:03d}", 7)
+
+        pages, after_id, has_more = [], None, True
+        while has_more:
+            rows, has_more = await list_promo_codes_page(after_id=after_id, limit=20)
+            pages.append(rows)
+            after_id = rows[-1]["id"]
+        assert [len(p) for p in pages] == [20, 20, 5]
+        assert [c for p in pages for c in codes(p)] == [f"CODE{n:03d}" for n in reversed(range(45))]
+
+        rows, has_more = await list_promo_codes_page(before_id=pages[2][0]["id"], limit=20)
+        assert codes(rows) == codes(pages[1]) and has_more
+        rows, has_more = await list_promo_codes_page(before_id=pages[1][0]["id"], limit=20)
+        assert codes(rows) == codes(pages[0]) and not has_more
+
+    run_db(scenario)
+
+
+def test_filters_and_prefix_search(run_db):
+    async def scenario():
+        await create_promo_code("SPRING1", 7, max_uses=5)
+        await create_promo_code("SPRING2", 7, max_uses=5, expires_at=datetime.now() - timedelta(days=1))
+        await create_promo_code("SUMMER", 7, max_uses=1)
+        await create_promo_code("SPRINGER", 7, max_uses=5, expires_at=datetime.now() + timedelta(days=1))
+        async with database._db().transaction() as conn:
+            await conn.execute("UPDATE promo_codes SET used_count = 1 WHERE code = 'SUMMER'")
+
+        assert codes((await list_promo_codes_page("active"))[0]) == ["SPRINGER", "SPRING1"]
+        assert codes((await list_promo_codes_page("expired"))[0]) == ["SPRING2"]
+        assert codes((await list_promo_codes_page("exhausted"))[0]) == ["SUMMER"]
+        assert codes((await list_promo_codes_page(prefix="spring"))[0]) == ["SPRINGER", "SPRING2", "SPRING1"]
+        assert codes((await list_promo_codes_page("active", "SPRING2"))[0]) == []
+        rows, _ = await list_promo_codes_page(prefix="SPRINGE")
+        assert isinstance(rows[0]["expires_at"], datetime)
+
+    run_db(scenario)
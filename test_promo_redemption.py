@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import database
+from database import (
+    create_user, create_promo_code, redeem_promo_code,
+    get_subscription_info, PROMO_OK, PROMO_ALREADY_USED, PROMO_INVALID
+)
+
+
+async def count(sql, args=()):
+    async with database._db().acquire() as conn:
+        return await conn.fetchval(sql, args)
+
+
+def test_concurrent_redemptions_respect_max_uses(run_db):
+    async def scenario():
+        users = range(1000, 1100)
+        for telegram_id in users:
+            await create_user(telegram_id, "", "")
+        await create_promo_code("RACE", 7, max_uses=5)
+
+        results = await asyncio.gather(*(redeem_promo_code("race", tid) for tid in users))
+
+        statuses = [r["status"] for r in results]
+        assert statuses.count(PROMO_OK) == 5
+        assert statuses.count(PROMO_INVALID) == 95
+        assert await count("SELECT used_count FROM promo_codes WHERE code = 'RACE'") == 5
+        assert await count("SELECT COUNT(*) FROM promo_code_usages") == 5
+        assert await count("SELECT COUNT(*) FROM users WHERE subscription_expiry IS NOT NULL") == 5
+
+    run_db(scenario, pool_size=8)
+
+
+def test_same_user_redeems_once_under_concurrency(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+        await create_promo_code("TWICE", 10, max_uses=100)
+
+        results = await asyncio.gather(*(redeem_promo_code("TWICE", 1) for _ in range(20)))
+
+        statuses = [r["status"] for r in results]
+        assert statuses.count(PROMO_OK) == 1
+        assert statuses.count(PROMO_ALREADY_USED) == 19
+        # Rolled back attempts must not burn uses
+        assert await count("SELECT used_count FROM promo_codes WHERE code = 'TWICE'") == 1
+        assert (await get_subscription_info(1))["days_left"] in (9, 10)
+
+    run_db(scenario, pool_size=8)
+
+
+def test_unknown_and_expired_codes_are_rejected(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+        await create_promo_code("OLD", 7, max_uses=10, expires_at=datetime.now() - timedelta(days=1))
+
+        assert (await redeem_promo_code("OLD", 1))["status"] == PROMO_INVALID
+        assert (await redeem_promo_code("NOPE", 1))["status"] == PROMO_INVALID
+        assert await count("SELECT used_count FROM promo_codes WHERE code = 'OLD'") == 0
+
+    run_db(scenario, pool_size=8)
+
+
+def test_exhausted_code_reports_already_used_to_its_user(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+        await create_user(2, "", "")
+        await create_promo_code("ONCE", 7, max_uses=1)
+
+        assert (await redeem_promo_code("ONCE", 1))["status"] == PROMO_OK
+        assert (await redeem_promo_code("once", 1))["status"] == PROMO_ALREADY_USED
+        assert (await redeem_promo_code("ONCE", 2))["status"] == PROMO_INVALID
+
+    run_db(scenario)
+
+
+def test_use_promo_code_logs_failures(run_db, monkeypatch, caplog):
+    async def broken(code, telegram_id):
+        raise RuntimeError("lost connection")
+
+    monkeypatch.setattr(database, "redeem_promo_code", broken)
+    assert run_db(lambda: database.use_promo_code("GIFT", 1)) is False
+    [record] = [r for r in caplog.records if "use_promo_code" in r.message]
+    assert record.exc_info[1].args == ("lost connection",)
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import database
+from database import create_user, add_subscription, claim_expiry_reminders
+from reminders import ReminderScheduler
+
+
+class FakeBot:
+    """Records send_message calls, raising the queued errors first"""
+
+    def __init__(self, errors: dict = None):
+        self.errors = errors or {}  # chat id -> list of exceptions to raise
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        errors = self.errors.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append(chat_id)
+
+
+def api_error(cls, chat_id, **kwargs):
+    return cls(method=SendMessage(chat_id=chat_id, text=""), message="error", **kwargs)
+
+
+async def subscribers():
+    """Users 1-3, their subscriptions end in two days"""
+    for telegram_id in (1, 2, 3):
+        await create_user(telegram_id, f"user{telegram_id}", "User")
+        await add_subscription(telegram_id, 2)
+
+
+async def expire_claims():
+    async with database._db().transaction() as conn:
+        await conn.execute("UPDATE subscription_reminders SET claimed_at = ?",
+                           (datetime.now() - timedelta(hours=1),))
+
+
+def test_reminder_goes_out_once_per_window(run_db):
+    async def scenario():
+        await subscribers()
+        bot = FakeBot()
+        scheduler = ReminderScheduler(bot, windows=[3, 1], rate=1000)
+
+        assert await scheduler.run_once() == 3
+        assert sorted(bot.sent) == [1, 2, 3]
+        # Delivered reminders aren't sent again, not even once the claim is old
+        await expire_claims()
+        assert await scheduler.run_once() == 0
+        assert len(bot.sent) == 3
+
+    run_db(scenario)
+
+
+def test_retry_after_is_retried_in_the_same_scan(run_db):
+    async def scenario():
+        await subscribers()
+        bot = FakeBot({2: [api_error(TelegramRetryAfter, 2, retry_after=0)]})
+        scheduler = ReminderScheduler(bot, windows=[3], rate=1000)
+
+        assert await scheduler.run_once() == 3
+        assert sorted(bot.sent) == [1, 2, 3]
+
+    run_db(scenario)
+
+
+def test_failed_reminder_is_retried_by_a_later_scan(run_db):
+    async def scenario():
+        await subscribers()
+        bot = FakeBot({
+            2: [api_error(TelegramNetworkError, 2)],
+            3: [api_error(TelegramForbiddenError, 3)],
+        })
+        scheduler = ReminderScheduler(bot, windows=[3], rate=1000)
+
+        assert await scheduler.run_once() == 1
+        # Still claimed: the next scan right away leaves it alone
+        assert await scheduler.run_once() == 0
+
+        await expire_claims()
+        assert await scheduler.run_once() == 1
+        # A user who blocked the bot isn't retried
+        assert bot.sent == [1, 2]
+
+    run_db(scenario)
+
+
+def test_claim_lost_in_a_crash_is_picked_up_again(run_db):
+    async def scenario():
+        await subscribers()
+        now = datetime.now()
+        claimed = await claim_expiry_reminders(3, now, now + timedelta(days=3))
+        assert [telegram_id for _, telegram_id, _ in claimed] == [1, 2, 3]
+        assert await claim_expiry_reminders(3, now, now + timedelta(days=3)) == []
+
+        # The process died before sending: once the claim is stale it's sent
+        await expire_claims()
+        bot = FakeBot()
+        assert await ReminderScheduler(bot, windows=[3], rate=1000).run_once() == 3
+
+    run_db(scenario)
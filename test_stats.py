@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta, timezone
+
+import database
+from database import (
+    create_user, upsert_users, record_payment, create_promo_code,
+    redeem_promo_code, get_stats_summary, rebuild_stats,
+    stats_backfilled
+)
+from stats import StatsJob, format_stats
+
+
+def test_writes_update_counters_in_their_transactions(run_db):
+    async def scenario():
+        await create_user(1, "a", "A")
+        await upsert_users([(2, "b", "B"), (3, "c", "C"), (2, "b2", "B")])
+        await create_user(1, "a", "A renamed")
+        await record_payment(1, 300, "RUB", 30, "p", "charge-1")
+        await record_payment(1, 300, "RUB", 30, "p", "charge-1")  # redelivered
+        await record_payment(2, 50, "XTR", 30, "p", "charge-2")
+        await create_promo_code("FREE", 7, max_uses=5)
+        await redeem_promo_code("FREE", 3)
+        await redeem_promo_code("FREE", 3)  # already used
+
+        summary = await get_stats_summary()
+        totals = summary["totals"]
+        assert totals[("new_users", "")] == 3
+        assert totals[("payments", "RUB")] == 1
+        assert totals[("revenue", "RUB")] == 300
+        assert totals[("revenue", "XTR")] == 50
+        assert totals[("promo_redemptions", "")] == 1
+        current, previous = summary["periods"][7]
+        assert current[("new_users", "")] == 3 and previous == {}
+
+        async with database._db().acquire() as conn:
+            assert await conn.fetchval("SELECT username FROM users WHERE telegram_id = 2") == "b2"
+
+        # Rebuilding from history gives the same numbers
+        await rebuild_stats()
+        rebuilt = await get_stats_summary()
+        assert {k: v for k, v in rebuilt["totals"].items() if k[0] != "backfilled"} == totals
+        assert rebuilt["periods"] == summary["periods"]
+
+    run_db(scenario)
+
+
+def test_backfill_builds_daily_rollups_from_history(run_db):
+    async def scenario():
+        today = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        async with database._db().transaction() as conn:
+            for telegram_id, age in ((1, 0), (2, 3), (3, 10), (4, 100)):
+                # As CURRENT_TIMESTAMP would have stored it (UTC)
+                created = (today - timedelta(days=age)).timestamp()
+                utc = datetime.fromtimestamp(created, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                await conn.execute(
+                    "INSERT INTO users (telegram_id, created_at) VALUES (?, ?)", (telegram_id, utc)
+                )
+                await conn.execute(
+                    """INSERT INTO payments (user_id, amount, days, currency, payment_date)
+                       SELECT id, 100, 30, 'RUB', ? FROM users WHERE telegram_id = ?""",
+                    (utc, telegram_id)
+                )
+            await conn.execute(
+                "UPDATE users SET subscription_expiry = ? WHERE telegram_id IN (1, 2)",
+                (today + timedelta(days=5),)
+            )
+
+        assert not await stats_backfilled()
+        assert await StatsJob().run_once() == 2
+        assert await stats_backfilled()
+
+        summary = await get_stats_summary()
+        assert summary["totals"][("new_users", "")] == 4
+        assert summary["totals"][("revenue", "RUB")] == 400
+        assert summary["totals"][("active_subscriptions", "")] == 2
+        assert summary["active"] == {0: 2}
+        current, previous = summary["periods"][7]
+        assert current[("payments", "RUB")] == 2
+        assert previous[("payments", "RUB")] == 1
+        current, previous = summary["periods"][30]
+        assert current[("revenue", "RUB")] == 300 and previous == {}
+
+        # Second run only refreshes the snapshot
+        await create_user(5, "", "")
+        assert await StatsJob().run_once() == 2
+        assert (await get_stats_summary())["totals"][("new_users", "")] == 5
+
+        text = format_stats(summary)
+        assert "Всего пользователей: <b>4</b>" in text
+        assert "300 ₽" in text
+
+    run_db(scenario)
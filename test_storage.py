@@ -0,0 +1,135 @@
+import asyncio
+import os
+import uuid
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import database
+from storage import IntegrityError, PostgresPool, SQLitePool, _rowcount, _to_numbered, create_pool
+
+POSTGRES_URL = os.environ.get("DATABASE_URL", "")
+postgres = pytest.mark.skipif(
+    not POSTGRES_URL.startswith(("postgres://", "postgresql://")),
+    reason="set DATABASE_URL to a PostgreSQL database to run",
+)
+
+
+def test_placeholders_are_numbered_in_order():
+    assert _to_numbered("SELECT * FROM users WHERE telegram_id = ?") == \
+        "SELECT * FROM users WHERE telegram_id = $1"
+    assert _to_numbered("INSERT INTO t (a, b, c) VALUES (?, ?, ?), (?, ?, ?)") == \
+        "INSERT INTO t (a, b, c) VALUES ($1, $2, $3), ($4, $5, $6)"
+    assert _to_numbered("SELECT 1") == "SELECT 1"
+
+
+def test_question_marks_in_string_literals_are_kept():
+    assert _to_numbered("SELECT '?' , ? WHERE x = 'why?'") == "SELECT '?' , $1 WHERE x = 'why?'"
+    # A doubled quote is an escaped quote, the literal goes on
+    assert _to_numbered("SELECT 'it''s ?', ?") == "SELECT 'it''s ?', $1"
+    assert _to_numbered("date(?, 'localtime') >= ?") == "date($1, 'localtime') >= $2"
+
+
+def test_rowcount_from_command_tags():
+    assert _rowcount("UPDATE 3") == 3
+    assert _rowcount("INSERT 0 1") == 1
+    assert _rowcount("DELETE 0") == 0
+    assert _rowcount("CREATE TABLE") == 0
+
+
+def test_backend_is_picked_from_the_url(tmp_path):
+    pool = create_pool("sqlite:///bot.db", base_dir=str(tmp_path))
+    assert isinstance(pool, SQLitePool) and pool.path == str(tmp_path / "bot.db")
+    assert create_pool(f"sqlite:///{tmp_path}/abs.db").path == f"{tmp_path}/abs.db"
+
+    pool = create_pool("postgres://bot:secret@db:5432/bot", size=8)
+    assert isinstance(pool, PostgresPool)
+    assert (pool.dsn, pool.size) == ("postgresql://bot:secret@db:5432/bot", 8)
+
+    with pytest.raises(ValueError):
+        create_pool("bot.db")
+
+
+def run_postgres(scenario):
+    """Run `scenario` against a throwaway schema of the DATABASE_URL database"""
+    import asyncpg
+
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    url = f"{POSTGRES_URL}{'&' if '?' in POSTGRES_URL else '?'}search_path={schema}"
+
+    async def wrapper():
+        admin = await asyncpg.connect(POSTGRES_URL)
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        try:
+            await database.init_db(url, pool_size=4, profile=False)
+            database._expiry_cache.clear()
+            try:
+                return await scenario()
+            finally:
+                await database.close_db()
+        finally:
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+            await admin.close()
+
+    return asyncio.run(wrapper())
+
+
+@postgres
+def test_postgres_users_payments_and_promo_codes():
+    async def scenario():
+        assert database._db().dialect == "postgresql"
+        await database.upsert_users([(1, "a", "A"), (2, "b", "B"), (1, "a2", "A")])
+        assert (await database.get_user(1))["username"] == "a2"
+        assert await database.get_users_count() == 2
+
+        first = await database.record_payment(1, 300, "RUB", 30, "p", "charge-1")
+        again = await database.record_payment(1, 300, "RUB", 30, "p", "charge-1")
+        assert (first["status"], again["status"]) == (database.PAYMENT_OK, database.PAYMENT_DUPLICATE)
+        assert await database.has_active_subscription(1)
+
+        assert await database.create_promo_code("GIFT", 7, max_uses=1)
+        assert not await database.create_promo_code("GIFT", 7)
+        assert (await database.redeem_promo_code("gift", 2))["status"] == database.PROMO_OK
+        assert (await database.redeem_promo_code("GIFT", 2))["status"] == database.PROMO_ALREADY_USED
+        assert (await database.redeem_promo_code("GIFT", 1))["status"] == database.PROMO_INVALID
+
+        codes = iter(["GIFT", "NEW1", "NEW2"])
+        assert await database.create_promo_codes(lambda: next(codes), 2, 7) == ["NEW1", "NEW2"]
+        rows, has_more = await database.list_promo_codes_page(prefix="new", limit=1)
+        assert [r["code"] for r in rows] == ["NEW2"] and has_more
+
+        async with database._db().acquire() as conn:
+            with pytest.raises(IntegrityError):
+                await conn.execute("INSERT INTO promo_codes (code, days) VALUES (?, ?)", ("NEW1", 1))
+
+    run_postgres(scenario)
+
+
+@postgres
+def test_postgres_background_queries():
+    async def scenario():
+        await database.upsert_users([(n, f"user{n}", "User") for n in range(1, 4)])
+        for telegram_id in (1, 2, 3):
+            await database.add_subscription(telegram_id, 2)
+
+        now = datetime.now()
+        claimed = await database.claim_expiry_reminders(3, now, now + timedelta(days=3))
+        assert [telegram_id for _, telegram_id, _ in claimed] == [1, 2, 3]
+        await database.mark_reminders_sent(3, [user_id for user_id, _, _ in claimed])
+        assert await database.claim_expiry_reminders(3, now, now + timedelta(days=3), claim_timeout=timedelta(0)) == []
+
+        chunks = [rows async for rows in database.iter_table_rows("users", since=date.today(), chunk_size=2)]
+        assert [len(rows) for rows in chunks] == [2, 1]
+
+        await database.rebuild_stats()
+        assert await database.stats_backfilled()
+        assert await database.refresh_active_subscriptions() == 3
+        summary = await database.get_stats_summary()
+        assert summary["totals"][(database.STAT_NEW_USERS, "")] == 3
+
+        expires = now + timedelta(minutes=5)
+        await database.set_fsm_state("k", "State:a", expires)
+        await database.set_fsm_data("k", "{}", expires)
+        assert tuple(await database.get_fsm_record("k")) == ("State:a", "{}")
+
+    run_postgres(scenario)
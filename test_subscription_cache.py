@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import database
+from database import (
+    create_user, add_subscription, record_payment, redeem_promo_code,
+    create_promo_code, get_subscription_expiry, has_active_subscription, subscription_cache_stats,
+    PAYMENT_OK, PROMO_OK
+)
+
+
+async def set_expiry_behind_cache(telegram_id: int, expiry: datetime):
+    async with database._db().transaction() as conn:
+        await conn.execute("UPDATE users SET subscription_expiry = ? WHERE telegram_id = ?",
+                           (expiry, telegram_id))
+
+
+def test_repeated_lookup_is_a_cache_hit(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+        assert not await has_active_subscription(1)
+        hits = subscription_cache_stats()["hits"]
+
+        # A change nobody told the cache about stays invisible until the entry expires
+        await set_expiry_behind_cache(1, datetime.now() + timedelta(days=5))
+        assert not await has_active_subscription(1)
+        assert await get_subscription_expiry(1) is None
+        assert subscription_cache_stats()["hits"] == hits + 2
+
+        database._expiry_cache.clear()
+        assert await has_active_subscription(1)
+
+    run_db(scenario)
+
+
+def test_subscription_writes_update_the_cache(run_db):
+    async def scenario():
+        await create_user(1, "", "")
+        await create_promo_code("GIFT", 10)
+        misses = subscription_cache_stats()["misses"]
+        assert await get_subscription_expiry(1) is None
+
+        expiry = await add_subscription(1, 30)
+        assert await get_subscription_expiry(1) == expiry
+
+        result = await record_payment(1, 300, "RUB", 30, "sub_30_1_0_rub", "charge-1")
+        assert result["status"] == PAYMENT_OK
+        assert await get_subscription_expiry(1) == result["expiry"]
+
+        result = await redeem_promo_code("GIFT", 1)
+        assert result["status"] == PROMO_OK
+        assert await get_subscription_expiry(1) == result["expiry"]
+
+        # Only the first read went to the database, and the cache matches it
+        assert subscription_cache_stats()["misses"] == misses + 1
+        database._expiry_cache.clear()
+        assert await get_subscription_expiry(1) == result["expiry"]
+
+    run_db(scenario)
+
+
+def test_failed_write_invalidates_the_entry(run_db, monkeypatch):
+    async def scenario():
+        await create_user(1, "", "")
+        assert await get_subscription_expiry(1) is None
+        await set_expiry_behind_cache(1, datetime.now() + timedelta(days=5))
+
+        async def broken(conn, telegram_id, days):
+            raise RuntimeError("lost connection")
+
+        monkeypatch.setattr(database, "_add_subscription", broken)
+        try:
+            await add_subscription(1, 30)
+        except RuntimeError:
+            pass
+        # The outcome is unknown, so the next read goes to the database
+        assert await get_subscription_expiry(1) is not None
+
+    run_db(scenario)
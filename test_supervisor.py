@@ -0,0 +1,111 @@
+import asyncio
+import functools
+import os
+
+import supervisor
+from supervisor import ShardWorker, Supervisor, shard_key
+
+
+def message(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "text": text,
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "U"}},
+    }
+
+
+def test_shard_key_prefers_sender():
+    assert shard_key(message(1, 42, "hi")) == 42
+    assert shard_key({"update_id": 5, "callback_query": {"id": "x", "from": {"id": 7}}}) == 7
+    assert shard_key({"update_id": 6, "channel_post": {"chat": {"id": -100}}}) == -100
+    assert shard_key({"update_id": 9}) == 9
+
+
+class RecordingDispatcher:
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    async def feed_raw_update(self, bot, update: dict):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        text = update["message"]["text"]
+        # Earlier updates take longer: without ordering they would finish last
+        await asyncio.sleep(0.05 if text == "first" else 0)
+        self.events.append((update["message"]["from"]["id"], text))
+        self.running -= 1
+
+
+def test_updates_of_one_user_stay_ordered_others_run_in_parallel():
+    async def scenario():
+        dp = RecordingDispatcher()
+        worker = ShardWorker(dp, bot=None, concurrency=10)
+        for n, user in enumerate((1, 2, 3)):
+            worker.submit(message(2 * n, user, "first"))
+            worker.submit(message(2 * n + 1, user, "second"))
+        await worker.drain()
+        return dp
+
+    dp = asyncio.run(scenario())
+    for user in (1, 2, 3):
+        assert [text for uid, text in dp.events if uid == user] == ["first", "second"]
+    assert dp.max_running == 3
+
+
+def test_flooding_user_does_not_hold_slots():
+    async def scenario():
+        dp = RecordingDispatcher()
+        worker = ShardWorker(dp, bot=None, concurrency=2)
+        for n in range(20):
+            worker.submit(message(n, 1, "first"))
+        worker.submit(message(100, 2, "second"))
+        await worker.drain()
+        return dp
+
+    dp = asyncio.run(scenario())
+    # User 2 isn't stuck behind user 1's backlog of 0.05 s updates
+    assert dp.events.index((2, "second")) < 3
+
+
+def flaky_worker(index: int, conn, workers: int, log_path: str):
+    """Dies on its first update unless it has run before, otherwise acks everything"""
+    first_run = not os.path.exists(log_path)
+    with open(log_path, "a") as log:
+        log.write("start\n")
+    while True:
+        update = conn.recv()
+        if update is None:
+            return
+        if first_run:
+            os._exit(1)
+        with open(log_path, "a") as log:
+            log.write(f"{update['update_id']}\n")
+        conn.send(update["update_id"])
+
+
+def test_dead_worker_is_restarted_and_gets_unacknowledged_updates(tmp_path, monkeypatch):
+    log_path = str(tmp_path / "worker.log")
+    monkeypatch.setattr(supervisor, "MONITOR_INTERVAL", 0.05)
+
+    async def scenario():
+        sup = Supervisor(workers=1, queue_size=10, target=functools.partial(flaky_worker, log_path=log_path))
+        sup._start(0)
+        monitor = asyncio.create_task(sup.monitor())
+        try:
+            for n in range(3):
+                await sup.route(message(n, 5, "hi"))
+            for _ in range(200):
+                if not sup.links[0].pending:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            sup._stopping.set()
+            await monitor
+            await sup.stop()
+
+    asyncio.run(scenario())
+    with open(log_path) as log:
+        lines = log.read().split()
+    assert lines == ["start", "start", "0", "1", "2"]
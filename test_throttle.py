@@ -0,0 +1,82 @@
+import asyncio
+
+from aiogram import Dispatcher, F
+from aiogram.filters import Command
+from aiogram.types import Update
+
+import throttle
+from throttle import ThrottlingMiddleware, setup_throttling
+
+USER = {"id": 7, "is_bot": False, "first_name": "Spammer"}
+CHAT = {"id": 7, "type": "private"}
+
+
+def message(update_id: int, text: str = "/start", **extra) -> Update:
+    return Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": CHAT, "from": USER, "text": text, **extra,
+    }})
+
+
+def callback(update_id: int) -> Update:
+    return Update.model_validate({"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": USER, "chat_instance": "1", "data": "profile",
+    }})
+
+
+def test_user_is_throttled_per_handler_cost(fake_bot_api):
+    async def scenario():
+        handled = []
+        api = await fake_bot_api().start()
+        bot = api.bot()
+        dp = Dispatcher()
+
+        @dp.message(Command("start"), flags={"throttle": "heavy"})
+        async def start(msg):
+            handled.append("start")
+
+        @dp.message(F.successful_payment)
+        async def paid(msg):
+            handled.append("paid")
+
+        @dp.callback_query(F.data == "profile")
+        async def profile(query):
+            handled.append("profile")
+            await query.answer()
+
+        # No refill during the test: the burst is all there is
+        setup_throttling(dp, ThrottlingMiddleware(rate=0.001, burst=12))
+        try:
+            # 12 tokens: two /start (5 each), then two callbacks (1 each)
+            for n in range(4):
+                await dp.feed_update(bot, message(n))
+            for n in range(4, 7):
+                await dp.feed_update(bot, callback(n))
+            payment = {"currency": "XTR", "total_amount": 50, "invoice_payload": "p",
+                       "telegram_payment_charge_id": "c", "provider_payment_charge_id": "p"}
+            await dp.feed_update(bot, message(7, text=None, successful_payment=payment))
+
+            assert handled == ["start", "start", "profile", "profile", "paid"]
+            # One notice for the streak, later drops are silent; callbacks are still answered
+            assert api.methods == ["sendMessage", "answerCallbackQuery", "answerCallbackQuery", "answerCallbackQuery"]
+        finally:
+            await bot.session.close()
+            await api.close()
+
+    asyncio.run(scenario())
+
+
+def test_idle_buckets_are_evicted(monkeypatch):
+    monkeypatch.setattr(throttle, "MAX_USER_BUCKETS", 4)
+    middleware = ThrottlingMiddleware(rate=0.001, burst=5)
+    for user_id in range(4):
+        middleware._bucket(user_id).try_acquire(5)
+
+    # All four are spent: the oldest half goes to make room
+    middleware._bucket(10).try_acquire(5)
+    assert list(middleware._buckets) == [2, 3, 10]
+
+    # Full buckets (refilled or never used) are idle and go first
+    middleware._buckets[3]._tokens = 5
+    middleware._bucket(11)
+    middleware._bucket(12)
+    assert list(middleware._buckets) == [2, 10, 12]
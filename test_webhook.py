@@ -0,0 +1,143 @@
+import asyncio
+
+import aiohttp
+from aiogram import Dispatcher
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer, unused_port
+
+from metrics import setup_metrics, start_metrics_server
+from webhook import build_app
+
+TOKEN = "123456:TEST"
+SECRET = "s3cret"
+
+
+def make_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+async def run_scenario(fake_bot_api, max_concurrency: int = 10, metrics: bool = False):
+    api = await fake_bot_api().start()
+    bot = api.bot(TOKEN)
+
+    dp = Dispatcher()
+    release = asyncio.Event()
+
+    @dp.message()
+    async def echo(message: Message):
+        if message.text == "slow":
+            await release.wait()
+        await message.bot.send_message(message.chat.id, message.text)
+
+    if metrics:
+        setup_metrics(dp, bot)
+    client = TestClient(TestServer(build_app(dp, bot, path="/webhook", secret=SECRET,
+                                             max_concurrency=max_concurrency)))
+    await client.start_server()
+    return client, api, api.calls, release
+
+
+def test_rejects_wrong_secret(fake_bot_api):
+    async def scenario():
+        client, api, calls, _ = await run_scenario(fake_bot_api)
+        try:
+            resp = await client.post("/webhook", json=make_update(1, "hi"),
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+            assert resp.status == 401
+            assert calls == []
+        finally:
+            await client.close()
+            await api.close()
+
+    asyncio.run(scenario())
+
+
+def test_update_reaches_handler_and_fake_api(fake_bot_api):
+    async def scenario():
+        client, api, calls, _ = await run_scenario(fake_bot_api)
+        try:
+            resp = await client.post("/webhook", json=make_update(1, "hello"),
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            assert resp.status == 200
+            for _ in range(100):
+                if calls:
+                    break
+                await asyncio.sleep(0.01)
+            assert calls[0][0] == "sendMessage"
+            assert calls[0][1]["text"] == "hello"
+
+            health = await client.get("/healthz")
+            assert health.status == 200
+            assert (await health.json())["status"] == "ok"
+        finally:
+            await client.close()
+            await api.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrency_limit_holds_back_responses(fake_bot_api):
+    async def scenario():
+        client, api, calls, release = await run_scenario(fake_bot_api, max_concurrency=1)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        try:
+            first = await client.post("/webhook", json=make_update(1, "slow"), headers=headers)
+            assert first.status == 200
+
+            # The only slot is busy, so the second delivery must wait
+            second = asyncio.create_task(
+                client.post("/webhook", json=make_update(2, "next"), headers=headers)
+            )
+            await asyncio.sleep(0.1)
+            assert not second.done()
+
+            release.set()
+            assert (await second).status == 200
+        finally:
+            await client.close()
+            await api.close()
+
+    asyncio.run(scenario())
+
+
+def test_metrics_cover_update_handler_and_api_call(fake_bot_api):
+    async def scenario():
+        client, api, calls, _ = await run_scenario(fake_bot_api, metrics=True)
+        try:
+            await client.post("/webhook", json=make_update(1, "hello"),
+                              headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            for _ in range(100):
+                if calls:
+                    break
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+
+            # Not on the public webhook server, only on the metrics listener
+            assert (await client.get("/metrics")).status == 404
+            port = unused_port()
+            runner = await start_metrics_server(port=port)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                        assert resp.status == 200
+                        text = await resp.text()
+            finally:
+                await runner.cleanup()
+            assert 'bot_update_duration_seconds_count{update_type="message"} 1' in text
+            assert 'bot_handler_duration_seconds_count{handler="echo"} 1' in text
+            assert 'bot_handlers_in_flight{handler="echo"} 0' in text
+            assert 'bot_api_request_duration_seconds_count{method="sendMessage"} 1' in text
+        finally:
+            await client.close()
+            await api.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,73 @@
+import asyncio
+
+import database
+import writebehind
+from dbprofile import profiler
+from writebehind import UserWriteBehind
+
+
+def count_batches(monkeypatch) -> list:
+    batches = []
+
+    async def counting(users, **kwargs):
+        batches.append(len(users))
+        await database.upsert_users(users, **kwargs)
+
+    monkeypatch.setattr(writebehind, "upsert_users", counting)
+    return batches
+
+
+def test_burst_of_starts_is_committed_in_few_batches(run_db, monkeypatch):
+    batches = count_batches(monkeypatch)
+
+    async def scenario():
+        writer = UserWriteBehind(interval=0.01, batch_size=100, maxsize=150)
+        # 300 /starts from 250 users; the last names of a repeated user win
+        await asyncio.gather(
+            *(writer.upsert(n, f"user{n}", "Old") for n in range(250)),
+            *(writer.upsert(n, f"user{n}", "New") for n in range(50)),
+        )
+        await writer.close()
+
+        user = await database.get_user(7)
+        assert user["full_name"] == "New"
+        assert await database.get_users_count() == 250
+
+    run_db(scenario)
+    assert sum(batches) <= 300
+    assert len(batches) <= 5
+    assert max(batches) <= 150
+
+
+def test_close_flushes_queued_users(run_db, monkeypatch):
+    batches = count_batches(monkeypatch)
+
+    async def scenario():
+        writer = UserWriteBehind(interval=60, batch_size=1000)
+        pending = asyncio.create_task(writer.upsert(1, "a", "A"))
+        await asyncio.sleep(0.01)
+        assert not pending.done()
+
+        await writer.close()
+        await pending
+        assert (await database.get_user(1))["username"] == "a"
+
+    run_db(scenario)
+    assert batches == [1]
+
+
+def test_large_batch_is_inserted_in_fixed_size_chunks(run_db):
+    async def scenario():
+        profiler.reset()
+        await database.upsert_users([(n, f"user{n}", "User") for n in range(10)], chunk_size=4)
+        await database.upsert_users([(n, f"user{n}", "User") for n in range(5, 16)], chunk_size=4)
+        assert await database.get_users_count() == 16
+        summary = await database.get_stats_summary()
+        assert summary["totals"][(database.STAT_NEW_USERS, "")] == 16
+
+        # 4 + 4 + 2 and 4 + 4 + 3 padded to 4: two statement shapes
+        inserts = {sql: stats.calls for sql, stats in profiler.queries.items() if "INSERT INTO users" in sql}
+        assert sorted(sql.count("(?, ?, ?)") for sql in inserts) == [2, 4]
+        assert sum(inserts.values()) == 6
+
+    run_db(scenario, profile=True)
@@ -0,0 +1,100 @@
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from config import ADMIN_IDS, THROTTLE_RATE, THROTTLE_BURST, THROTTLE_NOTICE
+from metrics import UPDATES_THROTTLED
+from ratelimit import TokenBucket
+
+# Handler classes, set with flags={"throttle": ...}; unflagged callbacks are
+# "cheap", unflagged messages "normal"
+THROTTLE_COSTS = {
+    "free": 0,
+    "cheap": 1,
+    "normal": 2,
+    "heavy": 5,   # sends a photo or writes to the database
+}
+
+# Drop idle per-user buckets once there are this many
+MAX_USER_BUCKETS = 10000
+
+THROTTLE_TEXT = "⏳ Слишком много запросов, подождите немного."
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Per-user anti-flood for message and callback handlers.
+
+    Every user has a token bucket refilled at `rate` tokens per second up to
+    `burst`; a handler costs tokens according to its class. An update the
+    user can't afford is dropped. Callbacks are always answered so the
+    button stops spinning; with `notice` the first dropped update of a
+    streak also tells the user to slow down, the rest are dropped silently.
+    Admins and successful payments are never throttled.
+    """
+
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST,
+                 notice: bool = THROTTLE_NOTICE):
+        self.rate = rate
+        self.burst = burst
+        self.notice = notice
+        self._buckets = {}      # user id -> TokenBucket
+        self._notified = set()  # users told to slow down in the current streak
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_USER_BUCKETS:
+                self._evict()
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _evict(self):
+        self._buckets = {k: b for k, b in self._buckets.items() if not b.is_idle()}
+        if len(self._buckets) >= MAX_USER_BUCKETS:
+            # Everyone is busy (a flood of new accounts): forget the oldest half
+            keys = list(self._buckets)
+            self._buckets = {k: self._buckets[k] for k in keys[len(keys) // 2:]}
+        self._notified &= self._buckets.keys()
+
+    def _cost(self, event: TelegramObject, data: dict) -> int:
+        if isinstance(event, Message) and event.successful_payment:
+            # The money is taken already, the payment must be credited
+            return 0
+        default = "cheap" if isinstance(event, CallbackQuery) else "normal"
+        return THROTTLE_COSTS[get_flag(data, "throttle", default=default)]
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        cost = self._cost(event, data)
+        if user is None or cost == 0 or user.id in ADMIN_IDS:
+            return await handler(event, data)
+
+        if self._bucket(user.id).try_acquire(cost):
+            self._notified.discard(user.id)
+            return await handler(event, data)
+
+        name = data["handler"].callback.__name__
+        UPDATES_THROTTLED.inc(name)
+        first = user.id not in self._notified
+        if first:
+            self._notified.add(user.id)
+            logging.info(f"Throttling user {user.id} ({name})")
+        if isinstance(event, CallbackQuery):
+            await event.answer(THROTTLE_TEXT if first and self.notice else None)
+        elif isinstance(event, Message) and first and self.notice:
+            await event.answer(THROTTLE_TEXT)
+
+
+def setup_throttling(dp, middleware: ThrottlingMiddleware = None) -> ThrottlingMiddleware:
+    middleware = middleware or ThrottlingMiddleware()
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+    return middleware
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_MAX_CONCURRENCY
+)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Webhook handler that runs at most `max_concurrency` updates at once.
+
+    Telegram gets its 200 as soon as a slot is free and the update is
+    scheduled. When all slots are busy the HTTP response is held back, so a
+    burst queues up on Telegram's side instead of in our memory.
+    """
+
+    def __init__(self, *args, max_concurrency: int = WEBHOOK_MAX_CONCURRENCY, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _feed_and_release(self, bot: Bot, update: dict):
+        try:
+            await self._background_feed_update(bot=bot, update=update)
+        finally:
+            self._slots.release()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+
+        task = asyncio.create_task(self._feed_and_release(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+
+def build_app(
+    dp: Dispatcher,
+    bot: Bot,
+    path: str = WEBHOOK_PATH,
+    secret: str = WEBHOOK_SECRET,
+    max_concurrency: int = WEBHOOK_MAX_CONCURRENCY,
+) -> web.Application:
+    """aiohttp app with the webhook endpoint and GET /healthz.
+
+    This server is public, so /metrics stays on its own METRICS_PORT listener.
+    """
+    app = web.Application()
+    handler = LimitedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret or None,
+        max_concurrency=max_concurrency,
+    )
+    handler.register(app, path=path)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "in_flight": handler.in_flight,
+            "max_concurrency": handler.max_concurrency,
+        })
+
+    app.router.add_get("/healthz", health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Serve updates over HTTPS webhook (behind a reverse proxy) until cancelled"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL must be set when RUN_MODE=webhook")
+
+    app = build_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100),
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
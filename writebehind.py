@@ -0,0 +1,89 @@
+import asyncio
+import logging
+
+from config import USER_FLUSH_INTERVAL, USER_FLUSH_BATCH, USER_QUEUE_SIZE
+from database import upsert_users
+
+
+class UserWriteBehind:
+    """Group commit for user upserts.
+
+    upsert() parks the row in a queue and returns once the batch holding it
+    is committed. Batches go out every `interval` seconds or as soon as
+    `batch_size` users are waiting, as one transaction with an INSERT per
+    `batch_size` rows. Repeated /start from the same user within a batch
+    collapses to one row (latest names win). At most `maxsize` users wait
+    at once; beyond that callers wait for the next flush.
+    """
+
+    def __init__(self, interval: float = USER_FLUSH_INTERVAL, batch_size: int = USER_FLUSH_BATCH,
+                 maxsize: int = USER_QUEUE_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self._pending = {}  # telegram_id -> (username, full_name)
+        self._done = None   # resolved when the pending batch is committed
+        self._has_pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    def _batch_future(self) -> asyncio.Future:
+        if self._done is None:
+            self._done = asyncio.get_running_loop().create_future()
+        return self._done
+
+    async def upsert(self, telegram_id: int, username: str, full_name: str):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        while len(self._pending) >= self.maxsize and telegram_id not in self._pending:
+            self._full.set()
+            await asyncio.shield(self._batch_future())
+
+        self._pending[telegram_id] = (username, full_name)
+        done = self._batch_future()
+        self._has_pending.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        await asyncio.shield(done)
+
+    async def _flush(self):
+        batch, self._pending = self._pending, {}
+        done, self._done = self._done, None
+        self._has_pending.clear()
+        self._full.clear()
+        if not batch:
+            return
+        try:
+            await upsert_users([(tid, username, full_name) for tid, (username, full_name) in batch.items()],
+                               chunk_size=self.batch_size)
+        except Exception as e:
+            if done is not None:
+                done.set_exception(e)
+            raise
+        if done is not None:
+            done.set_result(len(batch))
+
+    async def _run(self):
+        while not self._closing:
+            await self._has_pending.wait()
+            try:
+                # Let the batch fill for `interval` unless it's already full
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._flush()
+            except Exception:
+                logging.exception("User upsert batch failed")
+
+    async def close(self):
+        """Stop the background flusher and commit whatever is still queued"""
+        self._closing = True
+        if self._task is not None:
+            self._has_pending.set()
+            self._full.set()
+            await self._task
+            self._task = None
+        await self._flush()